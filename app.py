@@ -1,146 +1,251 @@
 # app.py
+import base64
+import bisect
+import csv
+import fcntl
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import mimetypes
+import operator
 import os
+import queue
+import re
+import secrets
+import shutil
 import sqlite3
+import sys
+import tempfile
+import threading
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date, datetime, timedelta
 from flask import (
-    Flask, g, render_template, request, redirect, url_for,
-    session, send_from_directory, jsonify, flash
+    Flask, Request, g, render_template, request, redirect, url_for,
+    session, jsonify, flash, has_request_context
 )
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.datastructures import CallbackDict
+from werkzeug.security import check_password_hash, safe_join
 from werkzeug.utils import secure_filename
-from functools import wraps
+from werkzeug.wsgi import wrap_file
+from markupsafe import escape
+from collections import OrderedDict, deque
+from functools import lru_cache, wraps
+import click
+import numpy as np
+
+import media
+import rules
+from migrations import (
+    PASSWORD_HASH_METHOD, hash_password,
+    migrate, rebuild_practice_days, rebuild_rollup_tables, rebuild_search_index,
+    technique_key, create_search_triggers, drop_search_triggers, reindex_search_rows,
+)
 
 # -------------------------
 # Configuration
 # -------------------------
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(APP_ROOT, "instance", "database.db")
+DB_PATH = os.environ.get("DATABASE_PATH") or os.path.join(APP_ROOT, "instance", "database.db")
 UPLOAD_PUBLIC = os.path.join(APP_ROOT, "static", "uploads", "public")
 UPLOAD_PRIVATE = os.path.join(APP_ROOT, "static", "uploads", "private")
+UPLOAD_TMP = os.path.join(APP_ROOT, "instance", "upload_tmp")
+BLOB_ROOT = os.path.join(APP_ROOT, "instance", "blobs")
 ALLOWED_EXT = {"png", "jpg", "jpeg", "gif", "pdf", "mp3", "wav", "mp4", "zip"}
+USER_QUOTA_BYTES = int(os.environ.get("USER_QUOTA_BYTES", 2 * 1024 ** 3))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024     # suggested client chunk size
+UPLOAD_READ_SIZE = 1024 * 1024          # bytes read from the socket at a time
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))  # seconds to finish an upload
 
 os.makedirs(os.path.join(APP_ROOT, "instance"), exist_ok=True)
 os.makedirs(UPLOAD_PUBLIC, exist_ok=True)
 os.makedirs(UPLOAD_PRIVATE, exist_ok=True)
+os.makedirs(UPLOAD_TMP, exist_ok=True)
+os.makedirs(BLOB_ROOT, exist_ok=True)
+
+
+class UploadRequest(Request):
+    """Spool multipart file parts next to the upload folders.
+
+    Werkzeug's default spools to the system temp dir, which is often
+    another filesystem, so f.save() had to copy every byte a second time.
+    Spooling to UPLOAD_TMP lets save_upload() hard-link the file into
+    place instead.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return tempfile.NamedTemporaryFile("wb+", dir=UPLOAD_TMP)
+
 
 app = Flask(__name__)
 app.secret_key = "replace-this-secret"  # change in production
+app.request_class = UploadRequest
 
 
 # -------------------------
 # DB helpers
 # -------------------------
-def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
-    return g.db
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = 30          # seconds to wait for a free connection
+DB_POOL_RETRY_AFTER = 2       # Retry-After sent when none came free
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-32000",     # ~32 MB page cache per connection
+    "PRAGMA mmap_size=268435456",   # 256 MB memory-mapped I/O
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
 
 
-@app.teardown_appcontext
-def close_db(exc):
-    db = g.pop("db", None)
-    if db:
-        db.close()
+class PoolTimeout(Exception):
+    """No pooled connection came free in time; the request should be retried."""
 
 
-def init_tables():
-    """Create tables if they don't exist."""
-    db = get_db()
-    c = db.cursor()
+class ConnectionPool:
+    """Per-process pool of tuned SQLite connections.
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT UNIQUE,
-            password TEXT,
-            name TEXT,
-            role TEXT
-        )
-    """)
+    Connections stay open between requests so each keeps its page cache and
+    prepared-statement cache. The pool is rebuilt after a fork (gunicorn
+    preload) because SQLite connections must not cross process boundaries.
+    """
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS practice_entries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            date TEXT,
-            hours REAL,
-            technique TEXT,
-            notes TEXT,
-            UNIQUE(user_id, date),
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, factory=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.factory = factory or (TimedConnection if METRICS else sqlite3.Connection)
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS errors (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            date TEXT,
-            piece TEXT,
-            error_text TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256,
+                               factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS special_notes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            date TEXT,
-            note_text TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
+    def checkout(self, timeout=None):
+        """A connection, waiting up to `timeout` seconds (default: the pool's) for one."""
+        timeout = self.timeout if timeout is None else timeout
+        conn = None
+        with self._lock:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                if self.created < self.size:
+                    self.created += 1
+                    try:
+                        conn = self._connect()
+                    except Exception:
+                        self.created -= 1
+                        raise
+        if conn is None:
+            started = time.perf_counter()
+            try:
+                conn = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.waits += 1
+                    self.wait_time += time.perf_counter() - started
+                    self.timeouts += 1
+                raise PoolTimeout(f"no database connection free after {timeout}s") from None
+            waited = time.perf_counter() - started
+            with self._lock:
+                self.waits += 1
+                self.wait_time += waited
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+        return conn
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS notifications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            teacher_id INTEGER,
-            title TEXT,
-            message TEXT,
-            timestamp TEXT,
-            attachment TEXT,
-            FOREIGN KEY(teacher_id) REFERENCES users(id)
-        )
-    """)
+    def checkin(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # broken connection: drop it and let the pool open a new one
+            conn.close()
+            with self._lock:
+                self.in_use -= 1
+                self.created -= 1
+            return
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS public_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            teacher_id INTEGER,
-            file_name TEXT,
-            original_name TEXT,
-            file_type TEXT,
-            description TEXT,
-            timestamp TEXT,
-            FOREIGN KEY(teacher_id) REFERENCES users(id)
-        )
-    """)
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self.created,
+                "in_use": self.in_use,
+                "idle": self._idle.qsize(),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time_ms": round(self.wait_time * 1000, 3),
+                "timeouts": self.timeouts,
+            }
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS private_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            file_name TEXT,
-            original_name TEXT,
-            file_type TEXT,
-            description TEXT,
-            timestamp TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS suggestions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            suggestion TEXT,
-            timestamp TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
+_pool = None
+_pool_lock = threading.Lock()
 
-    db.commit()
+
+def get_pool():
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def get_db(timeout=None):
+    if "db" not in g:
+        g.db = get_pool().checkout(timeout)
+        if isinstance(g.db, TimedConnection):
+            g.db.reset_timing()
+    return g.db
+
+
+@app.teardown_appcontext
+def close_db(exc):
+    db = g.pop("db", None)
+    if db:
+        get_pool().checkin(db)
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    app.logger.warning("%s %s: %s", request.method, request.path, e)
+    headers = {"Retry-After": str(DB_POOL_RETRY_AFTER)}
+    if request.path.startswith("/api/"):
+        return jsonify({"error": "busy"}), 503, headers
+    return "The server is busy. Please try again.", 503, headers
+
+
+def init_tables():
+    """Create tables / bring the schema up to date (see migrations.py)."""
+    migrate(get_db())
 
 
 def ensure_default_users():
@@ -152,11 +257,16 @@ def ensure_default_users():
     if r and r["cnt"] > 0:
         return  # already initialized
 
+    # scrypt releases the GIL: hash the 60 default passwords in parallel
+    ids = list(range(10001, 10051)) + list(range(70001, 70011))
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as executor:
+        hashes = dict(zip(ids, executor.map(hash_password, map(str, ids))))
+
     # students 10001-10050
     for i in range(10001, 10051):
         c.execute(
             "INSERT OR IGNORE INTO users (id, username, password, name, role) VALUES (?, ?, ?, ?, 'student')",
-            (i, str(i), str(i), f"Student {i}")
+            (i, str(i), hashes[i], f"Student {i}")
         )
         # create private folder for student
         student_folder = os.path.join(UPLOAD_PRIVATE, str(i))
@@ -166,7 +276,7 @@ def ensure_default_users():
     for i in range(70001, 70011):
         c.execute(
             "INSERT OR IGNORE INTO users (id, username, password, name, role) VALUES (?, ?, ?, ?, 'teacher')",
-            (i, str(i), str(i), f"Teacher {i}")
+            (i, str(i), hashes[i], f"Teacher {i}")
         )
         teacher_folder = os.path.join(UPLOAD_PRIVATE, str(i))
         os.makedirs(teacher_folder, exist_ok=True)
@@ -174,19 +284,13 @@ def ensure_default_users():
     db.commit()
 
 
-# initialize on startup
-with app.app_context():
-    init_tables()
-    ensure_default_users()
-
-
 # -------------------------
 # Utilities & Auth
 # -------------------------
 def login_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        if "user_id" not in session:
+        if current_user() is None:
             return redirect(url_for("login"))
         return f(*args, **kwargs)
     return wrapper
@@ -197,293 +301,2995 @@ def allowed_file(filename):
     return "." in filename and ext in ALLOWED_EXT
 
 
-def get_user_by_username(username):
-    db = get_db()
-    return db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+def make_save_name(username, filename):
+    return f"{username}_{int(datetime.now().timestamp())}_{filename}"
 
 
-def get_user_by_id(uid):
-    db = get_db()
-    return db.execute("SELECT * FROM users WHERE id = ?", (uid,)).fetchone()
+def save_upload(f, dest):
+    """Move an uploaded FileStorage to `dest` and return its size in bytes.
+
+    When the part was spooled to UPLOAD_TMP (see UploadRequest) it is
+    hard-linked into place; otherwise this falls back to f.save().
+    """
+    name = getattr(f.stream, "name", None)
+    if isinstance(name, str) and os.path.exists(name):
+        f.stream.flush()
+        try:
+            os.link(name, dest)
+            return os.path.getsize(dest)
+        except OSError:
+            pass
+    f.save(dest)
+    return os.path.getsize(dest)
 
 
-# -------------------------
-# Auth routes
-# -------------------------
-@app.route("/login", methods=["GET", "POST"])
-@app.route("/", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        username = request.form.get("username", "").strip()
-        password = request.form.get("password", "").strip()
+def upload_cutoff():
+    """created_at before which an unfinished upload session has expired."""
+    return (datetime.now() - timedelta(seconds=UPLOAD_SESSION_TTL)).isoformat()
 
-        if not (username.isdigit() and len(username) == 5):
-            return render_template("login.html", error="Username must be 5 digits.")
 
-        user = get_user_by_username(username)
-        if not user or user["password"] != password:
-            return render_template("login.html", error="Invalid username or password.")
+def quota_used(db, user_id):
+    """Bytes stored by a user plus bytes reserved by live chunked uploads."""
+    return db.execute("""
+        SELECT
+            (SELECT COALESCE(SUM(size), 0) FROM private_files WHERE user_id=?) +
+            (SELECT COALESCE(SUM(size), 0) FROM public_files WHERE teacher_id=?) +
+            (SELECT COALESCE(SUM(size), 0) FROM upload_sessions
+             WHERE user_id=? AND completed_at IS NULL AND created_at >= ?)
+    """, (user_id, user_id, user_id, upload_cutoff())).fetchone()[0]
 
-        # set session
-        session["user_id"] = user["id"]
-        session["username"] = user["username"]
-        session["role"] = user["role"]
-        session["name"] = user["name"]
-        # Redirect by role
-        if user["role"] == "student":
-            return redirect(url_for("dashboard_student"))
-        else:
-            return redirect(url_for("dashboard_teacher"))
 
-    return render_template("login.html")
+def quota_allows(db, user_id, size):
+    return quota_used(db, user_id) + (size or 0) <= USER_QUOTA_BYTES
 
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect(url_for("login"))
+def upload_refusal(db, user_id):
+    """Status to refuse a form upload with before its body is read, or None.
+
+    411 when there is no Content-Length (a chunked body can't be checked
+    up front), 413 when the declared length is over the user's quota. Call
+    it before touching request.files or request.form, which spool the body.
+    """
+    if request.content_length is None:
+        return 411
+    if not quota_allows(db, user_id, request.content_length):
+        return 413
+    return None
 
 
 # -------------------------
-# Dashboards
+# Content-addressed blob store
 # -------------------------
-@app.route("/dashboard_student")
-@login_required
-def dashboard_student():
-    if session.get("role") != "student":
-        return redirect(url_for("dashboard_teacher"))
+# Every stored upload is a blob under instance/blobs/<aa>/<sha256>, counted
+# in the blobs table. The paths the download routes serve (uploads/public,
+# uploads/private/<id>) are hard links to the blob, so a file uploaded by
+# ten teachers occupies disk once and serving code is unchanged.
+def blob_path(sha256):
+    return os.path.join(BLOB_ROOT, sha256[:2], sha256)
 
-    user_id = session["user_id"]
-    db = get_db()
-    today = date.today().isoformat()
 
-    # today's hours
-    row = db.execute(
-        "SELECT hours FROM practice_entries WHERE user_id=? AND date=?",
-        (user_id, today)
-    ).fetchone()
-    today_hours = float(row["hours"]) if row else 0.0
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for buf in iter(lambda: fh.read(UPLOAD_READ_SIZE), b""):
+            h.update(buf)
+    return h.hexdigest()
 
-    # month total
-    now = date.today()
-    month_start = now.replace(day=1).isoformat()
-    month_end = (now.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-    month_end = month_end.isoformat()
-    r = db.execute(
-        "SELECT SUM(hours) as s FROM practice_entries WHERE user_id=? AND date BETWEEN ? AND ?",
-        (user_id, month_start, month_end)
-    ).fetchone()
-    month_hours = float(r["s"]) if r and r["s"] else 0.0
 
-    # notes this week (special_notes and practice_entries notes)
-    week_ago = (date.today() - timedelta(days=7)).isoformat()
-    count_notes1 = db.execute(
-        "SELECT COUNT(*) AS c FROM special_notes WHERE user_id=? AND date >= ?",
-        (user_id, week_ago)
-    ).fetchone()["c"]
-    count_notes2 = db.execute(
-        "SELECT COUNT(*) AS c FROM practice_entries WHERE user_id=? AND date >= ? AND notes IS NOT NULL AND notes != ''",
-        (user_id, week_ago)
-    ).fetchone()["c"]
-    notes_week = int(count_notes1) + int(count_notes2)
+def link_blob(sha256, dest):
+    """Materialize a blob at `dest` (hard link, or a copy across filesystems)."""
+    try:
+        os.link(blob_path(sha256), dest)
+    except OSError:
+        shutil.copyfile(blob_path(sha256), dest)
 
-    return render_template(
-        "dashboard_student.html",
-        title="Dashboard",
-        active="dashboard",
-        today_hours=round(today_hours, 2),
-        month_hours=round(month_hours, 2),
-        notes_week=notes_week,
-    )
 
+def find_blob(db, sha256):
+    if not sha256:
+        return None
+    row = db.execute("SELECT sha256, size FROM blobs WHERE sha256=?", (sha256,)).fetchone()
+    if row and os.path.exists(blob_path(sha256)):
+        return row
+    return None
 
-@app.route("/dashboard_teacher")
-@login_required
-def dashboard_teacher():
-    if session.get("role") != "teacher":
-        return redirect(url_for("dashboard_student"))
-    # Simple teacher dashboard: show their name and count of public files and notifications
-    db = get_db()
-    teacher_id = session["user_id"]
-    pub_files = db.execute("SELECT COUNT(*) AS c FROM public_files WHERE teacher_id=?", (teacher_id,)).fetchone()["c"]
-    notes = db.execute("SELECT COUNT(*) AS c FROM notifications WHERE teacher_id=?", (teacher_id,)).fetchone()["c"]
-    return render_template("dashboard_teacher.html",
-                           title="Teacher Dashboard",
-                           active="dashboard",
-                           pub_files=pub_files,
-                           notifications_count=notes)
 
+def holds_blob(db, user_id, sha256):
+    """True if the user already stores this content (own upload or attachment).
 
-# -------------------------
-# Hours (Calendar) routes
-# -------------------------
-@app.route("/hours")
-@login_required
-def hours():
-    # Student-only page
-    if session.get("role") != "student":
-        return redirect(url_for("dashboard_teacher"))
+    Only then may an upload skip sending bytes: a declared hash alone must
+    not hand out, or confirm the existence of, anyone else's file.
+    """
+    return db.execute("""
+        SELECT 1 FROM private_files WHERE sha256=? AND user_id=?
+        UNION ALL SELECT 1 FROM public_files WHERE sha256=? AND teacher_id=?
+        UNION ALL SELECT 1 FROM notifications WHERE attachment_sha256=? AND teacher_id=?
+        LIMIT 1
+    """, (sha256, user_id) * 3).fetchone() is not None
 
-    user_id = session["user_id"]
-    db = get_db()
-    rows = db.execute(
-        "SELECT date, hours, technique, notes FROM practice_entries WHERE user_id=?",
-        (user_id,)
-    ).fetchall()
 
-    data = {}
-    for r in rows:
-        data[r["date"]] = {"hours": r["hours"], "technique": r["technique"], "notes": r["notes"]}
+def adopt_blob(db, path, sha256=None):
+    """Take ownership of a freshly written upload at `path`.
 
-    return render_template("hours.html", title="Hours Practiced", active="hours", data=data)
+    If the content is already stored, `path` is replaced by a link to the
+    existing blob; otherwise `path` becomes the blob. Either way the blob's
+    refcount goes up by one. Returns the SHA-256. The caller commits.
+    """
+    sha256 = sha256 or hash_file(path)
+    if find_blob(db, sha256):
+        os.remove(path)
+        link_blob(sha256, path)
+    else:
+        os.makedirs(os.path.dirname(blob_path(sha256)), exist_ok=True)
+        try:
+            os.link(path, blob_path(sha256))
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(path, blob_path(sha256))
+    add_blob_ref(db, sha256, os.path.getsize(path))
+    return sha256
 
 
-@app.route("/save_hours", methods=["POST"])
-@login_required
-def save_hours():
-    if session.get("role") != "student":
-        return "forbidden", 403
-    user_id = session["user_id"]
-    date_str = request.form.get("date")
-    hours = request.form.get("hours") or 0
-    technique = request.form.get("technique") or ""
-    notes = request.form.get("notes") or ""
+def add_blob_ref(db, sha256, size):
+    db.execute("""
+        INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 1, ?)
+        ON CONFLICT(sha256) DO UPDATE SET refcount=refcount + 1
+    """, (sha256, size, datetime.now().isoformat()))
 
-    # normalize date format (YYYY-M-D or YYYY-MM-DD) -> YYYY-MM-DD
+
+def release_blob(db, sha256):
+    """Drop one reference; the blob file goes when the last one does."""
+    if not sha256:
+        return
+    db.execute("UPDATE blobs SET refcount=refcount - 1 WHERE sha256=?", (sha256,))
+    row = db.execute("SELECT refcount FROM blobs WHERE sha256=?", (sha256,)).fetchone()
+    if row and row["refcount"] <= 0:
+        db.execute("DELETE FROM blobs WHERE sha256=?", (sha256,))
+        try:
+            os.remove(blob_path(sha256))
+        except OSError:
+            pass
+        remove_media(db, sha256)
+
+
+def remove_stored_file(db, path, sha256):
+    """Remove one stored copy of an upload and release its blob reference."""
     try:
-        d = datetime.strptime(date_str, "%Y-%m-%d")
-    except ValueError:
-        # try alternative parsing
-        d = datetime.fromisoformat(date_str)
-    date_key = d.date().isoformat()
+        os.remove(path)
+    except OSError:
+        pass
+    release_blob(db, sha256)
 
-    db = get_db()
-    # upsert
-    db.execute("""
-        INSERT INTO practice_entries (user_id, date, hours, technique, notes)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(user_id, date) DO UPDATE SET hours=excluded.hours, technique=excluded.technique, notes=excluded.notes
-    """, (user_id, float(hours), date_key, technique, notes))
-    db.commit()
-    return "ok", 200
 
+def backfill_blobs(db):
+    """Move files stored before the blob store existed into it."""
+    moved = 0
+    # library rows also go through the change log, so every process's
+    # catalog picks up the new sha256
+    sources = [
+        ("public_files", "sha256", "file_name", lambda r: UPLOAD_PUBLIC, "public"),
+        ("private_files", "sha256", "file_name", lambda r: os.path.join(UPLOAD_PRIVATE, str(r["user_id"])), "private"),
+        ("notifications", "attachment_sha256", "attachment", lambda r: UPLOAD_PUBLIC, None),
+    ]
+    for table, sha_col, name_col, folder, kind in sources:
+        rows = db.execute(f"SELECT * FROM {table} WHERE {sha_col} IS NULL AND {name_col} IS NOT NULL").fetchall()
+        for r in rows:
+            path = os.path.join(folder(r), r[name_col])
+            if not os.path.exists(path):
+                continue
+            sha256 = adopt_blob(db, path)
+            db.execute(f"UPDATE {table} SET {sha_col}=? WHERE id=?", (sha256, r["id"]))
+            if kind:
+                log_library_change(db, kind, r["id"], r["teacher_id"] if kind == "public" else r["user_id"])
+            db.commit()
+            moved += 1
+    return moved
 
-@app.route("/delete_hours", methods=["POST"])
-@login_required
-def delete_hours():
-    if session.get("role") != "student":
-        return "forbidden", 403
-    user_id = session["user_id"]
-    date_str = request.form.get("date")
+
+@app.cli.command("backfill-blobs")
+def backfill_blobs_command():
+    """Hash existing uploads into the blob store, linking duplicates."""
+    print(f"{backfill_blobs(get_db())} file(s) moved into the blob store.")
+
+
+class LRUCache:
+    """Small thread-safe LRU map for per-process lookups."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def parse_date_key(date_str):
+    """Normalize YYYY-M-D / YYYY-MM-DD / ISO datetime strings to YYYY-MM-DD."""
     try:
         d = datetime.strptime(date_str, "%Y-%m-%d")
     except ValueError:
         d = datetime.fromisoformat(date_str)
-    date_key = d.date().isoformat()
-
-    db = get_db()
-    db.execute("DELETE FROM practice_entries WHERE user_id=? AND date=?", (user_id, date_key))
-    db.commit()
-    return "ok", 200
+    return d.date().isoformat()
 
 
 # -------------------------
-# Errors routes
+# Users and server-side sessions
 # -------------------------
-@app.route("/errors")
-@login_required
-def errors():
-    if session.get("role") != "student":
-        return redirect(url_for("dashboard_teacher"))
-    user_id = session["user_id"]
-    db = get_db()
-    rows = db.execute("SELECT id, date, piece, error_text FROM errors WHERE user_id=? ORDER BY date DESC", (user_id,)).fetchall()
-    return render_template("errors.html", title="Errors", active="errors", errors=rows)
+# The session cookie carries only a random id; the data lives in the
+# sessions table, with a per-process copy so most requests read neither.
+# Only what views set themselves is stored (user_id, flashes):
+# username, role and name are filled in from the user cache when a session
+# is opened, so a rename or role change reaches sessions already logged in.
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 7 * 86400))    # idle seconds before a session expires
+SESSION_TOUCH_SECONDS = 3600        # push expires_at forward at most this often
+SESSION_RECHECK_SECONDS = 5         # re-read a cached session after this (logouts in other workers)
+SESSION_PURGE_SECONDS = 600         # delete expired rows at most this often (per process)
+SESSION_CACHE_SIZE = 50_000
+USER_CACHE_SIZE = 20_000
+USER_CACHE_SECONDS = 30             # edits made by other processes show up within this
+USER_FIELDS = ("username", "role", "name")
 
+user_cache = LRUCache(USER_CACHE_SIZE)      # id -> (user dict, loaded at)
 
-@app.route("/add_error", methods=["POST"])
-@login_required
-def add_error():
-    if session.get("role") != "student":
-        return "forbidden", 403
-    user_id = session["user_id"]
-    piece = request.form.get("piece") or ""
-    error_text = request.form.get("error_text") or ""
-    date_str = date.today().isoformat()
-    db = get_db()
-    db.execute("INSERT INTO errors (user_id, date, piece, error_text) VALUES (?,?,?,?)",
-               (user_id, date_str, piece, error_text))
-    db.commit()
-    return redirect(url_for("errors"))
 
+def cache_user(row):
+    if row is None:
+        return None
+    user = dict(row)
+    user_cache.set(user["id"], (user, time.monotonic()))
+    return user
 
-# -------------------------
-# Notes routes
-# -------------------------
-@app.route("/notes")
-@login_required
-def notes():
-    if session.get("role") != "student":
-        return redirect(url_for("dashboard_teacher"))
-    user_id = session["user_id"]
+
+def get_user_by_username(username):
+    """Always read from the database (a login must see the current password)."""
     db = get_db()
-    rows = db.execute("SELECT id, date, note_text FROM special_notes WHERE user_id=? ORDER BY date DESC", (user_id,)).fetchall()
-    return render_template("notes.html", title="Notes", active="notes", notes=rows)
+    return cache_user(db.execute("SELECT id, username, password, name, role FROM users WHERE username = ?",
+                                 (username,)).fetchone())
 
 
-@app.route("/add_note", methods=["POST"])
-@login_required
-def add_note():
-    if session.get("role") != "student":
-        return "forbidden", 403
-    user_id = session["user_id"]
-    note_text = request.form.get("note_text") or ""
-    date_str = date.today().isoformat()
-    db = get_db()
-    db.execute("INSERT INTO special_notes (user_id, date, note_text) VALUES (?,?,?)",
-               (user_id, date_str, note_text))
-    db.commit()
-    return redirect(url_for("notes"))
+def get_user_by_id(uid, fresh=False):
+    hit = None if fresh else user_cache.get(uid)
+    if hit and time.monotonic() - hit[1] < USER_CACHE_SECONDS:
+        return hit[0]
+    try:
+        # with a cached copy to fall back on, don't queue for a connection
+        db = get_db(timeout=0 if hit else None)
+    except PoolTimeout:
+        if hit is None:
+            raise
+        return hit[0]       # the pool is exhausted: a slightly stale user beats a 503
+    user = cache_user(db.execute("SELECT id, username, password, name, role FROM users WHERE id = ?", (uid,)).fetchone())
+    if user is None:
+        user_cache.pop(uid)
+    return user
 
 
-# -------------------------
-# Music Library routes
-# -------------------------
-@app.route("/music-library")
-@login_required
-def music_library():
-    db = get_db()
-    # public teacher files
-    public = db.execute("SELECT pf.*, u.name as teacher_name FROM public_files pf LEFT JOIN users u ON u.id=pf.teacher_id ORDER BY pf.timestamp DESC").fetchall()
-    # private files for this user
-    user_id = session["user_id"]
-    private = db.execute("SELECT * FROM private_files WHERE user_id=? ORDER BY timestamp DESC", (user_id,)).fetchall()
-    return render_template("music_library.html", title="Music Library", active="library", public=public, private=private)
+def invalidate_user(uid):
+    """Call after changing a users row (this process sees it at once, others within USER_CACHE_SECONDS)."""
+    user_cache.pop(uid)
 
 
-@app.route("/upload_public", methods=["POST"])
-@login_required
-def upload_public():
-    # only teachers can upload public files
-    if session.get("role") != "teacher":
-        return "forbidden", 403
+def current_user():
+    """The logged-in user's record from the user cache, or None."""
+    uid = session.get("user_id")
+    return get_user_by_id(uid) if uid is not None else None
 
-    if "file" not in request.files:
-        flash("No file")
-        return redirect(url_for("music_library"))
 
-    f = request.files["file"]
-    desc = request.form.get("description", "")
-    if f and allowed_file(f.filename):
-        filename = secure_filename(f.filename)
-        timestamp = datetime.now().isoformat()
-        save_name = f"{session['username']}_{int(datetime.now().timestamp())}_{filename}"
-        save_path = os.path.join(UPLOAD_PUBLIC, save_name)
-        f.save(save_path)
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=0.0):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.replaced = None
+        self.error = None       # set when the session couldn't be read; raised in the request
+
+    def rotate(self):
+        """Give the session a new id (at login, so a planted id is worthless)."""
+        if self.sid:
+            self.replaced = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class SqliteSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self):
+        self.cache = LRUCache(SESSION_CACHE_SIZE)   # id -> (data, expires_at, read at)
+        self.last_purge = 0.0
+
+    def load(self, sid):
+        hit = self.cache.get(sid)
+        if hit is None or time.monotonic() - hit[2] > SESSION_RECHECK_SECONDS:
+            try:
+                # with a cached row to fall back on, don't queue for a connection
+                db = get_db(timeout=0 if hit else None)
+            except PoolTimeout:
+                if hit is None:
+                    raise
+                # the pool is exhausted: serve the cached row and recheck next time
+                return hit if hit[1] > time.time() else None
+            row = db.execute("SELECT data, expires_at FROM sessions WHERE id=?", (sid,)).fetchone()
+            if row is None:
+                self.cache.pop(sid)
+                return None
+            hit = (row["data"], row["expires_at"], time.monotonic())
+            self.cache.set(sid, hit)
+        return hit if hit[1] > time.time() else None
+
+    def open_session(self, app, request):
+        # errors raised here bypass the app's error handlers, so a pool
+        # timeout is parked on an empty session and raised by check_session
+        sid = request.cookies.get(self.get_cookie_name(app))
+        try:
+            hit = self.load(sid) if sid else None
+            if hit is None:
+                return ServerSession()
+            s = ServerSession(self.serializer.loads(hit[0]), sid, hit[1])
+            user = get_user_by_id(s["user_id"]) if "user_id" in s else None
+        except PoolTimeout as e:
+            s = ServerSession()
+            s.error = e
+            return s
+        if "user_id" in s:
+            if user is None:
+                s.clear()       # account removed: end the session
+            else:
+                dict.update(s, {k: user[k] for k in USER_FIELDS})
+        return s
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        now = time.time()
+        if session is None or session.error:
+            return
+        if not session.modified and (not session or session.expires_at - now > SESSION_TTL - SESSION_TOUCH_SECONDS):
+            return
+        if not session and not session.sid and not session.replaced:
+            return
+
+        db = get_db()
+        # anything the view left uncommitted would be rolled back at checkin anyway
+        if db.in_transaction:
+            db.rollback()
+        for sid in (session.replaced, session.sid if not session else None):
+            if sid:
+                db.execute("DELETE FROM sessions WHERE id=?", (sid,))
+                self.cache.pop(sid)
+        if session:
+            new = session.sid is None
+            if new:
+                session.sid = secrets.token_urlsafe(32)
+            data = self.serializer.dumps({k: v for k, v in session.items() if k not in USER_FIELDS})
+            expires_at = now + SESSION_TTL
+            db.execute("""
+                INSERT INTO sessions (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET user_id=excluded.user_id, data=excluded.data, expires_at=excluded.expires_at
+            """, (session.sid, session.get("user_id"), data, expires_at))
+            self.cache.set(session.sid, (data, expires_at, time.monotonic()))
+        if now - self.last_purge > SESSION_PURGE_SECONDS:
+            self.last_purge = now
+            db.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+        db.commit()
+
+        if not session:
+            if session.sid:
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite,
+                                       httponly=httponly)
+        elif new:
+            # no expiry on the cookie itself (ends with the browser, as before); the row expires server-side
+            response.set_cookie(name, session.sid, domain=domain, path=path, secure=secure, samesite=samesite,
+                                httponly=httponly)
+
+
+app.session_interface = SqliteSessionInterface()
+
+
+@app.before_request
+def check_session():
+    if session.error:
+        raise session.error
+
+
+def end_other_sessions(db, user_id, keep=None):
+    """Log a user out everywhere else (after a password change). The caller commits."""
+    sids = [r["id"] for r in db.execute("SELECT id FROM sessions WHERE user_id=? AND id IS NOT ?", (user_id, keep))]
+    db.executemany("DELETE FROM sessions WHERE id=?", [(sid,) for sid in sids])
+    for sid in sids:
+        app.session_interface.cache.pop(sid)
+
+
+# -------------------------
+# Keyset pagination
+# -------------------------
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(sort_value, row_id):
+    raw = json.dumps([sort_value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (sort_value, id) from an opaque cursor, or None if absent/invalid."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        row_id = int(row_id)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    # only values SQLite can bind as a sort key (a tampered cursor gets the first page)
+    if isinstance(sort_value, bool) or not isinstance(sort_value, (str, int, float)):
+        return None
+    if any(isinstance(v, int) and not -2 ** 63 <= v < 2 ** 63 for v in (sort_value, row_id)):
+        return None
+    return sort_value, row_id
+
+
+def page_args():
+    """(cursor, limit) from the query string, with limit clamped."""
+    limit = request.args.get("limit", PAGE_SIZE, type=int) or PAGE_SIZE
+    return request.args.get("cursor"), max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_page(db, select, where, params, sort_col, id_col, cursor, limit):
+    """Fetch one page ordered by (sort_col DESC, id_col DESC).
+
+    Seeks past the cursor with a row-value comparison, so each page is an
+    index range scan of `limit` rows no matter how deep the caller is.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    clauses = list(where)
+    params = list(params)
+    after = decode_cursor(cursor)
+    if after:
+        clauses.append(f"({sort_col}, {id_col}) < (?, ?)")
+        params.extend(after)
+    sql = select
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += f" ORDER BY {sort_col} DESC, {id_col} DESC LIMIT ?"
+    rows = db.execute(sql, params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last[sort_col.split(".")[-1]], last[id_col.split(".")[-1]])
+    return rows, next_cursor
+
+
+def page_errors(db, user_id, cursor=None, limit=PAGE_SIZE):
+    return keyset_page(db, "SELECT id, date, piece, error_text FROM errors",
+                       ["user_id=?"], [user_id], "date", "id", cursor, limit)
+
+
+def page_notes(db, user_id, cursor=None, limit=PAGE_SIZE):
+    return keyset_page(db, "SELECT id, date, note_text FROM special_notes",
+                       ["user_id=?"], [user_id], "date", "id", cursor, limit)
+
+
+def page_notifications(db, teacher_id=None, cursor=None, limit=PAGE_SIZE):
+    """Notifications by one teacher, or by every teacher when teacher_id is None."""
+    where, params = (["n.teacher_id=?"], [teacher_id]) if teacher_id is not None else ([], [])
+    return keyset_page(db, "SELECT n.*, u.name as teacher_name FROM notifications n LEFT JOIN users u ON u.id=n.teacher_id",
+                       where, params, "n.timestamp", "n.id", cursor, limit)
+
+
+def page_public_files(db, cursor=None, limit=PAGE_SIZE):
+    return keyset_page(db, "SELECT pf.*, u.name as teacher_name FROM public_files pf LEFT JOIN users u ON u.id=pf.teacher_id",
+                       [], [], "pf.timestamp", "pf.id", cursor, limit)
+
+
+def page_private_files(db, user_id, cursor=None, limit=PAGE_SIZE):
+    return keyset_page(db, "SELECT * FROM private_files",
+                       ["user_id=?"], [user_id], "timestamp", "id", cursor, limit)
+
+
+def page_json(rows, next_cursor):
+    return jsonify({"items": [dict(r) for r in rows], "next_cursor": next_cursor})
+
+
+# -------------------------
+# Notification feed cache (shared by every student) and unread counts
+# -------------------------
+FEED_CACHE_PAGES = 256
+_feed_lock = threading.Lock()
+_feed_cache = {"version": None, "pages": {}, "ids": None}
+
+
+def get_feed_version(db):
+    row = db.execute("SELECT version FROM feed_state WHERE name='notifications'").fetchone()
+    return row["version"] if row else 0
+
+
+def bump_feed_version(db):
+    """Call from every write to notifications, inside the same transaction."""
+    db.execute("UPDATE feed_state SET version=version+1 WHERE name='notifications'")
+
+
+def _feed_entry(db):
+    """Return the cache dict for the current feed version, resetting if stale.
+
+    The version lives in SQLite so every worker process sees a bump made
+    by any other one; the cached pages themselves are per process.
+    """
+    version = get_feed_version(db)
+    with _feed_lock:
+        if _feed_cache["version"] != version:
+            _feed_cache["version"] = version
+            _feed_cache["pages"] = {}
+            _feed_cache["ids"] = None
+        return _feed_cache
+
+
+def cached_student_feed(db, cursor=None, limit=PAGE_SIZE):
+    """The all-teachers notification feed students see, served from cache."""
+    entry = _feed_entry(db)
+    key = (cursor or "", limit)
+    page = entry["pages"].get(key)
+    if page is None:
+        rows, next_cursor = page_notifications(db, None, cursor, limit)
+        page = ([dict(r) for r in rows], next_cursor)
+        with _feed_lock:
+            if len(entry["pages"]) >= FEED_CACHE_PAGES:
+                entry["pages"].clear()
+            entry["pages"][key] = page
+    return page
+
+
+def live_notification_ids(db):
+    """Sorted ids of every notification, cached alongside the feed."""
+    entry = _feed_entry(db)
+    ids = entry["ids"]
+    if ids is None:
+        ids = [r["id"] for r in db.execute("SELECT id FROM notifications ORDER BY id")]
+        with _feed_lock:
+            entry["ids"] = ids
+    return ids
+
+
+def unread_count(db, user_id):
+    """Notifications newer than the student's read cursor (no COUNT query)."""
+    row = db.execute("SELECT last_seen_id FROM notification_reads WHERE user_id=?", (user_id,)).fetchone()
+    ids = live_notification_ids(db)
+    return len(ids) - bisect.bisect_right(ids, row["last_seen_id"] if row else 0)
+
+
+def mark_notifications_read(db, user_id):
+    ids = live_notification_ids(db)
+    row = db.execute("SELECT last_seen_id FROM notification_reads WHERE user_id=?", (user_id,)).fetchone()
+    if not ids or (row and row["last_seen_id"] >= ids[-1]):
+        return
+    bump_data_versions(db, f"reads:{user_id}")
+    db.execute("""
+        INSERT INTO notification_reads (user_id, last_seen_id) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET last_seen_id=MAX(last_seen_id, excluded.last_seen_id)
+    """, (user_id, ids[-1]))
+    db.commit()
+
+
+# -------------------------
+# Instrumentation (route latency, SQL timing, sampling profiler)
+# -------------------------
+# With METRICS on (the default), pooled connections time every statement
+# they run. Each request records its latency in a per-route histogram,
+# together with its statement count and SQL time. Statements slower than
+# SLOW_QUERY_MS go to a slow-query log along with their EXPLAIN QUERY PLAN.
+# A sampling profiler can be switched on at runtime. Everything is
+# exposed in Prometheus text format on /metrics and on the /debug page.
+# Figures are per process.
+METRICS = os.environ.get("METRICS", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")     # bearer token for scrapers
+# let unauthenticated loopback clients scrape /metrics. Only safe without a
+# reverse proxy in front, which would make every request look local.
+METRICS_LOOPBACK = os.environ.get("METRICS_LOOPBACK", "0") == "1"
+DEBUG_ADMINS = {u for u in os.environ.get("DEBUG_ADMINS", "").split(",") if u}  # empty: every teacher
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_LOG_SIZE = 100
+SQL_STATS_MAX = 500             # distinct statements tracked; the rest count as "other"
+METRICS_FOLD_EVERY = 1000       # requests queued before they are folded into the totals
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = 0.005        # seconds between profiler samples
+PROFILE_MAX_STACKS = 5000
+PROFILE_DEPTH = 48
+
+
+@lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """One line, with variable-length placeholder lists folded: 'IN (?, ...)'."""
+    return re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", " ".join(sql.split()))
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.connection.timed(sql, params, started)
+
+    def executemany(self, sql, seq):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self.connection.timed(sql, None, started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection that times each statement run through it.
+
+    Totals accumulate on the connection and are folded into the process
+    metrics when the request ends, so the hot path takes no lock. Time is
+    that of the execute call, which includes the first step of a query but
+    not rows fetched afterwards.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_timing()
+
+    recorder = None     # a list to append (sql, params) to; see walk_routes()
+
+    def reset_timing(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.sql_stats = {}
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.timed(sql, params, started)
+
+    def executemany(self, sql, seq):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self.timed(sql, None, started)
+
+    def timed(self, sql, params, started):
+        elapsed = time.perf_counter() - started
+        self.statements += 1
+        self.sql_seconds += elapsed
+        if self.recorder is not None:
+            self.recorder.append((sql, params))
+        st = self.sql_stats.get(sql)
+        if st is None:
+            self.sql_stats[sql] = [1, elapsed, elapsed]
+        else:
+            st[0] += 1
+            st[1] += elapsed
+            if elapsed > st[2]:
+                st[2] = elapsed
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            get_metrics().record_slow(self, sql, params, elapsed)
+
+
+class Metrics:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.routes = {}        # (endpoint, method) -> {"buckets", "count", "sum", "sql", "sql_seconds"}
+        self.responses = {}     # (endpoint, method, status) -> count
+        self.statements = {}    # normalized sql -> [count, seconds, max seconds]
+        self.slow = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self.slow_total = 0
+        self._pending = []
+
+    def observe_request(self, endpoint, method, status, seconds, conn):
+        """Queue one request's figures; they are folded in when next read.
+
+        list.append needs no lock, which keeps this off the request's
+        critical path. The connection's stats are copied: the request can
+        still run statements after after_request (save_session does), and
+        fold() may be iterating the hand-off from another thread.
+        """
+        if conn is None:
+            self._pending.append((endpoint, method, status, seconds, 0, 0.0, None))
+        else:
+            stats = {sql: tuple(st) for sql, st in conn.sql_stats.items()}
+            self._pending.append((endpoint, method, status, seconds, conn.statements, conn.sql_seconds, stats))
+        if len(self._pending) >= METRICS_FOLD_EVERY:
+            self.fold()
+
+    def fold(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            for endpoint, method, status, seconds, statements, sql_seconds, sql_stats in pending:
+                route = self.routes.get((endpoint, method))
+                if route is None:
+                    route = self.routes[(endpoint, method)] = {
+                        "buckets": [0] * (len(LATENCY_BUCKETS) + 1), "count": 0, "sum": 0.0, "sql": 0, "sql_seconds": 0.0,
+                    }
+                route["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+                route["count"] += 1
+                route["sum"] += seconds
+                route["sql"] += statements
+                route["sql_seconds"] += sql_seconds
+                key = (endpoint, method, status)
+                self.responses[key] = self.responses.get(key, 0) + 1
+                for sql, (count, total, worst) in (sql_stats or {}).items():
+                    sql = normalize_sql(sql)
+                    st = self.statements.get(sql)
+                    if st is None:
+                        if len(self.statements) >= SQL_STATS_MAX:
+                            sql = "other"
+                        st = self.statements.setdefault(sql, [0, 0.0, 0.0])
+                    st[0] += count
+                    st[1] += total
+                    st[2] = max(st[2], worst)
+
+    def record_slow(self, conn, sql, params, elapsed):
+        if params is None or not isinstance(params, (tuple, list, dict)):
+            plan = None     # executemany: the rows are already consumed
+        else:
+            try:
+                plan = [r[-1] for r in sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params)]
+            except sqlite3.Error:
+                plan = None
+        entry = {
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "endpoint": request.endpoint if has_request_context() else threading.current_thread().name,
+            "ms": round(elapsed * 1000, 2),
+            "sql": normalize_sql(sql),
+            "plan": plan,
+        }
+        with self._lock:
+            self.slow.appendleft(entry)
+            self.slow_total += 1
+
+    def route_rows(self):
+        """Per-route summary for the debug page, slowest total first."""
+        self.fold()
+        with self._lock:
+            routes = {k: dict(v, buckets=list(v["buckets"])) for k, v in self.routes.items()}
+        rows = []
+        for (endpoint, method), r in routes.items():
+            rows.append({
+                "endpoint": endpoint, "method": method, "count": r["count"],
+                "mean_ms": r["sum"] / r["count"] * 1000,
+                "p50": histogram_quantile(r["buckets"], r["count"], 0.5),
+                "p95": histogram_quantile(r["buckets"], r["count"], 0.95),
+                "sql": r["sql"] / r["count"], "sql_ms": r["sql_seconds"] / r["count"] * 1000,
+                "total_s": r["sum"],
+            })
+        return sorted(rows, key=lambda r: r["total_s"], reverse=True)
+
+    def statement_rows(self, limit=50):
+        self.fold()
+        with self._lock:
+            items = [(sql, list(st)) for sql, st in self.statements.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [{"sql": sql, "count": c, "total_ms": t * 1000, "mean_ms": t / c * 1000, "max_ms": m * 1000}
+                for sql, (c, t, m) in items[:limit]]
+
+    def prometheus(self):
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{prom_escape(v)}"' for k, v in labels.items())
+                out.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        self.fold()
+        with self._lock:
+            routes = {k: dict(v, buckets=list(v["buckets"])) for k, v in self.routes.items()}
+            responses = dict(self.responses)
+            statements = {sql: list(st) for sql, st in self.statements.items()}
+            slow_total = self.slow_total
+        histogram = []
+        for (endpoint, method), r in sorted(routes.items()):
+            labels = {"endpoint": endpoint, "method": method}
+            running = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), r["buckets"]):
+                running += n
+                histogram.append((dict(labels, le=str(bound)), running))
+        out.append("# HELP http_request_duration_seconds Time to produce a response, by route.")
+        out.append("# TYPE http_request_duration_seconds histogram")
+        for labels, value in histogram:
+            label_text = ",".join(f'{k}="{prom_escape(v)}"' for k, v in labels.items())
+            out.append(f"http_request_duration_seconds_bucket{{{label_text}}} {value}")
+        for (endpoint, method), r in sorted(routes.items()):
+            label_text = f'endpoint="{prom_escape(endpoint)}",method="{method}"'
+            out.append(f"http_request_duration_seconds_sum{{{label_text}}} {r['sum']}")
+            out.append(f"http_request_duration_seconds_count{{{label_text}}} {r['count']}")
+        metric("http_responses_total", "counter", "Responses by route and status.",
+               [({"endpoint": e, "method": m, "status": s}, n) for (e, m, s), n in sorted(responses.items())])
+        metric("http_request_sql_statements_total", "counter", "SQL statements run by requests to each route.",
+               [({"endpoint": e, "method": m}, r["sql"]) for (e, m), r in sorted(routes.items())])
+        metric("http_request_sql_seconds_total", "counter", "Time spent in SQL by requests to each route.",
+               [({"endpoint": e, "method": m}, r["sql_seconds"]) for (e, m), r in sorted(routes.items())])
+        metric("sql_statement_executions_total", "counter", "Executions of each distinct statement.",
+               [({"statement": statement_label(sql)}, st[0]) for sql, st in statements.items()])
+        metric("sql_statement_seconds_total", "counter", "Time spent in each distinct statement.",
+               [({"statement": statement_label(sql)}, st[1]) for sql, st in statements.items()])
+        metric("sql_slow_queries_total", "counter", f"Statements slower than {SLOW_QUERY_MS:g} ms.", [({}, slow_total)])
+        pool = get_pool().stats()
+        metric("db_pool_connections", "gauge", "Pooled SQLite connections by state.",
+               [({"state": "in_use"}, pool["in_use"]), ({"state": "idle"}, pool["idle"])])
+        metric("db_pool_waits_total", "counter", "Checkouts that had to wait for a connection.", [({}, pool["waits"])])
+        metric("db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.",
+               [({}, pool["wait_time_ms"] / 1000)])
+        metric("db_pool_timeouts_total", "counter", "Checkouts that gave up waiting for a connection.", [({}, pool["timeouts"])])
+        if WRITE_BEHIND:
+            wq = get_write_log().stats()
+            metric("write_queue_depth", "gauge", "Write-behind records waiting to be applied.", [({}, wq["depth"])])
+            metric("write_queue_applied_total", "counter", "Write-behind records applied.", [({}, wq["applied"])])
+            metric("write_queue_batches_total", "counter", "Write-behind commits.", [({}, wq["batches"])])
+        hasher = get_password_hasher().stats()
+        metric("password_hashes_total", "counter", "Password hashes and checks run.", [({}, hasher["hashes"])])
+        metric("password_hash_seconds_total", "counter", "Time spent hashing passwords.", [({}, hasher["seconds"])])
+        metric("password_refused_total", "counter", "Logins refused because the hashing pool was full.",
+               [({}, hasher["refused"])])
+        metric("login_rate_limited_total", "counter", "Login attempts over the per-username limit.",
+               [({}, login_limiter.limited)])
+        metric("profiler_samples_total", "counter", "Sampling profiler samples taken.",
+               [({}, get_profiler().samples)])
+        metric("process_uptime_seconds", "gauge", "Seconds since this process loaded the app.",
+               [({}, round(time.time() - self.started, 3))])
+        return "\n".join(out) + "\n"
+
+
+def prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def statement_label(sql):
+    """Short, stable label for a statement: its opening words plus a hash."""
+    return f"{sql[:60]} #{hashlib.sha1(sql.encode()).hexdigest()[:8]}"
+
+
+def histogram_quantile(buckets, count, q):
+    """Upper bound (ms) of the bucket holding the q-quantile; None past the last bound."""
+    running = 0
+    for bound, n in zip(LATENCY_BUCKETS, buckets):
+        running += n
+        if running >= q * count:
+            return bound * 1000
+    return None
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads serving requests every PROFILE_INTERVAL.
+
+    Stacks are counted in collapsed form (root;...;leaf), ready for
+    flamegraph.pl or speedscope.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.active = set()     # thread ids currently inside a request
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.since = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+            self.since = datetime.now().isoformat(timespec="seconds")
+            threading.Thread(target=self.run, name="profiler", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def reset(self):
+        with self._lock:
+            self.stacks = {}
+            self.samples = 0
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            time.sleep(PROFILE_INTERVAL)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident in list(self.active):
+                    frame = frames.get(ident)
+                    if frame is None or ident == own:
+                        continue
+                    names = []
+                    while frame is not None and len(names) < PROFILE_DEPTH:
+                        code = frame.f_code
+                        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    stack = ";".join(reversed(names))
+                    if stack in self.stacks or len(self.stacks) < PROFILE_MAX_STACKS:
+                        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.samples += 1
+
+    def collapsed(self, limit=None):
+        with self._lock:
+            items = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return items[:limit] if limit else items
+
+
+_metrics = None
+_profiler = None
+_instrument_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        with _instrument_lock:
+            if _metrics is None or _metrics.pid != os.getpid():
+                _metrics = Metrics()
+    return _metrics
+
+
+def get_profiler():
+    global _profiler
+    if _profiler is None or _profiler.pid != os.getpid():
+        with _instrument_lock:
+            if _profiler is None or _profiler.pid != os.getpid():
+                _profiler = SamplingProfiler()
+    return _profiler
+
+
+@app.before_request
+def start_request_timer():
+    if METRICS:
+        g.request_started = time.perf_counter()
+    profiler = get_profiler()
+    if profiler.running:
+        profiler.active.add(threading.get_ident())
+
+
+@app.after_request
+def record_request_metrics(response):
+    ctx = g._get_current_object()
+    started = ctx.pop("request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    db = ctx.get("db")
+    conn = db if isinstance(db, TimedConnection) else None
+    if conn is None:
+        response.headers["Server-Timing"] = f"app;dur={elapsed * 1000:.1f}"
+    else:
+        response.headers["Server-Timing"] = (f"app;dur={elapsed * 1000:.1f}, "
+                                             f'sql;dur={conn.sql_seconds * 1000:.1f};desc="{conn.statements} statements"')
+    get_metrics().observe_request(request.endpoint or "unmatched", request.method, response.status_code, elapsed, conn)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    get_profiler().active.discard(threading.get_ident())
+    started = g.pop("request_started", None)
+    if started is not None:
+        # after_request never ran: the view raised
+        db = g.get("db")
+        get_metrics().observe_request(request.endpoint or "unmatched", request.method, 500,
+                                      time.perf_counter() - started,
+                                      db if isinstance(db, TimedConnection) else None)
+
+
+def debug_allowed():
+    if session.get("role") != "teacher":
+        return False
+    return not DEBUG_ADMINS or session.get("username") in DEBUG_ADMINS
+
+
+@app.route("/metrics")
+def metrics():
+    auth = request.headers.get("Authorization", "")
+    token_ok = bool(METRICS_TOKEN) and secrets.compare_digest(auth, f"Bearer {METRICS_TOKEN}")
+    loopback_ok = METRICS_LOOPBACK and request.remote_addr in ("127.0.0.1", "::1")
+    if not (token_ok or debug_allowed() or loopback_ok):
+        return "forbidden", 403
+    return app.response_class(get_metrics().prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug")
+@login_required
+def debug_page():
+    if not debug_allowed():
+        return "forbidden", 403
+    m = get_metrics()
+    with m._lock:
+        slow = list(m.slow)
+    profiler = get_profiler()
+    return render_template("debug.html", title="Debug", metrics_enabled=METRICS,
+                           routes=m.route_rows(), statements=m.statement_rows(), slow=slow,
+                           slow_ms=SLOW_QUERY_MS, profiler=profiler, stacks=profiler.collapsed(40))
+
+
+@app.route("/debug/profile", methods=["GET", "POST"])
+@login_required
+def debug_profile():
+    """GET: collapsed stacks as text. POST action=start|stop|reset."""
+    if not debug_allowed():
+        return "forbidden", 403
+    profiler = get_profiler()
+    if request.method == "GET":
+        body = "".join(f"{stack} {n}\n" for stack, n in profiler.collapsed())
+        return app.response_class(body, mimetype="text/plain")
+    action = request.form.get("action") or (request.get_json(silent=True) or {}).get("action")
+    if action == "start":
+        profiler.start()
+    elif action == "stop":
+        profiler.stop()
+    elif action == "reset":
+        profiler.reset()
+    else:
+        return jsonify({"error": "action must be start, stop or reset"}), 400
+    if request.is_json:
+        return jsonify({"running": profiler.running, "samples": profiler.samples})
+    return redirect(url_for("debug_page"))
+
+
+# -------------------------
+# Response cache (rendered pages and JSON, keyed on data versions)
+# -------------------------
+# Views wrap their rendering in cached_response(scopes, build). Each scope
+# names a slice of data ("practice:<uid>", "library:public", ...) whose
+# version lives in feed_state and is bumped by the writes that change it, in
+# the same transaction. The key is (user, endpoint, query string, day,
+# scope versions), so a write only invalidates the responses that read what
+# it changed; superseded entries are never looked up again and LRU / TTL
+# just reclaim them. The key doubles as a weak ETag, so a revalidation costs
+# one version query and no rendering.
+#
+# RESPONSE_CACHE picks the backend: "memory" (per process, the default),
+# "shared" (an SQLite file on /dev/shm shared by every worker on the host),
+# "redis" (REDIS_URL, any Redis-compatible server; needs the redis package)
+# or "off".
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "memory")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2048"))   # entries
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "600"))      # seconds
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "practice-response-cache.db")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+
+def data_versions(db, names):
+    """Current version of each data scope (0 if never written)."""
+    rows = db.execute(f"SELECT name, version FROM feed_state WHERE name IN ({','.join('?' * len(names))})", names)
+    found = {r["name"]: r["version"] for r in rows}
+    return [found.get(n, 0) for n in names]
+
+
+def bump_data_versions(db, *names):
+    """Invalidate cached responses that read these scopes. The caller commits."""
+    db.executemany("""
+        INSERT INTO feed_state (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version=version + 1
+    """, [(n,) for n in names])
+
+
+def layout_scopes():
+    """Data versions behind layout.html itself (the student's unread badge)."""
+    if session.get("role") == "student":
+        return ["notifications", f"reads:{session['user_id']}"]
+    return []
+
+
+class MemoryCacheBackend:
+    """Per-process LRU with a deadline on every entry."""
+
+    def __init__(self, maxsize):
+        self._lru = LRUCache(maxsize)
+
+    def get(self, key):
+        hit = self._lru.get(key)
+        if hit is None or hit[0] < time.time():
+            return None
+        return hit[1]
+
+    def set(self, key, value, ttl):
+        self._lru.set(key, (time.time() + ttl, value))
+
+    def clear(self):
+        self._lru.clear()
+
+
+class SharedCacheBackend:
+    """Cross-process cache in an SQLite file (on tmpfs), evicting by last use."""
+
+    TRIM_EVERY = 64     # sets between eviction passes, per process
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._sets = 0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_used ON cache(used)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self._conn().execute("UPDATE cache SET used=? WHERE key=? AND expires>? RETURNING value",
+                                   (now, key, now)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                     (key, value, now + ttl, now))
+        self._sets += 1
+        if self._sets % self.TRIM_EVERY == 0:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                         (self.maxsize,))
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache")
+
+
+class RedisCacheBackend:
+    """Redis or a compatible server; configure it with maxmemory-policy
+    allkeys-lru for LRU eviction, entries expire through SETEX."""
+
+    PREFIX = "rc:"
+
+    def __init__(self, url):
+        import redis    # optional dependency, only needed for this backend
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(self.PREFIX + key)
+
+    def set(self, key, value, ttl):
+        self._client.setex(self.PREFIX + key, ttl, value)
+
+    def clear(self):
+        for key in self._client.scan_iter(self.PREFIX + "*"):
+            self._client.delete(key)
+
+
+_response_cache = {"pid": None, "backend": None}
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The configured backend for this process, or None when caching is off."""
+    with _response_cache_lock:
+        if _response_cache["pid"] != os.getpid():
+            if RESPONSE_CACHE == "shared":
+                backend = SharedCacheBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE)
+            elif RESPONSE_CACHE == "redis":
+                backend = RedisCacheBackend(REDIS_URL)
+            elif RESPONSE_CACHE == "memory":
+                backend = MemoryCacheBackend(RESPONSE_CACHE_SIZE)
+            else:
+                backend = None
+            _response_cache.update(pid=os.getpid(), backend=backend)
+        return _response_cache["backend"]
+
+
+def cached_response(scopes, build, ttl=RESPONSE_CACHE_TTL):
+    """Serve build() through the response cache with a weak ETag.
+
+    `scopes` lists every data version the response depends on (pages add
+    layout_scopes()); build() returns anything a view may return. Only 200 responses are stored, and
+    requests with pending flash messages always render.
+    """
+    if session.get("_flashes"):
+        return build()
+    db = get_db()
+    parts = [session.get("user_id"), request.endpoint, request.query_string.decode(), date.today().isoformat()]
+    scopes = ["cache_epoch"] + list(scopes)
+    parts += [f"{name}={version}" for name, version in zip(scopes, data_versions(db, scopes))]
+    key = hashlib.sha256("\x1f".join(map(str, parts)).encode()).hexdigest()[:32]
+
+    if request.if_none_match.contains_weak(key):
+        response = app.response_class(status=304)
+    else:
+        backend = get_response_cache()
+        hit = None
+        if backend is not None:
+            try:
+                hit = backend.get(key)
+            except Exception:
+                app.logger.exception("response cache read failed")
+        if hit is not None:
+            content_type, _, body = bytes(hit).partition(b"\n")
+            response = app.response_class(body, content_type=content_type.decode())
+        else:
+            response = app.make_response(build())
+            if response.status_code != 200 or response.direct_passthrough:
+                return response
+            if backend is not None:
+                try:
+                    backend.set(key, response.content_type.encode() + b"\n" + response.get_data(), ttl)
+                except Exception:
+                    app.logger.exception("response cache write failed")
+    response.set_etag(key, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# -------------------------
+# Push channel: in-process broker for Server-Sent Events
+# -------------------------
+# Run with an async-friendly worker (gunicorn -k gevent) so idle streams
+# don't each pin an OS thread. NOTIFY_BACKEND=sqlite fans events out
+# across worker processes through the shared database instead of Redis.
+NOTIFY_BACKEND = os.environ.get("NOTIFY_BACKEND", "local")
+NOTIFY_QUEUE_SIZE = 16          # events buffered per connection before dropping
+NOTIFY_HEARTBEAT = 15           # seconds between keep-alive comments
+NOTIFY_POLL_INTERVAL = 1.0      # sqlite backend: seconds between polls
+NOTIFY_EVENT_RETENTION = 1000   # sqlite backend: events kept for late pollers
+
+
+class LocalBackend:
+    """Delivers straight to this process's subscribers (single worker)."""
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+
+    def publish(self, event):
+        self.dispatch(event)
+
+
+class SQLiteBackend:
+    """Multi-worker stand-in for Redis pub/sub.
+
+    publish() appends to notification_events and trims it to the last
+    NOTIFY_EVENT_RETENTION rows, so the table stays bounded whether or not
+    any process is polling; one poller thread per process reads new rows
+    and dispatches them locally, so the database sees one poll per worker
+    rather than one per connected student.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_id = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+        self.conn = self._connect()
+        self.last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM notification_events").fetchone()[0]
+        threading.Thread(target=self._poll, name="notify-poller", daemon=True).start()
+
+    def publish(self, event):
+        conn = self._connect()
+        try:
+            cur = conn.execute("INSERT INTO notification_events (payload, created_at) VALUES (?, ?)",
+                               (json.dumps(event), datetime.now().isoformat()))
+            conn.execute("DELETE FROM notification_events WHERE id <= ?",
+                         (cur.lastrowid - NOTIFY_EVENT_RETENTION,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _poll(self):
+        while True:
+            time.sleep(NOTIFY_POLL_INTERVAL)
+            try:
+                rows = self.conn.execute(
+                    "SELECT id, payload FROM notification_events WHERE id > ? ORDER BY id",
+                    (self.last_id,)
+                ).fetchall()
+                for event_id, payload in rows:
+                    self.last_id = event_id
+                    self.dispatch(json.loads(payload))
+            except sqlite3.Error:
+                app.logger.exception("notification poller failed; retrying")
+
+
+class Broker:
+    """Fans each published event out to every subscribed connection.
+
+    Each subscriber gets a bounded queue; a slow client loses its oldest
+    buffered events rather than growing memory without limit.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pid = os.getpid()
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._started:
+                self.backend.start(self._dispatch)
+                self._started = True
+
+    def _dispatch(self, event):
+        with self._lock:
+            subs = list(self._subs)
+        for q in subs:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    q.put_nowait(event)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def subscribe(self):
+        self._ensure_started()
+        q = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        with self._lock:
+            self._subs.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs.discard(q)
+
+    def publish(self, event):
+        self._ensure_started()
+        self.backend.publish(event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subs)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None or _broker.pid != os.getpid():
+        with _broker_lock:
+            if _broker is None or _broker.pid != os.getpid():
+                backend = SQLiteBackend(DB_PATH) if NOTIFY_BACKEND == "sqlite" else LocalBackend()
+                _broker = Broker(backend)
+    return _broker
+
+
+def sse_stream(broker, q):
+    """Yield SSE frames for one subscriber until the client disconnects."""
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = q.get(timeout=NOTIFY_HEARTBEAT)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"id: {event.get('id', '')}\nevent: notification\ndata: {json.dumps(event)}\n\n"
+    finally:
+        broker.unsubscribe(q)
+
+
+# -------------------------
+# Rollups (per-user daily / monthly practice totals)
+# -------------------------
+def bump_rollups(db, user_id, date_key, hours=0.0, entries=0, notes=0):
+    """Apply a delta to the daily and monthly rollup rows for one day.
+
+    Callers pass the difference between the old and new state of the raw
+    tables; the caller's own commit makes the rollup change atomic with it.
+    """
+    bump_rollups_many(db, user_id, [(date_key, hours, entries, notes)])
+
+
+def bump_rollups_many(db, user_id, deltas):
+    """bump_rollups for a list of (date_key, hours, entries, notes) deltas."""
+    db.executemany("""
+        INSERT INTO practice_rollup_daily (user_id, date, hours, entries, notes_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, date) DO UPDATE SET
+            hours=hours + excluded.hours,
+            entries=entries + excluded.entries,
+            notes_count=notes_count + excluded.notes_count
+    """, [(user_id, d, h, e, n) for d, h, e, n in deltas])
+    db.executemany("""
+        INSERT INTO practice_rollup_monthly (user_id, month, hours, days_practiced, notes_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, month) DO UPDATE SET
+            hours=hours + excluded.hours,
+            days_practiced=days_practiced + excluded.days_practiced,
+            notes_count=notes_count + excluded.notes_count
+    """, [(user_id, d[:7], h, e, n) for d, h, e, n in deltas])
+
+
+def entry_has_notes(notes):
+    return 1 if notes else 0
+
+
+def bump_techniques_many(db, user_id, changes):
+    """Apply (date_key, technique, delta) changes to the monthly technique counts."""
+    rows = [(user_id, d[:7], technique_key(t), n) for d, t, n in changes if technique_key(t) and n]
+    if not rows:
+        return
+    db.executemany("""
+        INSERT INTO practice_technique_monthly (user_id, month, technique, entries)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, month, technique) DO UPDATE SET entries=entries + excluded.entries
+    """, rows)
+    db.executemany("DELETE FROM practice_technique_monthly WHERE user_id=? AND month=? AND technique=? AND entries <= 0",
+                   [r[:3] for r in rows if r[3] < 0])
+
+
+# Practice-day bitsets: bit i of practice_days.bits is set when the student
+# has an entry on day first_day + i (a date ordinal), packed little-endian.
+# A decade of history is under 500 bytes, so streaks and year heatmaps never
+# scan practice_entries.
+def load_practice_days(db, user_id):
+    """(first_day ordinal, bool array) for one student; (None, empty) if none."""
+    row = db.execute("SELECT first_day, bits FROM practice_days WHERE user_id=?", (user_id,)).fetchone()
+    if not row:
+        return None, np.zeros(0, dtype=bool)
+    bits = np.unpackbits(np.frombuffer(row["bits"], dtype=np.uint8), bitorder="little").astype(bool)
+    return row["first_day"], bits
+
+
+def mark_practice_days(db, user_id, changes):
+    """Apply (date_key, practiced) changes to a student's bitset. The caller commits."""
+    if not changes:
+        return
+    first, bits = load_practice_days(db, user_id)
+    days = [(date.fromisoformat(d).toordinal(), on) for d, on in changes]
+    if first is None:
+        first = days[0][0]
+    lo = min([first] + [d for d, _ in days])
+    hi = max([first + len(bits)] + [d + 1 for d, _ in days])
+    grown = np.zeros(hi - lo, dtype=bool)
+    grown[first - lo:first - lo + len(bits)] = bits
+    for d, on in days:
+        grown[d - lo] = on
+    # keep the first and last practiced days at the ends of the bitset
+    practiced = np.flatnonzero(grown)
+    if not practiced.size:
+        db.execute("DELETE FROM practice_days WHERE user_id=?", (user_id,))
+        return
+    grown = grown[practiced[0]:practiced[-1] + 1]
+    db.execute("""
+        INSERT INTO practice_days (user_id, first_day, bits) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET first_day=excluded.first_day, bits=excluded.bits
+    """, (user_id, lo + int(practiced[0]), np.packbits(grown, bitorder="little").tobytes()))
+
+
+def practice_streaks(first, bits, today=None):
+    """(longest, current) streak in days; current counts if it reaches today or yesterday."""
+    if first is None:
+        return 0, 0
+    edges = np.flatnonzero(np.diff(np.r_[0, bits.astype(np.int8), 0]))
+    starts, ends = edges[::2], edges[1::2]
+    longest = int((ends - starts).max())
+    last_day = first + int(ends[-1]) - 1
+    current = int(ends[-1] - starts[-1]) if last_day >= (today or date.today()).toordinal() - 1 else 0
+    return longest, current
+
+
+def rebuild_rollups(db, user_id=None):
+    """Recompute rollups from the raw tables (all users, or just one)."""
+    rebuild_rollup_tables(db, user_id)
+    rebuild_practice_days(db, user_id)
+    db.commit()
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute practice rollup tables from practice_entries / special_notes."""
+    rebuild_rollups(get_db())
+    print("Rollups rebuilt.")
+
+
+def ensure_rollups():
+    """Backfill rollups once for databases created before they existed."""
+    db = get_db()
+    if db.execute("SELECT 1 FROM practice_rollup_daily LIMIT 1").fetchone():
+        return
+    if db.execute("SELECT 1 FROM practice_entries LIMIT 1").fetchone() or \
+            db.execute("SELECT 1 FROM special_notes LIMIT 1").fetchone():
+        rebuild_rollups(db)
+
+
+# -------------------------
+# Credentials (hashed passwords, bounded verification pool, login rate limit)
+# -------------------------
+# PASSWORD_HASH_METHOD and hash_password() live in migrations.py, so
+# init_db.py and gen_data.py seed the same hashes.
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 2))
+PASSWORD_MAX_PENDING = int(os.environ.get("PASSWORD_MAX_PENDING", PASSWORD_WORKERS * 16))
+PASSWORD_WAIT = 10                  # seconds a login waits for its hash before giving up
+# per username and per process: LOGIN_BURST attempts, then one more every LOGIN_REFILL_SECONDS
+LOGIN_BURST = int(os.environ.get("LOGIN_BURST", 10))
+LOGIN_REFILL_SECONDS = float(os.environ.get("LOGIN_REFILL_SECONDS", 6))
+LOGIN_BUCKETS_MAX = 100_000
+
+
+class PasswordBusy(Exception):
+    """The hashing pool is full (or too slow); the login should be retried."""
+
+
+class PasswordHasher:
+    """Runs password hashing on a small, bounded thread pool.
+
+    scrypt releases the GIL, so up to `workers` hashes run in parallel
+    while request threads for other pages keep going. At most
+    `max_pending` hashes may be queued or running. A class-start login
+    storm past that gets a quick 503 rather than a queue of request
+    threads stuck waiting.
+    """
+
+    def __init__(self, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING):
+        self.pid = os.getpid()
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.hashes = 0
+        self.seconds = 0.0
+        self.refused = 0
+
+    def _timed(self, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.hashes += 1
+                self.seconds += elapsed
+
+    def run(self, fn, *args):
+        """fn(*args) on the pool; raises PasswordBusy when full or after PASSWORD_WAIT seconds."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.refused += 1
+            raise PasswordBusy()
+        future = self._executor.submit(self._timed, fn, args)
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(timeout=PASSWORD_WAIT)
+        except FutureTimeout:
+            with self._lock:
+                self.refused += 1
+            raise PasswordBusy() from None
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "max_pending": self.max_pending, "hashes": self.hashes,
+                    "seconds": round(self.seconds, 3), "refused": self.refused}
+
+
+_password_hasher = None
+_password_hasher_lock = threading.Lock()
+
+
+def get_password_hasher():
+    global _password_hasher
+    if _password_hasher is None or _password_hasher.pid != os.getpid():
+        with _password_hasher_lock:
+            if _password_hasher is None or _password_hasher.pid != os.getpid():
+                _password_hasher = PasswordHasher()
+    return _password_hasher
+
+
+def is_password_hash(stored):
+    return stored.startswith(("scrypt:", "pbkdf2:")) and stored.count("$") == 2
+
+
+@lru_cache(maxsize=1)
+def dummy_password_hash():
+    return hash_password(secrets.token_hex(16))
+
+
+def check_password(stored, password):
+    """(matches, new stored value or None); runs on the hashing pool.
+
+    Legacy plaintext rows and hashes made with other cost settings get a
+    fresh hash on success. Unknown users (stored is None) cost one hash,
+    the same as a wrong password, so timing does not reveal which
+    usernames exist.
+    """
+    if stored is None:
+        check_password_hash(dummy_password_hash(), password)
+        return False, None
+    if is_password_hash(stored):
+        if not check_password_hash(stored, password):
+            return False, None
+        return True, None if stored.startswith(PASSWORD_HASH_METHOD + "$") else hash_password(password)
+    if not hmac.compare_digest(stored.encode(), password.encode()):
+        return False, None
+    return True, hash_password(password)
+
+
+def verify_password(user, password):
+    """Check password for a users row (or None) and upgrade its stored hash if needed."""
+    stored = user["password"] if user else None
+    ok, new_hash = get_password_hasher().run(check_password, stored, password)
+    if ok and new_hash:
+        db = get_db()
+        # only if nobody changed it meanwhile
+        db.execute("UPDATE users SET password=? WHERE id=? AND password=?", (new_hash, user["id"], stored))
+        db.commit()
+        invalidate_user(user["id"])
+    return ok
+
+
+@app.cli.command("hash-passwords")
+def hash_passwords_command():
+    """Hash passwords still stored in plaintext (databases from before hashing)."""
+    db = get_db()
+    rows = [(r["id"], r["password"]) for r in db.execute("SELECT id, password FROM users WHERE password IS NOT NULL")
+            if not is_password_hash(r["password"])]
+    with ThreadPoolExecutor(max_workers=PASSWORD_WORKERS) as executor:
+        for i in range(0, len(rows), 1000):
+            chunk = rows[i:i + 1000]
+            hashes = executor.map(hash_password, [password for _, password in chunk])
+            # only rows nobody changed meanwhile (e.g. a login's own upgrade)
+            db.executemany("UPDATE users SET password=? WHERE id=? AND password=?",
+                           [(h, uid, password) for h, (uid, password) in zip(hashes, chunk)])
+            db.commit()
+            print(f"{min(i + 1000, len(rows))}/{len(rows)} hashed")
+    print(f"{len(rows)} plaintext password(s) hashed.")
+
+
+class TokenBucket:
+    """Per-key token buckets: `burst` tokens, one more every `refill` seconds.
+
+    Buckets live in an LRU map, so spraying many usernames cannot grow
+    memory without bound. State is per process; with N workers the real
+    limit is up to N times higher.
+    """
+
+    def __init__(self, burst, refill, maxsize=LOGIN_BUCKETS_MAX):
+        self.burst = burst
+        self.refill = refill
+        self._buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def take(self, key):
+        """Spend one token: 0 if allowed, otherwise seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) / self.refill)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) * self.refill
+                self.limited += 1
+            self._buckets.set(key, (tokens, now))
+        return wait
+
+
+login_limiter = TokenBucket(LOGIN_BURST, LOGIN_REFILL_SECONDS)
+
+
+# -------------------------
+# Auth routes
+# -------------------------
+@app.route("/login", methods=["GET", "POST"])
+@app.route("/", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        username = request.form.get("username", "").strip()
+        password = request.form.get("password", "").strip()
+
+        if not (username.isdigit() and len(username) == 5):
+            return render_template("login.html", error="Username must be 5 digits.")
+
+        wait = login_limiter.take(username)
+        if wait:
+            return render_template("login.html", error="Too many login attempts. Please wait a moment."), \
+                429, {"Retry-After": str(int(wait) + 1)}
+
+        user = get_user_by_username(username)
+        try:
+            ok = verify_password(user, password)
+        except PasswordBusy:
+            return render_template("login.html", error="The server is busy. Please try again."), \
+                503, {"Retry-After": "2"}
+        if not ok:
+            return render_template("login.html", error="Invalid username or password.")
+
+        # new session id; username / role / name come from the user cache on each request
+        session.clear()
+        session.rotate()
+        session["user_id"] = user["id"]
+        # Redirect by role
+        if user["role"] == "student":
+            return redirect(url_for("dashboard_student"))
+        else:
+            return redirect(url_for("dashboard_teacher"))
+
+    return render_template("login.html")
+
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect(url_for("login"))
+
+
+# -------------------------
+# Dashboards
+# -------------------------
+@app.route("/dashboard_student")
+@login_required
+def dashboard_student():
+    if session.get("role") != "student":
+        return redirect(url_for("dashboard_teacher"))
+
+    user_id = session["user_id"]
+    db = get_db()
+    now = date.today()
+    today = now.isoformat()
+    week_ago = (now - timedelta(days=7)).isoformat()
+
+    # today's hours and this month's total: one primary-key lookup each
+    row = db.execute(
+        "SELECT hours FROM practice_rollup_daily WHERE user_id=? AND date=?",
+        (user_id, today)
+    ).fetchone()
+    today_hours = float(row["hours"]) if row else 0.0
+
+    r = db.execute(
+        "SELECT hours FROM practice_rollup_monthly WHERE user_id=? AND month=?",
+        (user_id, today[:7])
+    ).fetchone()
+    month_hours = float(r["hours"]) if r and r["hours"] else 0.0
+
+    # notes this week (special_notes and practice_entries notes)
+    r = db.execute(
+        "SELECT SUM(notes_count) AS c FROM practice_rollup_daily WHERE user_id=? AND date >= ?",
+        (user_id, week_ago)
+    ).fetchone()
+    notes_week = int(r["c"] or 0)
+
+    return render_template(
+        "dashboard_student.html",
+        title="Dashboard",
+        active="dashboard",
+        today_hours=round(today_hours, 2),
+        month_hours=round(month_hours, 2),
+        notes_week=notes_week,
+    )
+
+
+@app.route("/dashboard_teacher")
+@login_required
+def dashboard_teacher():
+    if session.get("role") != "teacher":
+        return redirect(url_for("dashboard_student"))
+    # Simple teacher dashboard: show their name and count of public files and notifications
+    db = get_db()
+    teacher_id = session["user_id"]
+    pub_files = db.execute("SELECT COUNT(*) AS c FROM public_files WHERE teacher_id=?", (teacher_id,)).fetchone()["c"]
+    notes = db.execute("SELECT COUNT(*) AS c FROM notifications WHERE teacher_id=?", (teacher_id,)).fetchone()["c"]
+    return render_template("dashboard_teacher.html",
+                           title="Teacher Dashboard",
+                           active="dashboard",
+                           pub_files=pub_files,
+                           notifications_count=notes)
+
+
+# -------------------------
+# Hours (Calendar) routes
+# -------------------------
+@app.route("/hours")
+@login_required
+def hours():
+    # Student-only page
+    if session.get("role") != "student":
+        return redirect(url_for("dashboard_teacher"))
+
+    # entries are fetched a month at a time by the page (/api/practice_entries)
+    return render_template("hours.html", title="Hours Practiced", active="hours")
+
+
+def save_practice_entry(db, user_id, date_key, hours, technique, notes):
+    """Upsert one day's entry and its rollups. The caller commits."""
+    old = db.execute(
+        "SELECT hours, technique, notes FROM practice_entries WHERE user_id=? AND date=?",
+        (user_id, date_key)
+    ).fetchone()
+    # upsert
+    db.execute("""
+        INSERT INTO practice_entries (user_id, date, hours, technique, notes)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, date) DO UPDATE SET hours=excluded.hours, technique=excluded.technique,
+            notes=excluded.notes, version=version + 1
+    """, (user_id, date_key, hours, technique, notes))
+    if old:
+        bump_rollups(db, user_id, date_key,
+                     hours=hours - float(old["hours"] or 0),
+                     notes=entry_has_notes(notes) - entry_has_notes(old["notes"]))
+    else:
+        bump_rollups(db, user_id, date_key, hours=hours, entries=1, notes=entry_has_notes(notes))
+        mark_practice_days(db, user_id, [(date_key, True)])
+    bump_techniques_many(db, user_id, [(date_key, old["technique"] if old else None, -1), (date_key, technique, 1)])
+    bump_data_versions(db, f"practice:{user_id}")
+    return True
+
+
+def delete_practice_entry(db, user_id, date_key):
+    """Delete one day's entry; False if there was none. The caller commits."""
+    old = db.execute(
+        "SELECT hours, technique, notes FROM practice_entries WHERE user_id=? AND date=?",
+        (user_id, date_key)
+    ).fetchone()
+    if not old:
+        return False
+    db.execute("DELETE FROM practice_entries WHERE user_id=? AND date=?", (user_id, date_key))
+    bump_rollups(db, user_id, date_key,
+                 hours=-float(old["hours"] or 0), entries=-1,
+                 notes=-entry_has_notes(old["notes"]))
+    mark_practice_days(db, user_id, [(date_key, False)])
+    bump_techniques_many(db, user_id, [(date_key, old["technique"], -1)])
+    bump_data_versions(db, f"practice:{user_id}")
+    return True
+
+
+@app.route("/save_hours", methods=["POST"])
+@login_required
+def save_hours():
+    if session.get("role") != "student":
+        return "forbidden", 403
+    # normalize date format (YYYY-M-D or YYYY-MM-DD) -> YYYY-MM-DD
+    args = {
+        "user_id": session["user_id"],
+        "date_key": parse_date_key(request.form.get("date")),
+        "hours": float(request.form.get("hours") or 0),
+        "technique": request.form.get("technique") or "",
+        "notes": request.form.get("notes") or "",
+    }
+    if not queue_write("save_hours", args):
+        apply_write(get_db(), "save_hours", args)
+    return "ok", 200
+
+
+@app.route("/delete_hours", methods=["POST"])
+@login_required
+def delete_hours():
+    if session.get("role") != "student":
+        return "forbidden", 403
+    args = {"user_id": session["user_id"], "date_key": parse_date_key(request.form.get("date"))}
+    if not queue_write("delete_hours", args):
+        apply_write(get_db(), "delete_hours", args)
+    return "ok", 200
+
+
+PRACTICE_BATCH_MAX = 500
+
+
+def practice_entry_json(r):
+    return {"hours": r["hours"], "technique": r["technique"], "notes": r["notes"], "version": r["version"]}
+
+
+def practice_entries_between(db, user_id, date_from, date_to):
+    rows = db.execute(
+        "SELECT date, hours, technique, notes, version FROM practice_entries WHERE user_id=? AND date BETWEEN ? AND ?",
+        (user_id, date_from, date_to)
+    ).fetchall()
+    return {r["date"]: practice_entry_json(r) for r in rows}
+
+
+def parse_practice_ops(raw_ops):
+    """Validate a batch; returns [(op, date_key, fields, base_version)] or raises ValueError."""
+    if not isinstance(raw_ops, list) or len(raw_ops) > PRACTICE_BATCH_MAX:
+        raise ValueError(f"ops must be a list of at most {PRACTICE_BATCH_MAX} operations")
+    ops = []
+    for raw in raw_ops:
+        kind = raw.get("op")
+        if kind not in ("upsert", "delete"):
+            raise ValueError("op must be 'upsert' or 'delete'")
+        date_key = parse_date_key(str(raw.get("date")))
+        fields = None
+        if kind == "upsert":
+            fields = {"hours": float(raw.get("hours") or 0),
+                      "technique": raw.get("technique") or "",
+                      "notes": raw.get("notes") or ""}
+        ops.append((kind, date_key, fields, int(raw.get("base_version") or 0)))
+    return ops
+
+
+@app.route("/api/practice_entries/batch", methods=["POST"])
+@login_required
+def practice_entries_batch():
+    """Apply queued calendar edits in one transaction.
+
+    Body: {"ops": [{"op": "upsert"|"delete", "date", "hours", "technique",
+    "notes", "base_version"}], "from": "YYYY-MM-DD", "to": "YYYY-MM-DD"}.
+    base_version is the version the client last saw (0 for a new day). An op
+    whose base_version doesn't match the server is not applied and comes back
+    in "conflicts"; the response always carries the server's entries for the
+    requested range (or the range the ops cover) so the client can reconcile.
+    """
+    if session.get("role") != "student":
+        return jsonify({"error": "forbidden"}), 403
+    user_id = session["user_id"]
+    data = request.get_json(silent=True) or {}
+    try:
+        ops = parse_practice_ops(data.get("ops", []))
+        date_from = parse_date_key(data["from"]) if data.get("from") else None
+        date_to = parse_date_key(data["to"]) if data.get("to") else None
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": str(e) or "invalid batch"}), 400
+
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        dates = sorted({date_key for _, date_key, _, _ in ops})
+        original, deleted = {}, {}
+        for i in range(0, len(dates), 500):
+            chunk = dates[i:i + 500]
+            for r in db.execute(
+                f"SELECT date, hours, technique, notes, version FROM practice_entries WHERE user_id=? AND date IN ({','.join('?' * len(chunk))})",
+                [user_id] + chunk
+            ):
+                original[r["date"]] = practice_entry_json(r)
+            for r in db.execute(
+                f"SELECT date, version FROM practice_tombstones WHERE user_id=? AND date IN ({','.join('?' * len(chunk))})",
+                [user_id] + chunk
+            ):
+                deleted[r["date"]] = r["version"]
+
+        # replay the ops against an in-memory copy, in order. A missing day
+        # still matches base_version 0, but re-creating it continues from the
+        # deleted entry's version so stale clients conflict.
+        state = dict(original)
+        applied, conflicts = [], []
+        for kind, date_key, fields, base_version in ops:
+            current = state.get(date_key)
+            if (current["version"] if current else 0) != base_version:
+                conflicts.append(date_key)
+                continue
+            if kind == "upsert":
+                last = current["version"] if current else deleted.get(date_key, 0)
+                state[date_key] = dict(fields, version=last + 1)
+            elif current:
+                deleted[date_key] = current["version"]
+                del state[date_key]
+            applied.append(date_key)
+
+        upserts, deletes, deltas, day_changes, techniques = [], [], [], [], []
+        for date_key in dict.fromkeys(applied):
+            old, new = original.get(date_key), state.get(date_key)
+            techniques += [(date_key, old and old["technique"], -1), (date_key, new and new["technique"], 1)]
+            if new:
+                upserts.append((user_id, date_key, new["hours"], new["technique"], new["notes"], new["version"]))
+            elif old:
+                deletes.append((user_id, date_key))
+            delta = (date_key,
+                     (new["hours"] if new else 0) - (float(old["hours"] or 0) if old else 0),
+                     bool(new) - bool(old),
+                     entry_has_notes(new and new["notes"]) - entry_has_notes(old and old["notes"]))
+            if any(delta[1:]):
+                deltas.append(delta)
+            if bool(new) != bool(old):
+                day_changes.append((date_key, bool(new)))
+        db.executemany("""
+            INSERT INTO practice_entries (user_id, date, hours, technique, notes, version)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, date) DO UPDATE SET hours=excluded.hours, technique=excluded.technique,
+                notes=excluded.notes, version=excluded.version
+        """, upserts)
+        db.executemany("DELETE FROM practice_entries WHERE user_id=? AND date=?", deletes)
+        bump_rollups_many(db, user_id, deltas)
+        mark_practice_days(db, user_id, day_changes)
+        bump_techniques_many(db, user_id, techniques)
+        if applied:
+            bump_data_versions(db, f"practice:{user_id}")
+            refresh_suggestions(db, user_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    if dates or (date_from and date_to):
+        entries = practice_entries_between(db, user_id, date_from or dates[0], date_to or dates[-1])
+    else:
+        entries = {}
+    return jsonify({
+        "applied": [{"date": d, "version": state[d]["version"] if d in state else None} for d in dict.fromkeys(applied)],
+        "conflicts": [{"date": d, "server": state.get(d)} for d in dict.fromkeys(conflicts)],
+        "entries": entries,
+    })
+
+
+@app.route("/api/practice_entries")
+@login_required
+def practice_entries_month():
+    """One month of calendar entries: ?month=YYYY-MM (default: this month)."""
+    if session.get("role") != "student":
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        first = datetime.strptime(request.args.get("month") or date.today().strftime("%Y-%m"), "%Y-%m").date()
+    except ValueError:
+        return jsonify({"error": "month must be YYYY-MM"}), 400
+    last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    entries = practice_entries_between(get_db(), session["user_id"], first.isoformat(), last.isoformat())
+    return jsonify({"month": first.strftime("%Y-%m"), "entries": entries})
+
+
+@app.route("/api/practice_heatmap")
+@login_required
+def practice_heatmap():
+    """A year of practice days as a bitset: ?year=YYYY (default: this year).
+
+    "bits" is base64 of one bit per day from January 1st, least significant
+    bit first within each byte.
+    """
+    if session.get("role") != "student":
+        return jsonify({"error": "forbidden"}), 403
+    year = request.args.get("year", type=int) or date.today().year
+    if not 1 <= year <= 9999:
+        return jsonify({"error": "invalid year"}), 400
+    first, bits = load_practice_days(get_db(), session["user_id"])
+    start, end = date(year, 1, 1).toordinal(), date(year, 12, 31).toordinal() + 1
+    days = np.zeros(end - start, dtype=bool)
+    if first is not None:
+        lo, hi = max(start, first), min(end, first + len(bits))
+        if lo < hi:
+            days[lo - start:hi - start] = bits[lo - first:hi - first]
+    longest, current = practice_streaks(first, bits)
+    return jsonify({
+        "year": year,
+        "days": len(days),
+        "bits": base64.b64encode(np.packbits(days, bitorder="little").tobytes()).decode(),
+        "days_practiced": int(days.sum()),
+        "longest_streak": longest,
+        "current_streak": current,
+    })
+
+
+# -------------------------
+# Errors routes
+# -------------------------
+@app.route("/errors")
+@login_required
+def errors():
+    if session.get("role") != "student":
+        return redirect(url_for("dashboard_teacher"))
+    user_id = session["user_id"]
+
+    def build():
+        rows, next_cursor = page_errors(get_db(), user_id, *page_args())
+        return render_template("errors.html", title="Errors", active="errors", errors=rows, next_cursor=next_cursor)
+    return cached_response([f"errors:{user_id}"] + layout_scopes(), build)
+
+
+@app.route("/api/errors")
+@login_required
+def api_errors():
+    if session.get("role") != "student":
+        return jsonify({"error": "forbidden"}), 403
+    user_id = session["user_id"]
+    return cached_response([f"errors:{user_id}"], lambda: page_json(*page_errors(get_db(), user_id, *page_args())))
+
+
+@app.route("/add_error", methods=["POST"])
+@login_required
+def add_error():
+    if session.get("role") != "student":
+        return "forbidden", 403
+    args = {
+        "user_id": session["user_id"],
+        "date_str": date.today().isoformat(),
+        "piece": request.form.get("piece") or "",
+        "error_text": request.form.get("error_text") or "",
+    }
+    if not queue_write("add_error", args):
+        apply_write(get_db(), "add_error", args)
+    return redirect(url_for("errors"))
+
+
+def save_error(db, user_id, date_str, piece, error_text):
+    db.execute("INSERT INTO errors (user_id, date, piece, error_text) VALUES (?,?,?,?)",
+               (user_id, date_str, piece, error_text))
+    bump_data_versions(db, f"errors:{user_id}")
+
+
+# -------------------------
+# Notes routes
+# -------------------------
+@app.route("/notes")
+@login_required
+def notes():
+    if session.get("role") != "student":
+        return redirect(url_for("dashboard_teacher"))
+    user_id = session["user_id"]
+
+    def build():
+        rows, next_cursor = page_notes(get_db(), user_id, *page_args())
+        return render_template("notes.html", title="Notes", active="notes", notes=rows, next_cursor=next_cursor)
+    return cached_response([f"notes:{user_id}"] + layout_scopes(), build)
+
+
+@app.route("/api/notes")
+@login_required
+def api_notes():
+    if session.get("role") != "student":
+        return jsonify({"error": "forbidden"}), 403
+    user_id = session["user_id"]
+    return cached_response([f"notes:{user_id}"], lambda: page_json(*page_notes(get_db(), user_id, *page_args())))
+
+
+@app.route("/add_note", methods=["POST"])
+@login_required
+def add_note():
+    if session.get("role") != "student":
+        return "forbidden", 403
+    args = {
+        "user_id": session["user_id"],
+        "date_str": date.today().isoformat(),
+        "note_text": request.form.get("note_text") or "",
+    }
+    if not queue_write("add_note", args):
+        apply_write(get_db(), "add_note", args)
+    return redirect(url_for("notes"))
+
+
+def save_note(db, user_id, date_str, note_text):
+    db.execute("INSERT INTO special_notes (user_id, date, note_text) VALUES (?,?,?)",
+               (user_id, date_str, note_text))
+    bump_rollups(db, user_id, date_str, notes=1)
+    bump_data_versions(db, f"notes:{user_id}")
+
+
+# -------------------------
+# Bulk import / export (CSV and JSON lines)
+# -------------------------
+# GET  /api/export/<dataset>?format=csv|json[&student=<id>]
+# POST /api/import/<dataset>?format=csv|json    body: the file, raw or as multipart "file"
+#
+# dataset is practice, errors or notes. Students import and export their own
+# rows; teachers export one student (?student=) or every student, and import
+# rows naming their student by user_id or username. "json" means one object
+# per line, so both directions stream: exports read the table in fetchmany()
+# chunks on their own connection, and imports validate row by row and
+# executemany() IMPORT_CHUNK rows at a time, committing every
+# IMPORT_COMMIT_ROWS so other writers are never locked out for long. Large
+# chunks skip the per-row search_index triggers and reindex the rows they
+# wrote in two set-based statements, which is several times faster.
+# Rejected rows are skipped and reported by line number. Practice rows
+# upsert on (user_id, date); errors and notes are appended. Rollups,
+# practice-day bitsets, suggestions and cache versions are brought up to
+# date for the imported students once the stream ends.
+EXPORT_CHUNK = 5000
+IMPORT_CHUNK = 50000
+IMPORT_COMMIT_ROWS = 500000
+IMPORT_MAX_ERRORS = 100
+IMPORT_BULK_MIN = 1000          # smaller chunks go through the search triggers
+IMPORT_REBUILD_ALL = 200        # more students than this: rebuild rollups for everyone
+IMPORT_TEXT_MAX = 2000          # characters per text field
+
+# dataset -> (table, columns after user_id, conflict clause)
+DATASETS = {
+    "practice": ("practice_entries", ("date", "hours", "technique", "notes"),
+                 "ON CONFLICT(user_id, date) DO UPDATE SET hours=excluded.hours, technique=excluded.technique, "
+                 "notes=excluded.notes, version=version + 1"),
+    "errors": ("errors", ("date", "piece", "error_text"), ""),
+    "notes": ("special_notes", ("date", "note_text"), ""),
+}
+
+
+def export_chunks(dataset, fmt, user_id=None):
+    """Yield the export as text chunks; user_id=None exports every student."""
+    table, columns, _ = DATASETS[dataset]
+    header = ("user_id", "username") + columns
+    sql = (f"SELECT t.user_id, u.username, {', '.join('t.' + c for c in columns)} "
+           f"FROM {table} t JOIN users u ON u.id = t.user_id WHERE u.role = 'student'")
+    params = ()
+    if user_id is not None:
+        sql += " AND t.user_id = ? ORDER BY t.date, t.id"
+        params = (user_id,)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        cur = conn.execute(sql, params)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if fmt == "csv":
+            writer.writerow(header)
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                buf.writelines(json.dumps(dict(zip(header, r)), ensure_ascii=False) + "\n" for r in rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+    finally:
+        conn.close()
+
+
+def import_records(stream, fmt, fields):
+    """Yield (line number, [values for fields]) from a CSV or JSON-lines byte stream.
+
+    Malformed lines yield an exception instead of values.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.reader(text)
+        header = [h.strip().lower() for h in next(reader, [])]
+        # absent columns read the None padded onto every row
+        width = len(header)
+        pick = operator.itemgetter(*(header.index(f) if f in header else width for f in fields))
+        pad = [None] * (width + 1)
+        for row in reader:
+            if row:
+                row.extend(pad[len(row):])
+                yield reader.line_num, pick(row)
+        return
+    for line, raw in enumerate(text, start=1):
+        if not raw.strip():
+            continue
+        try:
+            obj = json.loads(raw)
+            values = [obj.get(f) for f in fields]
+        except (ValueError, AttributeError):
+            yield line, ValueError("not a JSON object")
+            continue
+        try:
+            yield line, [import_scalar(v) for v in values]
+        except ValueError as e:
+            yield line, e
+
+
+def import_day(value):
+    value = str(value or "").strip()
+    try:
+        day = date.fromisoformat(value)
+        # YYYY-MM-DD is kept as given; other ISO spellings are normalized
+        return value if len(value) == 10 and value[4] == value[7] == "-" else day.isoformat()
+    except ValueError:
+        pass
+    try:
+        return parse_date_key(value)
+    except ValueError:
+        raise ValueError(f"invalid date {value!r}") from None
+
+
+def import_scalar(value):
+    """JSON lines may carry any type; only strings, numbers and null are accepted."""
+    if isinstance(value, (dict, list, bool)):
+        raise ValueError(f"expected a string or number, got {type(value).__name__}")
+    return value
+
+
+def import_text(value, field):
+    value = "" if value is None else str(value)
+    if len(value) > IMPORT_TEXT_MAX:
+        raise ValueError(f"{field} is longer than {IMPORT_TEXT_MAX} characters")
+    return value
+
+
+def import_converter(dataset, resolve_user):
+    """Row converter: [user_id, username, *columns] -> statement params, or raises ValueError."""
+    if dataset == "practice":
+        def convert(values):
+            hours = float(values[3] or 0)
+            if not 0 <= hours <= 24:
+                raise ValueError("hours must be between 0 and 24")
+            return (resolve_user(values[0], values[1]), import_day(values[2]), hours,
+                    import_text(values[4], "technique"), import_text(values[5], "notes"))
+    elif dataset == "errors":
+        def convert(values):
+            return (resolve_user(values[0], values[1]), import_day(values[2]),
+                    import_text(values[3], "piece"), import_text(values[4], "error_text"))
+    else:
+        def convert(values):
+            return (resolve_user(values[0], values[1]), import_day(values[2]), import_text(values[3], "note_text"))
+    return convert
+
+
+def student_resolver(db, user_id=None):
+    """Map a row's (user_id, username) to a student id; user_id pins every row to one student."""
+    if user_id is not None:
+        return lambda uid, username: user_id
+    by_name, ids = {}, set()
+    for r in db.execute("SELECT id, username FROM users WHERE role='student'"):
+        by_name[r["username"]] = r["id"]
+        ids.add(r["id"])
+
+    def resolve(uid, username):
+        if uid not in (None, ""):
+            uid = int(uid)
+            if uid in ids:
+                return uid
+        elif username not in (None, "") and str(username) in by_name:
+            return by_name[str(username)]
+        raise ValueError("unknown student")
+    return resolve
+
+
+def write_import_chunk(db, dataset, batch):
+    """Write one chunk of converted rows inside the caller's transaction."""
+    table, columns, conflict = DATASETS[dataset]
+    names = ", ".join(("user_id",) + columns)
+    if len(batch) < IMPORT_BULK_MIN:
+        db.executemany(f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * (len(columns) + 1))}) {conflict}",
+                       batch)
+        return
+    drop_search_triggers(db, table)
+    if conflict:
+        # stage the chunk so the rows it upserted can be found again by key
+        db.execute(f"CREATE TEMP TABLE IF NOT EXISTS import_{dataset} ({names})")
+        db.execute(f"DELETE FROM import_{dataset}")
+        db.executemany(f"INSERT INTO import_{dataset} VALUES ({', '.join('?' * (len(columns) + 1))})", batch)
+        db.execute(f"INSERT INTO {table} ({names}) SELECT * FROM import_{dataset} WHERE true {conflict}")
+        reindex_search_rows(db, table, f"SELECT t.id FROM import_{dataset} s JOIN {table} t "
+                                       f"ON t.user_id = s.user_id AND t.date = s.date")
+    else:
+        last_id = db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        db.executemany(f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * (len(columns) + 1))})", batch)
+        reindex_search_rows(db, table, f"SELECT id FROM {table} WHERE id > ?", (last_id,))
+    create_search_triggers(db, table)
+
+
+def import_rows(db, dataset, records, resolve_user):
+    """Validate and write records in bounded transactions; returns a summary dict."""
+    convert = import_converter(dataset, resolve_user)
+    summary = {"imported": 0, "rejected": 0, "errors": []}
+    students, batch, pending = set(), [], 0
+
+    def reject(line, error):
+        summary["rejected"] += 1
+        if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+            summary["errors"].append({"row": line, "error": str(error) or type(error).__name__})
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for line, values in records:
+            if isinstance(values, Exception):
+                reject(line, values)
+                continue
+            try:
+                params = convert(values)
+            except (ValueError, TypeError) as e:
+                reject(line, e)
+                continue
+            batch.append(params)
+            if len(batch) >= IMPORT_CHUNK:
+                write_import_chunk(db, dataset, batch)
+                students.update(p[0] for p in batch)
+                summary["imported"] += len(batch)
+                pending += len(batch)
+                batch = []
+                if pending >= IMPORT_COMMIT_ROWS:
+                    db.commit()
+                    db.execute("BEGIN IMMEDIATE")
+                    pending = 0
+        write_import_chunk(db, dataset, batch)
+        students.update(p[0] for p in batch)
+        summary["imported"] += len(batch)
+        db.commit()
+    except (UnicodeDecodeError, csv.Error) as e:
+        # rows committed so far stay; the open chunk is dropped
+        db.rollback()
+        summary["imported"] -= pending
+        summary["aborted"] = f"unreadable input: {e}"
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if students:
+            finish_import(db, dataset, sorted(students))
+    return summary
+
+
+def finish_import(db, dataset, students):
+    """Bring derived data up to date for the students an import touched."""
+    if dataset in ("practice", "notes"):
+        if len(students) > IMPORT_REBUILD_ALL:
+            rebuild_rollups(db)
+        else:
+            for user_id in students:
+                rebuild_rollups(db, user_id)
+    bump_data_versions(db, *(f"{dataset}:{u}" for u in students))
+    if dataset == "practice":
+        for i in range(0, len(students), SUGGESTION_BATCH):
+            refresh_suggestions_many(db, students[i:i + SUGGESTION_BATCH])
+    db.commit()
+
+
+def bulk_format():
+    fmt = request.args.get("format", "csv")
+    return fmt if fmt in ("csv", "json") else None
+
+
+@app.route("/api/export/<dataset>")
+@login_required
+def export_dataset(dataset):
+    fmt = bulk_format()
+    if dataset not in DATASETS or not fmt:
+        return jsonify({"error": "unknown dataset or format"}), 404
+    if session.get("role") == "teacher":
+        user_id = request.args.get("student", type=int)
+    else:
+        user_id = session["user_id"]
+    name = f"{dataset}-{user_id or 'all'}-{date.today().isoformat()}.{'csv' if fmt == 'csv' else 'jsonl'}"
+    return app.response_class(
+        export_chunks(dataset, fmt, user_id),
+        mimetype="text/csv" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{name}"'},
+    )
+
+
+@app.route("/api/import/<dataset>", methods=["POST"])
+@login_required
+def import_dataset(dataset):
+    fmt = bulk_format()
+    if dataset not in DATASETS or not fmt:
+        return jsonify({"error": "unknown dataset or format"}), 404
+    db = get_db()
+    f = request.files.get("file")
+    stream = f.stream if f else request.stream
+    user_id = None if session.get("role") == "teacher" else session["user_id"]
+    fields = ("user_id", "username") + DATASETS[dataset][1]
+    summary = import_rows(db, dataset, import_records(stream, fmt, fields), student_resolver(db, user_id))
+    return jsonify(summary), 400 if "aborted" in summary else 200
+
+
+@app.cli.command("import-data")
+@click.argument("dataset", type=click.Choice(sorted(DATASETS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "json"]), default="csv", show_default=True)
+def import_data_command(dataset, path, fmt):
+    """Import a CSV / JSON-lines file of student rows (user_id or username column)."""
+    db = get_db()
+    with open(path, "rb") as fh:
+        summary = import_rows(db, dataset, import_records(fh, fmt, ("user_id", "username") + DATASETS[dataset][1]),
+                              student_resolver(db))
+    print(f"Imported {summary['imported']} row(s), rejected {summary['rejected']}.")
+    for e in summary["errors"]:
+        print(f"  line {e['row']}: {e['error']}")
+    if "aborted" in summary:
+        print(f"Aborted: {summary['aborted']}")
+
+
+@app.cli.command("export-data")
+@click.argument("dataset", type=click.Choice(sorted(DATASETS)))
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "json"]), default="csv", show_default=True)
+@click.option("--student", type=int, default=None, help="Only this student's rows.")
+def export_data_command(dataset, path, fmt, student):
+    """Export every student's rows (or one student's) to a file."""
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        for chunk in export_chunks(dataset, fmt, student):
+            fh.write(chunk)
+    print(f"Exported {dataset} to {path}.")
+
+
+# -------------------------
+# Full-text search (FTS5 over practice notes, errors and notifications)
+# -------------------------
+# search_index is maintained by triggers (see migrations.SEARCH_SOURCES).
+# Scoping is part of the MATCH expression, so FTS intersects the caller's
+# scope tokens with the query terms instead of filtering hits afterwards.
+SEARCH_KINDS = {0: "practice", 1: "error", 2: "note", 3: "notification"}
+SEARCH_MAX_TERMS = 8
+SEARCH_PAGE_SIZE = 20
+_fts_word = re.compile(r"\w+")
+
+
+def fts_query(text, scopes):
+    """Free text -> a safe FTS5 expression; the last word matches as a prefix."""
+    words = _fts_word.findall(text.lower())[:SEARCH_MAX_TERMS]
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += "*"
+    scope = " OR ".join(f'"{s}"' for s in scopes)
+    return f"scope : ({scope}) AND {{title body}} : ({' '.join(terms)})"
+
+
+def highlight_html(text):
+    """Escape an FTS snippet, turning its \\x02/\\x03 markers into <mark> tags."""
+    return str(escape(text or "")).replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+
+def search_entries(db, user_id, role, text, kind=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """BM25-ranked hits visible to this user (students also see every notification)."""
+    match = fts_query(text, [f"u{user_id}"] + (["all"] if role == "student" else []))
+    if match is None:
+        return []
+    kind_filter, params = "", [match]
+    if kind in SEARCH_KINDS.values():
+        kind_filter = "AND rowid % 4 = ?"
+        params.append(next(code for code, name in SEARCH_KINDS.items() if name == kind))
+    rows = db.execute(f"""
+        SELECT rowid, day,
+               highlight(search_index, 0, char(2), char(3)) AS title,
+               snippet(search_index, 1, char(2), char(3), '…', 16) AS snippet
+        FROM search_index
+        WHERE search_index MATCH ? {kind_filter}
+        ORDER BY bm25(search_index, 3.0, 1.0, 0.0)
+        LIMIT ? OFFSET ?
+    """, params + [limit, offset]).fetchall()
+    return [{
+        "kind": SEARCH_KINDS[r["rowid"] % 4],
+        "id": r["rowid"] // 4,
+        "date": r["day"],
+        "title": highlight_html(r["title"]),
+        "snippet": highlight_html(r["snippet"]),
+    } for r in rows]
+
+
+SEARCH_LINKS = {"practice": "hours", "error": "errors", "note": "notes", "notification": "notifications"}
+
+
+@app.route("/search")
+@login_required
+def search():
+    """?q=<text> [&kind=practice|error|note|notification] [&limit=] [&offset=]"""
+    limit = max(1, min(request.args.get("limit", SEARCH_PAGE_SIZE, type=int) or SEARCH_PAGE_SIZE, MAX_PAGE_SIZE))
+    offset = max(0, request.args.get("offset", 0, type=int) or 0)
+    hits = search_entries(get_db(), session["user_id"], session.get("role"), request.args.get("q", ""),
+                          request.args.get("kind"), limit + 1, offset)
+    for hit in hits:
+        hit["url"] = url_for(SEARCH_LINKS[hit["kind"]])
+    return jsonify({"items": hits[:limit], "next_offset": offset + limit if len(hits) > limit else None})
+
+
+@app.cli.command("rebuild-search")
+def rebuild_search_command():
+    """Re-index every note, error and notification for /search."""
+    db = get_db()
+    rebuild_search_index(db)
+    db.commit()
+    print(f"Indexed {db.execute('SELECT COUNT(*) FROM search_index').fetchone()[0]} entries.")
+
+
+# -------------------------
+# Library catalog (in-process index behind /get_library)
+# -------------------------
+# Each process keeps public_files and private_files in memory, indexed by
+# facet, date, name and search token. Writes append to library_changes in
+# the same transaction; every query first replays changes it hasn't seen,
+# so uploads and deletes made by any worker show up without a rebuild.
+LIBRARY_CATEGORIES = ("scales", "intervals", "exercises", "songs")
+LIBRARY_CHANGE_RETENTION = 10000
+PREFIX_EXPAND_LIMIT = 64    # prefixes matching more tokens are checked per entry instead
+_search_token = re.compile(r"[a-z0-9]+")
+
+LIBRARY_SELECT = {
+    "public": "SELECT pf.*, u.name AS teacher_name FROM public_files pf LEFT JOIN users u ON u.id=pf.teacher_id",
+    "private": "SELECT pf.*, NULL AS teacher_name FROM private_files pf",
+}
+
+
+def search_tokens(*texts):
+    return tuple(sorted({t for text in texts if text for t in _search_token.findall(text.lower())}))
+
+
+def log_library_change(db, kind, file_id, owner_id):
+    """Record an insert or delete for other processes' catalogs and caches. The caller commits."""
+    bump_data_versions(db, "library:public" if kind == "public" else f"library:{owner_id}")
+    cur = db.execute("INSERT INTO library_changes (kind, file_id) VALUES (?, ?)", (kind, file_id))
+    db.execute("DELETE FROM library_changes WHERE id <= ?", (cur.lastrowid - LIBRARY_CHANGE_RETENTION,))
+
+
+def catalog_entry(kind, r):
+    name = r["original_name"] or r["file_name"]
+    return {
+        "id": r["id"],
+        "kind": kind,
+        "owner_id": r["teacher_id"] if kind == "public" else r["user_id"],
+        "teacher_name": r["teacher_name"],
+        "file_name": r["file_name"],
+        "name": name,
+        "file_type": r["file_type"],
+        "category": r["category"],
+        "description": r["description"],
+        "timestamp": r["timestamp"] or "",
+        "size": r["size"],
+        "sha256": r["sha256"],
+        "name_key": name.lower(),
+        "tokens": search_tokens(name, r["description"]),
+    }
+
+
+def _discard_sorted(items, value):
+    i = bisect.bisect_left(items, value)
+    if i < len(items) and items[i] == value:
+        del items[i]
+
+
+class LibraryIndex:
+    """In-memory index over one library table."""
+
+    FACETS = ("category", "file_type", "owner_id")
+
+    def __init__(self, entries=()):
+        self.entries = {}
+        self.facets = {f: {} for f in self.FACETS}
+        self.postings = {}
+        for e in entries:
+            self._index(e)
+        self.by_date = sorted((e["timestamp"], e["id"]) for e in self.entries.values())
+        self.by_name = sorted((e["name_key"], e["id"]) for e in self.entries.values())
+        self.tokens = sorted(self.postings)
+
+    def _index(self, e):
+        """Add to the hash indexes; returns tokens not seen before."""
+        self.entries[e["id"]] = e
+        for f in self.FACETS:
+            self.facets[f].setdefault(e[f], set()).add(e["id"])
+        new_tokens = []
+        for tok in e["tokens"]:
+            if tok not in self.postings:
+                self.postings[tok] = set()
+                new_tokens.append(tok)
+            self.postings[tok].add(e["id"])
+        return new_tokens
+
+    def add(self, e):
+        self.remove(e["id"])
+        for tok in self._index(e):
+            bisect.insort(self.tokens, tok)
+        bisect.insort(self.by_date, (e["timestamp"], e["id"]))
+        bisect.insort(self.by_name, (e["name_key"], e["id"]))
+
+    def remove(self, file_id):
+        e = self.entries.pop(file_id, None)
+        if e is None:
+            return
+        _discard_sorted(self.by_date, (e["timestamp"], file_id))
+        _discard_sorted(self.by_name, (e["name_key"], file_id))
+        for f in self.FACETS:
+            ids = self.facets[f][e[f]]
+            ids.discard(file_id)
+            if not ids:
+                del self.facets[f][e[f]]
+        for tok in e["tokens"]:
+            ids = self.postings[tok]
+            ids.discard(file_id)
+            if not ids:
+                del self.postings[tok]
+                _discard_sorted(self.tokens, tok)
+
+    def query(self, facets=None, q="", date_from=None, date_to=None, sort="date", cursor=None, limit=PAGE_SIZE):
+        """Return (entries, next_cursor): newest first, or A-Z for sort="name".
+
+        Each facet or search word is a group of id sets an entry must hit one
+        of. If the matches are dense the sort order is walked and filtered
+        until the page is full; if they are sparse, the smallest group is
+        expanded, filtered and only that is sorted.
+        """
+        groups, prefixes = [], []
+        for field, value in (facets or {}).items():
+            ids = self.facets[field].get(value)
+            if not ids:
+                return [], None
+            groups.append([ids])
+        for word in _search_token.findall(q.lower()):
+            lo = bisect.bisect_left(self.tokens, word)
+            hi = bisect.bisect_left(self.tokens, word + "\uffff")
+            if lo == hi:
+                return [], None
+            if hi - lo > PREFIX_EXPAND_LIMIT:
+                prefixes.append(word)
+            else:
+                groups.append([self.postings[t] for t in self.tokens[lo:hi]])
+
+        by_name = sort == "name"
+        order = self.by_name if by_name else self.by_date
+        lo, hi = 0, len(order)
+        if not by_name:
+            if date_from:
+                lo = bisect.bisect_left(order, (date_from,))
+            if date_to:
+                hi = bisect.bisect_left(order, (date_to + "\uffff",))
+        if cursor:
+            if by_name:
+                lo = max(lo, bisect.bisect_right(order, tuple(cursor)))
+            else:
+                hi = min(hi, bisect.bisect_left(order, tuple(cursor)))
+        if lo >= hi:
+            return [], None
+
+        entries = self.entries
+
+        def keep(file_id):
+            e = entries[file_id]
+            if by_name and ((date_from and e["timestamp"] < date_from) or (date_to and e["timestamp"][:10] > date_to)):
+                return False
+            return all(any(t.startswith(p) for t in e["tokens"]) for p in prefixes)
+
+        # walking costs a Python-level check per group per step; expanding
+        # costs roughly one C-level set operation per id in the smallest group
+        sizes = [sum(map(len, g)) for g in groups]
+        selectivity = 1.0
+        for size in sizes:
+            selectivity *= size / len(entries)
+        walk_steps = min(hi - lo, (limit + 1) / selectivity)
+        if not groups or walk_steps * len(groups) * 8 <= min(sizes):
+            picked = []
+            for i in (range(lo, hi) if by_name else range(hi - 1, lo - 1, -1)):
+                file_id = order[i][1]
+                if all(any(file_id in ids for ids in g) for g in groups) and keep(file_id):
+                    picked.append(order[i])
+                    if len(picked) > limit:
+                        break
+        else:
+            groups = [g for _, g in sorted(zip(sizes, groups), key=lambda p: p[0])]
+            candidates = set().union(*groups[0])
+            for g in groups[1:]:
+                if len(g) == 1:
+                    candidates &= g[0]
+                else:
+                    candidates = {i for i in candidates if any(i in ids for ids in g)}
+            first, last = order[lo], order[hi - 1]
+            sort_field = "name_key" if by_name else "timestamp"
+            keys = [(entries[i][sort_field], i) for i in candidates]
+            keys = [k for k in keys if first <= k <= last and keep(k[1])]
+            picked = heapq.nsmallest(limit + 1, keys) if by_name else heapq.nlargest(limit + 1, keys)
+        next_cursor = encode_cursor(*picked[limit - 1]) if len(picked) > limit else None
+        return [entries[k[1]] for k in picked[:limit]], next_cursor
+
+
+_catalog_lock = threading.Lock()
+_catalog = {"last_change": None, "public": None, "private": None}
+
+
+def _sync_catalog(db):
+    """Bring this process's catalog up to date (call with _catalog_lock held)."""
+    last = _catalog["last_change"]
+    if last is not None:
+        changes = db.execute("SELECT id, kind, file_id FROM library_changes WHERE id > ? ORDER BY id", (last,)).fetchall()
+        if not changes or changes[0]["id"] == last + 1:
+            for c in changes:
+                row = db.execute(LIBRARY_SELECT[c["kind"]] + " WHERE pf.id=?", (c["file_id"],)).fetchone()
+                if row:
+                    _catalog[c["kind"]].add(catalog_entry(c["kind"], row))
+                else:
+                    _catalog[c["kind"]].remove(c["file_id"])
+                _catalog["last_change"] = c["id"]
+            return
+    # first use, or the change log was pruned past us: rebuild. Read the
+    # log position first so changes racing the load are replayed later.
+    last = db.execute("SELECT COALESCE(MAX(id), 0) FROM library_changes").fetchone()[0]
+    for kind, select in LIBRARY_SELECT.items():
+        _catalog[kind] = LibraryIndex(catalog_entry(kind, r) for r in db.execute(select))
+    _catalog["last_change"] = last
 
+
+def query_library(db, kind, **filters):
+    with _catalog_lock:
+        _sync_catalog(db)
+        return _catalog[kind].query(**filters)
+
+
+def library_item(e, media_by_sha):
+    if e["kind"] == "public":
+        path = f"uploads/public/{e['file_name']}"
+        url = url_for("serve_public_upload", filename=e["file_name"])
+    else:
+        path = f"uploads/private/{e['owner_id']}/{e['file_name']}"
+        url = url_for("download_private", filename=e["file_name"])
+    item = {k: e[k] for k in ("id", "name", "category", "file_type", "description", "teacher_name", "timestamp", "size")}
+    item.update(path=path, url=url, media=media_by_sha.get(e["sha256"], {}))
+    return item
+
+
+# -------------------------
+# Music Library routes
+# -------------------------
+def library_scopes():
+    """Data versions a library listing for the current user depends on."""
+    return ["library:public", f"library:{session['user_id']}", "media"]
+
+
+@app.route("/music-library")
+@login_required
+def music_library():
+    def build():
+        db = get_db()
+        # first page of each list; the rest comes from /api/music_library
+        public, public_next = page_public_files(db, limit=PAGE_SIZE)
+        user_id = session["user_id"]
+        private, private_next = page_private_files(db, user_id, limit=PAGE_SIZE)
+        return render_template("music_library.html", title="Music Library", active="library",
+                               public=public, private=private,
+                               media=media_urls(db, [r["sha256"] for r in public + private]),
+                               public_next=public_next, private_next=private_next)
+    return cached_response(library_scopes() + layout_scopes(), build)
+
+
+@app.route("/api/music_library")
+@login_required
+def api_music_library():
+    def build():
         db = get_db()
-        db.execute("INSERT INTO public_files (teacher_id, file_name, original_name, file_type, description, timestamp) VALUES (?,?,?,?,?,?)",
-                   (session["user_id"], save_name, filename, filename.rsplit(".", 1)[-1].lower(), desc, timestamp))
+        if request.args.get("list") == "private":
+            return library_json(db, *page_private_files(db, session["user_id"], *page_args()))
+        return library_json(db, *page_public_files(db, *page_args()))
+    return cached_response(library_scopes(), build)
+
+
+@app.route("/get_library")
+@login_required
+def get_library():
+    """Filtered, paginated library listing from the in-process catalog.
+
+    ?mode=public|private &category= &type= &teacher=<id> &from=YYYY-MM-DD
+    &to=YYYY-MM-DD &q=<name/description prefixes> &sort=date|name &cursor= &limit=
+    """
+    return cached_response(library_scopes(), _get_library)
+
+
+def _get_library():
+    db = get_db()
+    kind = "private" if request.args.get("mode") == "private" else "public"
+    facets = {}
+    if request.args.get("category") and request.args["category"] != "all":
+        facets["category"] = request.args["category"]
+    if request.args.get("type"):
+        facets["file_type"] = request.args["type"].lower()
+    if kind == "private":
+        facets["owner_id"] = session["user_id"]
+    elif request.args.get("teacher", type=int) is not None:
+        facets["owner_id"] = request.args.get("teacher", type=int)
+    cursor, limit = page_args()
+    entries, next_cursor = query_library(
+        db, kind, facets=facets, q=request.args.get("q", ""),
+        date_from=request.args.get("from"), date_to=request.args.get("to"),
+        sort="name" if request.args.get("sort") == "name" else "date",
+        cursor=decode_cursor(cursor), limit=limit,
+    )
+    media_by_sha = media_urls(db, [e["sha256"] for e in entries])
+    return jsonify({"items": [library_item(e, media_by_sha) for e in entries], "next_cursor": next_cursor})
+
+
+@app.route("/upload_audio", methods=["POST"])
+@login_required
+def upload_audio():
+    """JSON twin of upload_public/upload_private used by library.js."""
+    db = get_db()
+    refused = upload_refusal(db, session["user_id"])
+    if refused:
+        return jsonify({"error": "length required" if refused == 411 else "storage quota exceeded"}), refused
+    f = request.files.get("file")
+    if not f or not allowed_file(f.filename):
+        return jsonify({"error": "unsupported file"}), 400
+    kind = "public" if request.form.get("public") in ("true", "1", "on") else "private"
+    if kind == "public" and session.get("role") != "teacher":
+        return jsonify({"error": "only teachers can publish files"}), 403
+    file_id = save_library_file(db, kind, f, request.form.get("description", ""), request.form.get("category"))
+    if file_id is None:
+        return jsonify({"error": "storage quota exceeded"}), 413
+    db.commit()
+    row = db.execute(LIBRARY_SELECT[kind] + " WHERE pf.id=?", (file_id,)).fetchone()
+    return jsonify(library_item(catalog_entry(kind, row), {})), 201
+
+
+@app.route("/delete_audio", methods=["POST"])
+@login_required
+def delete_audio():
+    """Delete one of the caller's files by its library path (or id)."""
+    data = request.get_json(silent=True) or {}
+    file_name = os.path.basename(data.get("path") or "")
+    db = get_db()
+    row = db.execute("SELECT * FROM private_files WHERE user_id=? AND (file_name=? OR id=?)",
+                     (session["user_id"], file_name, data.get("id"))).fetchone()
+    kind = "private"
+    if row is None and session.get("role") == "teacher":
+        row = db.execute("SELECT * FROM public_files WHERE teacher_id=? AND (file_name=? OR id=?)",
+                         (session["user_id"], file_name, data.get("id"))).fetchone()
+        kind = "public"
+    if row is None:
+        return jsonify({"error": "not found"}), 404
+    delete_library_file(db, kind, row)
+    db.commit()
+    return jsonify({"ok": True})
+
+
+def save_library_file(db, kind, f, description="", category=None):
+    """Store an uploaded file in the public or private library; returns the row id.
+
+    The caller has checked the file type and the declared length against the
+    quota, and commits. The saved size is checked again (the body may differ
+    from its Content-Length, or a concurrent upload may have landed); over
+    quota, the file is removed and None returned.
+    """
+    filename = secure_filename(f.filename)
+    file_type = filename.rsplit(".", 1)[-1].lower()
+    save_name = make_save_name(session["username"], filename)
+    if kind == "public":
+        save_path = os.path.join(UPLOAD_PUBLIC, save_name)
+    else:
+        personal_folder = os.path.join(UPLOAD_PRIVATE, str(session["user_id"]))
+        os.makedirs(personal_folder, exist_ok=True)
+        save_path = os.path.join(personal_folder, save_name)
+    size = save_upload(f, save_path)
+    if not quota_allows(db, session["user_id"], size):
+        os.remove(save_path)
+        return None
+    sha256 = adopt_blob(db, save_path)
+    category = category if category in LIBRARY_CATEGORIES else None
+
+    owner_col = "teacher_id" if kind == "public" else "user_id"
+    cur = db.execute(f"INSERT INTO {kind}_files ({owner_col}, file_name, original_name, file_type, description, timestamp, size, sha256, category) VALUES (?,?,?,?,?,?,?,?,?)",
+                     (session["user_id"], save_name, filename, file_type, description, datetime.now().isoformat(), size, sha256, category))
+    log_library_change(db, kind, cur.lastrowid, session["user_id"])
+    enqueue_media_jobs(db, sha256, file_type)
+    return cur.lastrowid
+
+
+@app.route("/upload_public", methods=["POST"])
+@login_required
+def upload_public():
+    # only teachers can upload public files
+    if session.get("role") != "teacher":
+        return "forbidden", 403
+
+    db = get_db()
+    refused = upload_refusal(db, session["user_id"])
+    if refused:
+        return ("length required" if refused == 411 else "storage quota exceeded"), refused
+    if "file" not in request.files:
+        flash("No file")
+        return redirect(url_for("music_library"))
+
+    f = request.files["file"]
+    if f and allowed_file(f.filename):
+        if save_library_file(db, "public", f, request.form.get("description", ""), request.form.get("category")) is None:
+            return "storage quota exceeded", 413
         db.commit()
 
     return redirect(url_for("music_library"))
@@ -492,48 +3298,500 @@ def upload_public():
 @app.route("/upload_private", methods=["POST"])
 @login_required
 def upload_private():
+    db = get_db()
+    refused = upload_refusal(db, session["user_id"])
+    if refused:
+        return ("length required" if refused == 411 else "storage quota exceeded"), refused
     if "file" not in request.files:
         flash("No file")
         return redirect(url_for("music_library"))
     f = request.files["file"]
-    desc = request.form.get("description", "")
     if f and allowed_file(f.filename):
-        filename = secure_filename(f.filename)
-        save_name = f"{session['username']}_{int(datetime.now().timestamp())}_{filename}"
-        personal_folder = os.path.join(UPLOAD_PRIVATE, str(session["user_id"]))
-        os.makedirs(personal_folder, exist_ok=True)
-        save_path = os.path.join(personal_folder, save_name)
-        f.save(save_path)
-
-        db = get_db()
-        db.execute("INSERT INTO private_files (user_id, file_name, original_name, file_type, description, timestamp) VALUES (?,?,?,?,?,?)",
-                   (session["user_id"], save_name, filename, filename.rsplit(".", 1)[-1].lower(), desc, datetime.now().isoformat()))
+        if save_library_file(db, "private", f, request.form.get("description", ""), request.form.get("category")) is None:
+            return "storage quota exceeded", 413
         db.commit()
 
     return redirect(url_for("music_library"))
 
 
+# -------------------------
+# Chunked / resumable uploads
+# -------------------------
+# POST   /api/uploads            {filename, size, target, description?, sha256?} -> session
+# PUT    /api/uploads/<id>       raw bytes with "Content-Range: bytes start-end/size"
+# GET    /api/uploads/<id>       current offset, to resume after an interruption
+# DELETE /api/uploads/<id>       abort and remove the partial file
+#
+# Bytes go straight into a .part file in the destination folder and are
+# renamed into place when the last chunk lands, so nothing is spooled or
+# copied. The SHA-256 is computed as chunks arrive. One chunk is written at a
+# time per upload (flock on the .part file). Sessions not finished within
+# UPLOAD_SESSION_TTL stop counting against the quota and are purged, with
+# their .part files, by the next upload that starts.
+UPLOAD_PURGE_SECONDS = 600      # purge expired sessions at most this often (per process)
+UPLOAD_PURGE_BATCH = 500
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+_upload_last_purge = 0.0
+
+
+def upload_folder(target, user_id):
+    if target == "public":
+        return UPLOAD_PUBLIC
+    folder = os.path.join(UPLOAD_PRIVATE, str(user_id))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def upload_part_path(up):
+    return os.path.join(upload_folder(up["target"], up["user_id"]), f".{up['file_name']}.part")
+
+
+def upload_status(up):
+    return {
+        "upload_id": up["id"],
+        "file_name": up["file_name"],
+        "size": up["size"],
+        "offset": up["received"],
+        "complete": up["completed_at"] is not None,
+        "sha256": up["sha256"],
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+    }
+
+
+def get_upload(db, upload_id):
+    up = db.execute("SELECT * FROM upload_sessions WHERE id=?", (upload_id,)).fetchone()
+    if not up or up["user_id"] != session["user_id"]:
+        return None
+    if not up["completed_at"] and up["created_at"] < upload_cutoff():
+        return None
+    return up
+
+
+def purge_expired_uploads(db):
+    """Delete expired unfinished upload sessions and their .part files; returns the count."""
+    rows = db.execute(
+        "SELECT * FROM upload_sessions WHERE completed_at IS NULL AND created_at < ? LIMIT ?",
+        (upload_cutoff(), UPLOAD_PURGE_BATCH)
+    ).fetchall()
+    for up in rows:
+        try:
+            os.remove(upload_part_path(up))
+        except OSError:
+            pass
+    with _upload_hashers_lock:
+        for up in rows:
+            _upload_hashers.pop(up["id"], None)
+    db.executemany("DELETE FROM upload_sessions WHERE id=? AND completed_at IS NULL", [(up["id"],) for up in rows])
+    db.commit()
+    return len(rows)
+
+
+def maybe_purge_uploads(db):
+    global _upload_last_purge
+    now = time.monotonic()
+    if now - _upload_last_purge > UPLOAD_PURGE_SECONDS:
+        _upload_last_purge = now
+        purge_expired_uploads(db)
+
+
+def upload_hasher(up, part_path):
+    """Running SHA-256 for an upload, rebuilt from the .part file if this
+    worker didn't see the earlier chunks (restart or another process)."""
+    with _upload_hashers_lock:
+        entry = _upload_hashers.get(up["id"])
+    if entry and entry[0] == up["received"]:
+        return entry[1].copy()
+    h = hashlib.sha256()
+    remaining = up["received"]
+    with open(part_path, "rb") as fh:
+        while remaining > 0:
+            buf = fh.read(min(UPLOAD_READ_SIZE, remaining))
+            if not buf:
+                break
+            h.update(buf)
+            remaining -= len(buf)
+    return h
+
+
+def parse_content_range(header):
+    """'bytes start-end/total' -> (start, end_inclusive, total) or None."""
+    try:
+        unit, rng = header.split(" ", 1)
+        span, total = rng.split("/", 1)
+        start, end = span.split("-", 1)
+        if unit != "bytes":
+            return None
+        return int(start), int(end), int(total)
+    except (AttributeError, ValueError):
+        return None
+
+
+@app.route("/api/uploads", methods=["POST"])
+@login_required
+def api_upload_create():
+    data = request.get_json(silent=True) or request.form
+    target = data.get("target", "private")
+    filename = secure_filename(data.get("filename") or "")
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "size is required"}), 400
+    if target not in ("public", "private"):
+        return jsonify({"error": "target must be public or private"}), 400
+    if target == "public" and session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    if not filename or not allowed_file(filename):
+        return jsonify({"error": "file type not allowed"}), 400
+    if size <= 0:
+        return jsonify({"error": "size must be positive"}), 400
+
+    db = get_db()
+    maybe_purge_uploads(db)
+    if not quota_allows(db, session["user_id"], size):
+        return jsonify({"error": "storage quota exceeded", "quota": USER_QUOTA_BYTES,
+                        "used": quota_used(db, session["user_id"])}), 413
+
+    upload_id = secrets.token_hex(16)
+    save_name = make_save_name(session["username"], filename)
+    db.execute("""
+        INSERT INTO upload_sessions (id, user_id, target, file_name, original_name, description,
+                                     size, received, expected_sha256, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+    """, (upload_id, session["user_id"], target, save_name, filename, data.get("description", ""),
+          size, (data.get("sha256") or "").lower() or None, datetime.now().isoformat()))
+    db.commit()
+    up = get_upload(db, upload_id)
+
+    # content this user already holds: link it and finish without receiving any
+    # bytes. Anything else is uploaded in full and deduplicated by finish_upload
+    # once the digest has been verified.
+    blob = find_blob(db, up["expected_sha256"])
+    if blob and blob["size"] == size and holds_blob(db, up["user_id"], blob["sha256"]):
+        link_blob(blob["sha256"], os.path.join(upload_folder(target, up["user_id"]), save_name))
+        add_blob_ref(db, blob["sha256"], size)
+        return record_upload(db, up, blob["sha256"])
+
+    open(upload_part_path(up), "wb").close()
+    return jsonify(upload_status(up)), 201
+
+
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+@login_required
+def api_upload_status(upload_id):
+    up = get_upload(get_db(), upload_id)
+    if not up:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(upload_status(up))
+
+
+@app.route("/api/uploads/<upload_id>", methods=["PUT"])
+@login_required
+def api_upload_chunk(upload_id):
+    db = get_db()
+    up = get_upload(db, upload_id)
+    if not up:
+        return jsonify({"error": "not found"}), 404
+    if up["completed_at"]:
+        return jsonify(upload_status(up))
+
+    rng = parse_content_range(request.headers.get("Content-Range"))
+    if not rng or rng[2] != up["size"] or rng[1] < rng[0]:
+        return jsonify({"error": "bad Content-Range"}), 400
+    start, end, _ = rng
+    if end >= up["size"]:
+        return jsonify({"error": "chunk past declared size"}), 413
+
+    part_path = upload_part_path(up)
+    try:
+        fh = open(part_path, "r+b")
+    except FileNotFoundError:
+        return jsonify({"error": "not found"}), 404
+    with fh:
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another chunk of this upload is being written
+            return jsonify(upload_status(up)), 409
+        # re-read under the lock: a concurrent request may have moved the offset
+        up = get_upload(db, upload_id)
+        if not up:
+            return jsonify({"error": "not found"}), 404
+        if up["completed_at"]:
+            return jsonify(upload_status(up))
+        if start != up["received"]:
+            # client is out of sync (e.g. resumed from a stale offset)
+            return jsonify(upload_status(up)), 409
+
+        h = upload_hasher(up, part_path)
+        expected = end - start + 1
+        written = 0
+        fh.seek(start)
+        fh.truncate()
+        while written < expected:
+            buf = request.stream.read(min(UPLOAD_READ_SIZE, expected - written))
+            if not buf:
+                break
+            fh.write(buf)
+            h.update(buf)
+            written += len(buf)
+        fh.flush()
+        if request.stream.read(1):
+            # more bytes than the range promised: refuse without reading them
+            return jsonify({"error": "chunk larger than Content-Range"}), 413
+
+        received = start + written
+        cur = db.execute(
+            "UPDATE upload_sessions SET received=? WHERE id=? AND received=? AND completed_at IS NULL",
+            (received, upload_id, start)
+        )
+        db.commit()
+        if not cur.rowcount:
+            # aborted or purged while we wrote
+            return jsonify({"error": "not found"}), 404
+        with _upload_hashers_lock:
+            _upload_hashers[upload_id] = (received, h)
+
+        up = get_upload(db, upload_id)
+        if not up:
+            return jsonify({"error": "not found"}), 404
+        if received == up["size"]:
+            return finish_upload(db, up, h.hexdigest())
+    return jsonify(upload_status(up)), 202 if written == expected else 400
+
+
+def finish_upload(db, up, digest):
+    with _upload_hashers_lock:
+        _upload_hashers.pop(up["id"], None)
+    if up["expected_sha256"] and up["expected_sha256"] != digest:
+        discard_upload(db, up)
+        return jsonify({"error": "checksum mismatch", "sha256": digest}), 422
+
+    dest = os.path.join(upload_folder(up["target"], up["user_id"]), up["file_name"])
+    os.replace(upload_part_path(up), dest)
+    adopt_blob(db, dest, digest)
+    return record_upload(db, up, digest)
+
+
+def record_upload(db, up, digest):
+    """Insert the library row for a finished upload session and commit."""
+    now = datetime.now().isoformat()
+    file_type = up["original_name"].rsplit(".", 1)[-1].lower()
+    if up["target"] == "public":
+        cur = db.execute("INSERT INTO public_files (teacher_id, file_name, original_name, file_type, description, timestamp, size, sha256) VALUES (?,?,?,?,?,?,?,?)",
+                         (up["user_id"], up["file_name"], up["original_name"], file_type, up["description"], now, up["size"], digest))
+    else:
+        cur = db.execute("INSERT INTO private_files (user_id, file_name, original_name, file_type, description, timestamp, size, sha256) VALUES (?,?,?,?,?,?,?,?)",
+                         (up["user_id"], up["file_name"], up["original_name"], file_type, up["description"], now, up["size"], digest))
+    log_library_change(db, up["target"], cur.lastrowid, up["user_id"])
+    db.execute("UPDATE upload_sessions SET completed_at=?, sha256=?, received=size WHERE id=?", (now, digest, up["id"]))
+    enqueue_media_jobs(db, digest, file_type)
+    db.commit()
+    return jsonify(upload_status(get_upload(db, up["id"]))), 201
+
+
+def discard_upload(db, up):
+    try:
+        os.remove(upload_part_path(up))
+    except OSError:
+        pass
+    db.execute("DELETE FROM upload_sessions WHERE id=?", (up["id"],))
+    db.commit()
+
+
+@app.route("/api/uploads/<upload_id>", methods=["DELETE"])
+@login_required
+def api_upload_abort(upload_id):
+    db = get_db()
+    up = get_upload(db, upload_id)
+    if not up:
+        return jsonify({"error": "not found"}), 404
+    if not up["completed_at"]:
+        with _upload_hashers_lock:
+            _upload_hashers.pop(upload_id, None)
+        discard_upload(db, up)
+    return jsonify({"ok": True})
+
+
+# -------------------------
+# File delivery: strong ETags, byte ranges, sendfile
+# -------------------------
+# Stored upload names are unique and never rewritten, so responses can be
+# cached for a year and revalidated by content hash. Whole-file bodies are
+# handed to the server's wsgi.file_wrapper (sendfile under gunicorn); set
+# USE_X_SENDFILE=1 to offload them to nginx/Apache instead.
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+MAX_RANGES = 16
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+
+# filename -> (owner id, sha256); entries never go stale except by delete.
+# Misses and rows not yet in the blob store are not cached: the name may be
+# uploaded or backfilled later, and a cached miss would keep answering 404.
+_private_file_meta = LRUCache(maxsize=10000)
+_public_file_meta = LRUCache(maxsize=10000)
+
+
+def private_file_meta(db, filename):
+    meta = _private_file_meta.get(filename)
+    if meta is None:
+        row = db.execute("SELECT user_id, sha256 FROM private_files WHERE file_name=?", (filename,)).fetchone()
+        if not row:
+            return None
+        meta = (row["user_id"], row["sha256"])
+        if row["sha256"]:
+            _private_file_meta.set(filename, meta)
+    return meta
+
+
+def public_file_sha256(db, filename):
+    """Content hash for a public library file or notification attachment."""
+    sha256 = _public_file_meta.get(filename)
+    if sha256 is None:
+        row = db.execute("SELECT sha256 FROM public_files WHERE file_name=?", (filename,)).fetchone()
+        if row is None:
+            row = db.execute("SELECT attachment_sha256 AS sha256 FROM notifications WHERE attachment=?", (filename,)).fetchone()
+        sha256 = row["sha256"] if row else None
+        if sha256:
+            _public_file_meta.set(filename, sha256)
+    return sha256 or None
+
+
+def resolve_ranges(rng, size):
+    """Werkzeug Range -> list of (start, end_exclusive); [] if unsatisfiable."""
+    out = []
+    for start, stop in rng.ranges[:MAX_RANGES]:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            out.append((start, stop))
+    return out
+
+
+def _read_range(fh, start, stop):
+    fh.seek(start)
+    remaining = stop - start
+    while remaining:
+        buf = fh.read(min(UPLOAD_READ_SIZE, remaining))
+        if not buf:
+            break
+        remaining -= len(buf)
+        yield buf
+
+
+def _file_body(path, start, stop, size):
+    fh = open(path, "rb")
+    if start == 0 and stop == size:
+        # whole file: let the server sendfile() it via wsgi.file_wrapper
+        return wrap_file(request.environ, fh)
+
+    def body():
+        with fh:
+            yield from _read_range(fh, start, stop)
+    return body()
+
+
+def _multipart_body(path, ranges, size, boundary, content_type):
+    with open(path, "rb") as fh:
+        for start, stop in ranges:
+            yield (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                   f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+            yield from _read_range(fh, start, stop)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+
+def send_upload(folder, filename, sha256=None, as_attachment=False, private=False):
+    """Serve a stored upload with conditional GET and (multi-)range support."""
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        return "Not found", 404
+
+    st = os.stat(path)
+    size = st.st_size
+    etag = sha256 or f"{st.st_ino:x}-{int(st.st_mtime):x}-{size:x}"
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    resp = app.response_class(status=200, direct_passthrough=True)
+    resp.set_etag(etag)
+    resp.last_modified = datetime.fromtimestamp(st.st_mtime)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers["Cache-Control"] = f"{'private' if private else 'public'}, max-age={UPLOAD_MAX_AGE}, immutable"
+    if as_attachment:
+        resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    if request.if_none_match.contains(etag):
+        resp.status_code = 304
+        return resp
+
+    ranges = None
+    if request.range and request.range.units == "bytes":
+        if_range = request.if_range
+        if not (if_range.etag or if_range.date) or if_range.etag == etag:
+            ranges = resolve_ranges(request.range, size)
+            if not ranges:
+                resp.status_code = 416
+                resp.headers["Content-Range"] = f"bytes */{size}"
+                return resp
+
+    if app.config["USE_X_SENDFILE"] and not ranges:
+        resp.headers["X-Sendfile"] = path
+        resp.content_type = content_type
+        resp.content_length = size
+        return resp
+
+    if ranges and len(ranges) > 1:
+        boundary = secrets.token_hex(12)
+        resp.status_code = 206
+        resp.content_type = f"multipart/byteranges; boundary={boundary}"
+        if request.method != "HEAD":
+            resp.response = _multipart_body(path, ranges, size, boundary, content_type)
+        return resp
+
+    start, stop = ranges[0] if ranges else (0, size)
+    if ranges:
+        resp.status_code = 206
+        resp.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    if request.method != "HEAD":
+        resp.response = _file_body(path, start, stop, size)
+    resp.content_type = content_type
+    resp.content_length = stop - start
+    return resp
+
+
 @app.route("/download/public/<filename>")
 @login_required
 def download_public(filename):
-    return send_from_directory(UPLOAD_PUBLIC, filename, as_attachment=True)
+    return send_upload(UPLOAD_PUBLIC, filename, public_file_sha256(get_db(), filename), as_attachment=True)
 
 
 @app.route("/download/private/<filename>")
 @login_required
 def download_private(filename):
-    # only allow if file belongs to current user or teacher (owner)
-    db = get_db()
-    row = db.execute("SELECT * FROM private_files WHERE file_name=?", (filename,)).fetchone()
-    if not row:
+    # only the owner may download a private file (teachers included)
+    meta = private_file_meta(get_db(), filename)
+    if not meta:
         return "Not found", 404
-    if session.get("role") == "teacher" and row["user_id"] != session["user_id"]:
-        # teachers cannot see student private files
-        return "Forbidden", 403
-    if session.get("role") == "student" and row["user_id"] != session["user_id"]:
+    owner_id, sha256 = meta
+    if owner_id != session["user_id"]:
         return "Forbidden", 403
-    personal_folder = os.path.join(UPLOAD_PRIVATE, str(row["user_id"]))
-    return send_from_directory(personal_folder, filename, as_attachment=True)
+    personal_folder = os.path.join(UPLOAD_PRIVATE, str(owner_id))
+    return send_upload(personal_folder, filename, sha256, as_attachment=True, private=True)
+
+
+def delete_library_file(db, kind, row):
+    """Remove a library file row and its stored copy. The caller commits."""
+    if kind == "public":
+        # the blob itself goes only with its last reference
+        remove_stored_file(db, os.path.join(UPLOAD_PUBLIC, row["file_name"]), row["sha256"])
+        _public_file_meta.pop(row["file_name"])
+    else:
+        personal_folder = os.path.join(UPLOAD_PRIVATE, str(row["user_id"]))
+        remove_stored_file(db, os.path.join(personal_folder, row["file_name"]), row["sha256"])
+        _private_file_meta.pop(row["file_name"])
+    db.execute(f"DELETE FROM {kind}_files WHERE id=?", (row["id"],))
+    log_library_change(db, kind, row["id"], row["teacher_id"] if kind == "public" else row["user_id"])
 
 
 # delete public file (teacher)
@@ -548,34 +3806,244 @@ def delete_public_file(file_id):
         return "not found", 404
     if row["teacher_id"] != session["user_id"]:
         return "forbidden", 403
-    # remove from disk
-    try:
-        os.remove(os.path.join(UPLOAD_PUBLIC, row["file_name"]))
-    except Exception:
-        pass
-    db.execute("DELETE FROM public_files WHERE id=?", (file_id,))
+    delete_library_file(db, "public", row)
+    db.commit()
+    return redirect(url_for("music_library"))
+
+
+# delete private file (owner)
+@app.route("/delete_private_file/<int:file_id>", methods=["POST"])
+@login_required
+def delete_private_file(file_id):
+    db = get_db()
+    row = db.execute("SELECT * FROM private_files WHERE id=?", (file_id,)).fetchone()
+    if not row:
+        return "not found", 404
+    if row["user_id"] != session["user_id"]:
+        return "forbidden", 403
+    delete_library_file(db, "private", row)
+    db.commit()
+    return redirect(url_for("music_library"))
+
+
+# -------------------------
+# Media derivatives (background job queue)
+# -------------------------
+# Uploads queue waveform / thumbnail / preview jobs in media_jobs, keyed by
+# blob hash so duplicate uploads share one set of derivatives. A dispatcher
+# thread claims jobs and runs media.run_job in a local process pool; the
+# upload request only inserts rows. With several web workers, set
+# MEDIA_WORKERS=0 and run `flask --app app media-worker` once instead.
+MEDIA_ROOT = os.path.join(APP_ROOT, "instance", "media")
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 1))    # pool processes; 0 = external worker
+MEDIA_MAX_ATTEMPTS = 3
+MEDIA_LEASE = 900               # seconds a claimed job stays locked to its worker
+MEDIA_POLL_INTERVAL = 2.0
+MEDIA_RETRY_DELAY = 30          # seconds, doubled on each failed attempt
+
+
+def media_path(sha256, kind):
+    return os.path.join(MEDIA_ROOT, sha256[:2], f"{sha256}.{media.EXTENSIONS[kind]}")
+
+
+def enqueue_media_jobs(db, sha256, file_type):
+    """Queue the derivatives for a stored blob. Re-queuing is a no-op. The caller commits."""
+    now = datetime.now().isoformat()
+    for kind in media.KINDS_BY_TYPE.get(file_type, ()):
+        db.execute("INSERT OR IGNORE INTO media_jobs (sha256, kind, file_type, created_at) VALUES (?, ?, ?, ?)",
+                   (sha256, kind, file_type, now))
+
+
+def remove_media(db, sha256):
+    """Drop a blob's derivatives once nothing references it any more."""
+    for row in db.execute("SELECT kind FROM media_jobs WHERE sha256=?", (sha256,)).fetchall():
+        try:
+            os.remove(media_path(sha256, row["kind"]))
+        except OSError:
+            pass
+    db.execute("DELETE FROM media_jobs WHERE sha256=?", (sha256,))
+
+
+def claim_media_jobs(conn, limit):
+    """Atomically lease up to `limit` runnable jobs (new, retrying, or abandoned)."""
+    now = time.time()
+    conn.execute("""
+        UPDATE media_jobs SET status='failed', error='worker lease expired', locked_until=NULL
+        WHERE status='running' AND locked_until < ? AND attempts >= ?
+    """, (now, MEDIA_MAX_ATTEMPTS))
+    rows = conn.execute("""
+        UPDATE media_jobs SET status='running', attempts=attempts + 1, locked_until=?
+        WHERE id IN (
+            SELECT id FROM media_jobs WHERE status='queued' AND run_after <= ?
+            UNION ALL
+            SELECT id FROM media_jobs WHERE status='running' AND locked_until < ?
+            LIMIT ?
+        )
+        RETURNING id, sha256, kind, file_type, attempts
+    """, (now + MEDIA_LEASE, now, now, limit)).fetchall()
+    conn.commit()
+    return rows
+
+
+def finish_media_job(conn, job, future):
+    error = future.exception()
+    now = datetime.now().isoformat()
+    if error is None:
+        conn.execute("UPDATE media_jobs SET status='done', size=?, error=NULL, locked_until=NULL, finished_at=? WHERE id=?",
+                     (future.result(), now, job["id"]))
+    elif isinstance(error, media.ToolMissing):
+        conn.execute("UPDATE media_jobs SET status='skipped', error=?, locked_until=NULL, finished_at=? WHERE id=?",
+                     (str(error), now, job["id"]))
+    elif job["attempts"] >= MEDIA_MAX_ATTEMPTS:
+        conn.execute("UPDATE media_jobs SET status='failed', error=?, locked_until=NULL, finished_at=? WHERE id=?",
+                     (repr(error)[:500], now, job["id"]))
+    else:
+        conn.execute("UPDATE media_jobs SET status='queued', error=?, locked_until=NULL, run_after=? WHERE id=?",
+                     (repr(error)[:500], time.time() + MEDIA_RETRY_DELAY * 2 ** (job["attempts"] - 1), job["id"]))
+    if error is None:
+        bump_data_versions(conn, "media")
+    conn.commit()
+
+
+class MediaWorker:
+    """Claims queued media jobs and runs them in a local process pool."""
+
+    def __init__(self, path, processes):
+        self.path = path
+        self.processes = processes
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if not self._started:
+                threading.Thread(target=self.run, name="media-worker", daemon=True).start()
+                self._started = True
+
+    def new_pool(self):
+        # spawn, not fork: the pool may start from a threaded web worker
+        return ProcessPoolExecutor(max_workers=self.processes,
+                                   mp_context=multiprocessing.get_context("spawn"))
+
+    def run(self, once=False):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=5000")
+        pool = self.new_pool()
+        try:
+            while True:
+                try:
+                    jobs = claim_media_jobs(conn, self.processes)
+                    if not jobs:
+                        if once:
+                            return
+                        time.sleep(MEDIA_POLL_INTERVAL)
+                        continue
+                    futures = {
+                        pool.submit(media.run_job, job["kind"], blob_path(job["sha256"]),
+                                    media_path(job["sha256"], job["kind"]), job["file_type"]): job
+                        for job in jobs
+                    }
+                    for future in as_completed(futures):
+                        finish_media_job(conn, futures[future], future)
+                    if any(isinstance(f.exception(), BrokenProcessPool) for f in futures):
+                        raise BrokenProcessPool("a media job process died")
+                except BrokenProcessPool:
+                    # a decoder crashed or was OOM-killed; its jobs were requeued
+                    # above (or get reclaimed when their lock expires)
+                    app.logger.exception("media worker pool broke; restarting it")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self.new_pool()
+                except Exception:
+                    conn.rollback()
+                    app.logger.exception("media worker failed; retrying")
+                    time.sleep(MEDIA_POLL_INTERVAL)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            conn.close()
+
+
+_media_worker = None
+_media_worker_lock = threading.Lock()
+
+
+def get_media_worker():
+    global _media_worker
+    if _media_worker is None or _media_worker.pid != os.getpid():
+        with _media_worker_lock:
+            if _media_worker is None or _media_worker.pid != os.getpid():
+                _media_worker = MediaWorker(DB_PATH, max(MEDIA_WORKERS, 1))
+    return _media_worker
+
+
+@app.before_request
+def start_media_worker():
+    if MEDIA_WORKERS > 0:
+        get_media_worker().start()
+
+
+@app.cli.command("media-worker")
+@click.option("--once", is_flag=True, help="Exit when the queue is empty.")
+def media_worker_command(once):
+    """Run queued media jobs in the foreground."""
+    worker = MediaWorker(DB_PATH, max(MEDIA_WORKERS, 1))
+    worker.run(once=once)
+
+
+@app.cli.command("requeue-media")
+@click.option("--skipped", is_flag=True, help="Also retry jobs skipped for a missing tool.")
+def requeue_media_command(skipped):
+    """Reset failed media jobs (e.g. after installing ffmpeg)."""
+    db = get_db()
+    statuses = ("failed", "skipped") if skipped else ("failed",)
+    cur = db.execute(f"UPDATE media_jobs SET status='queued', attempts=0, run_after=0, error=NULL "
+                     f"WHERE status IN ({','.join('?' * len(statuses))})", statuses)
     db.commit()
-    return redirect(url_for("music_library"))
+    print(f"{cur.rowcount} media job(s) requeued.")
 
 
-# delete private file (owner)
-@app.route("/delete_private_file/<int:file_id>", methods=["POST"])
+def media_urls(db, sha256s):
+    """{sha256: {kind: url}} for the finished derivatives of the given blobs."""
+    sha256s = [s for s in set(sha256s) if s]
+    out = {}
+    if not sha256s:
+        return out
+    rows = db.execute(f"SELECT sha256, kind FROM media_jobs WHERE status='done' AND sha256 IN ({','.join('?' * len(sha256s))})",
+                      sha256s).fetchall()
+    for r in rows:
+        out.setdefault(r["sha256"], {})[r["kind"]] = url_for("serve_media", sha256=r["sha256"], kind=r["kind"])
+    return out
+
+
+def library_json(db, rows, next_cursor):
+    media_by_sha = media_urls(db, [r["sha256"] for r in rows])
+    items = [dict(r, media=media_by_sha.get(r["sha256"], {})) for r in rows]
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+
+def media_visibility(db, sha256, user_id):
+    """'public', 'private' (caller owns a copy) or None if the caller can't see it."""
+    if db.execute("SELECT 1 FROM public_files WHERE sha256=? UNION ALL "
+                  "SELECT 1 FROM notifications WHERE attachment_sha256=? LIMIT 1", (sha256, sha256)).fetchone():
+        return "public"
+    if db.execute("SELECT 1 FROM private_files WHERE sha256=? AND user_id=?", (sha256, user_id)).fetchone():
+        return "private"
+    return None
+
+
+@app.route("/media/<sha256>/<kind>")
 @login_required
-def delete_private_file(file_id):
+def serve_media(sha256, kind):
+    if kind not in media.EXTENSIONS or len(sha256) != 64:
+        return "Not found", 404
     db = get_db()
-    row = db.execute("SELECT * FROM private_files WHERE id=?", (file_id,)).fetchone()
-    if not row:
-        return "not found", 404
-    if row["user_id"] != session["user_id"]:
-        return "forbidden", 403
-    try:
-        personal_folder = os.path.join(UPLOAD_PRIVATE, str(row["user_id"]))
-        os.remove(os.path.join(personal_folder, row["file_name"]))
-    except Exception:
-        pass
-    db.execute("DELETE FROM private_files WHERE id=?", (file_id,))
-    db.commit()
-    return redirect(url_for("music_library"))
+    visibility = media_visibility(db, sha256, session["user_id"])
+    if not visibility:
+        return "Not found", 404
+    path = media_path(sha256, kind)
+    return send_upload(os.path.dirname(path), os.path.basename(path), f"{sha256}-{kind}",
+                       private=visibility == "private")
 
 
 # -------------------------
@@ -585,12 +4053,38 @@ def delete_private_file(file_id):
 @login_required
 def notifications():
     db = get_db()
-    if session.get("role") == "teacher":
-        rows = db.execute("SELECT n.*, u.name as teacher_name FROM notifications n LEFT JOIN users u ON u.id=n.teacher_id WHERE n.teacher_id=? ORDER BY timestamp DESC", (session["user_id"],)).fetchall()
-    else:
-        # students see all teacher notifications
-        rows = db.execute("SELECT n.*, u.name as teacher_name FROM notifications n LEFT JOIN users u ON u.id=n.teacher_id ORDER BY timestamp DESC").fetchall()
-    return render_template("notifications.html", title="Notifications", active="notifications", notifications=rows)
+    if session.get("role") != "teacher":
+        mark_notifications_read(db, session["user_id"])
+
+    def build():
+        # teachers see their own notifications, students see all teacher notifications
+        if session.get("role") == "teacher":
+            rows, next_cursor = page_notifications(db, session["user_id"], *page_args())
+        else:
+            rows, next_cursor = cached_student_feed(db, *page_args())
+        return render_template("notifications.html", title="Notifications", active="notifications",
+                               notifications=rows, next_cursor=next_cursor)
+    return cached_response(["notifications"] + layout_scopes(), build)
+
+
+@app.route("/api/notifications")
+@login_required
+def api_notifications():
+    def build():
+        db = get_db()
+        if session.get("role") == "teacher":
+            return page_json(*page_notifications(db, session["user_id"], *page_args()))
+        items, next_cursor = cached_student_feed(db, *page_args())
+        return jsonify({"items": items, "next_cursor": next_cursor})
+    return cached_response(["notifications"], build)
+
+
+@app.route("/api/notifications/unread")
+@login_required
+def api_notifications_unread():
+    if session.get("role") != "student":
+        return jsonify({"unread": 0})
+    return jsonify({"unread": unread_count(get_db(), session["user_id"])})
 
 
 @app.route("/create_notification", methods=["POST"])
@@ -598,22 +4092,60 @@ def notifications():
 def create_notification():
     if session.get("role") != "teacher":
         return "forbidden", 403
-    title = request.form.get("title") or ""
-    message = request.form.get("message") or ""
     attach = request.files.get("attachment", None)
     filename = None
+    sha256 = None
     if attach and allowed_file(attach.filename):
         orig = secure_filename(attach.filename)
-        filename = f"{session['username']}_{int(datetime.now().timestamp())}_{orig}"
+        filename = make_save_name(session["username"], orig)
         p = os.path.join(UPLOAD_PUBLIC, filename)
-        attach.save(p)
-    db = get_db()
-    db.execute("INSERT INTO notifications (teacher_id, title, message, timestamp, attachment) VALUES (?,?,?,?,?)",
-               (session["user_id"], title, message, datetime.now().isoformat(), filename))
-    db.commit()
+        save_upload(attach, p)
+        sha256 = hash_file(p)
+    args = {
+        "teacher_id": session["user_id"],
+        "teacher_name": session.get("name"),
+        "title": request.form.get("title") or "",
+        "message": request.form.get("message") or "",
+        "timestamp": datetime.now().isoformat(),
+        "attachment": filename,
+        "sha256": sha256,
+    }
+    if not queue_write("create_notification", args):
+        get_broker().publish(apply_write(get_db(), "create_notification", args))
     return redirect(url_for("notifications"))
 
 
+def save_notification(db, teacher_id, teacher_name, title, message, timestamp, attachment, sha256):
+    """Insert a notification (adopting its already-saved attachment); returns the push event."""
+    if attachment:
+        adopt_blob(db, os.path.join(UPLOAD_PUBLIC, attachment), sha256)
+    cur = db.execute("INSERT INTO notifications (teacher_id, title, message, timestamp, attachment, attachment_sha256) VALUES (?,?,?,?,?,?)",
+                     (teacher_id, title, message, timestamp, attachment, sha256))
+    bump_feed_version(db)
+    return {
+        "id": cur.lastrowid,
+        "title": title,
+        "message": message,
+        "timestamp": timestamp,
+        "attachment": attachment,
+        "teacher_name": teacher_name,
+    }
+
+
+@app.route("/notifications/stream")
+@login_required
+def notifications_stream():
+    # deliberately no get_db(): an open stream must not hold a pooled connection
+    if session.get("role") != "student":
+        return "forbidden", 403
+    broker = get_broker()
+    q = broker.subscribe()
+    return app.response_class(sse_stream(broker, q), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
 @app.route("/edit_notification/<int:notif_id>", methods=["POST"])
 @login_required
 def edit_notification(notif_id):
@@ -626,6 +4158,7 @@ def edit_notification(notif_id):
     if not row or row["teacher_id"] != session["user_id"]:
         return "forbidden", 403
     db.execute("UPDATE notifications SET title=?, message=? WHERE id=?", (title, message, notif_id))
+    bump_feed_version(db)
     db.commit()
     return redirect(url_for("notifications"))
 
@@ -641,18 +4174,519 @@ def delete_notification(notif_id):
         return "forbidden", 403
     # delete attachment from disk if exists
     if row["attachment"]:
-        try:
-            os.remove(os.path.join(UPLOAD_PUBLIC, row["attachment"]))
-        except Exception:
-            pass
+        remove_stored_file(db, os.path.join(UPLOAD_PUBLIC, row["attachment"]), row["attachment_sha256"])
+        _public_file_meta.pop(row["attachment"])
     db.execute("DELETE FROM notifications WHERE id=?", (notif_id,))
+    bump_feed_version(db)
     db.commit()
     return redirect(url_for("notifications"))
 
 
 # -------------------------
-# Suggestions (simple rule-based)
+# Write-behind log (optional group-committed writes)
+# -------------------------
+# With WRITE_BEHIND=1, save_hours / delete_hours / add_error / add_note /
+# create_notification append their write to a local log, fsync it and answer
+# at once; one writer thread per process applies the log to SQLite in
+# batches of up to WRITE_BATCH_MAX, one transaction each, instead of every
+# request taking the write lock itself.
+#
+# Each process appends to its own segment file (held under flock while the
+# process lives). The byte offset applied from each segment is stored in
+# feed_state ('write_log:<segment>') in the same transaction as the writes,
+# so replaying a segment after a crash skips what was already applied. A
+# writer adopts segments whose flock is free (their process is gone) before
+# every batch it applies, so a dead process's last writes land before any
+# later write to the same rows. A segment is deleted once fully applied. Only
+# a busy/locked database is retried; a record failing any other way is
+# dropped so it can't wedge the log behind it.
+#
+# Read-your-writes: a queued write leaves (segment, offset) in a small signed
+# write_token cookie (not the session, whose row would then be rewritten on
+# every queued write), and the client's next request waits (up to WRITE_WAIT_TIMEOUT) until that
+# offset is applied. Further queued writes to the same segment skip the wait,
+# since a segment is applied in order.
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+WRITE_LOG_DIR = os.path.join(APP_ROOT, "instance", "write_log")
+WRITE_BATCH_MAX = 500           # records per transaction
+WRITE_LINGER = 0.005            # seconds the writer waits for a batch to fill
+WRITE_SEGMENT_BYTES = 16 * 1024 * 1024
+WRITE_WAIT_TIMEOUT = 5.0        # seconds a request waits for its session's writes
+WRITE_RETRY_DELAY = 0.5         # seconds before retrying a batch that hit a locked database
+WRITE_RECOVER_INTERVAL = 60     # idle seconds between cleanups of stale segment offsets
+WRITE_TOKEN_COOKIE = "write_token"
+
+# op -> function(db, **args); practice ops also refresh the student's suggestions
+WRITE_OPS = {
+    "save_hours": save_practice_entry,
+    "delete_hours": delete_practice_entry,
+    "add_error": save_error,
+    "add_note": save_note,
+    "create_notification": save_notification,
+}
+PRACTICE_OPS = ("save_hours", "delete_hours")
+
+
+def apply_write(db, op, args):
+    """Apply one write and commit (the path every write takes with write-behind off)."""
+    result = WRITE_OPS[op](db, **args)
+    if op in PRACTICE_OPS and result:
+        refresh_suggestions(db, args["user_id"])
+    db.commit()
+    return result
+
+
+def queue_write(op, args):
+    """Log the write for the writer thread; False when write-behind is off."""
+    if not WRITE_BEHIND:
+        return False
+    g.write_token = get_write_log().append(op, args)
+    return True
+
+
+def write_token_signer():
+    return URLSafeSerializer(app.secret_key, salt="write-token")
+
+
+def is_busy_error(e):
+    """True for the transient SQLITE_BUSY / SQLITE_LOCKED errors worth retrying."""
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(e) or "busy" in str(e)
+
+
+class LogSegment:
+    def __init__(self, name, fd, size=0):
+        self.name = name
+        self.fd = fd
+        self.size = size
+
+
+class WriteBehindLog:
+    """The process's append log plus the thread that applies it."""
+
+    def __init__(self, path, directory):
+        self.path = path
+        self.directory = directory
+        self.pid = os.getpid()
+        self._lock = threading.Lock()           # appends
+        self._applied = threading.Condition()   # guards self.offsets
+        self._queue = queue.Queue()
+        self._segment = None
+        self._started = False
+        self.offsets = {}       # own segment -> bytes applied (None once retired)
+        self.appended = 0
+        self.applied = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.max_depth = 0
+        self.recovered = 0
+
+    def start(self):
+        with self._lock:
+            if not self._started:
+                os.makedirs(self.directory, exist_ok=True)
+                threading.Thread(target=self.run, name="write-behind", daemon=True).start()
+                self._started = True
+
+    def _open_segment(self):
+        name = f"{self.pid}-{time.time_ns()}.log"
+        fd = os.open(os.path.join(self.directory, name), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with self._applied:
+            self.offsets[name] = 0
+        return LogSegment(name, fd)
+
+    def append(self, op, args):
+        """Durably log one write; returns the (segment, offset) token to wait on."""
+        self.start()
+        line = (json.dumps({"op": op, "args": args}, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            seg = self._segment
+            if seg is None or seg.size >= WRITE_SEGMENT_BYTES:
+                if seg is not None:
+                    self._queue.put((seg, None, None, None))    # retire once applied
+                seg = self._segment = self._open_segment()
+            os.write(seg.fd, line)
+            os.fdatasync(seg.fd)
+            seg.size += len(line)
+            self.appended += 1
+            self._queue.put((seg, seg.size, op, args))
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+            return [seg.name, seg.size]
+
+    def owns(self, name):
+        with self._applied:
+            return name in self.offsets
+
+    def wait_for(self, db, token, timeout=WRITE_WAIT_TIMEOUT):
+        """Block until the write behind `token` is in SQLite; False on timeout."""
+        name, offset = token
+        deadline = time.monotonic() + timeout
+        with self._applied:
+            if name in self.offsets:
+                return self._applied.wait_for(
+                    lambda: self.offsets[name] is None or self.offsets[name] >= offset,
+                    timeout)
+        # another process's segment: poll its applied offset
+        while True:
+            row = db.execute("SELECT version FROM feed_state WHERE name=?", (f"write_log:{name}",)).fetchone()
+            if row and row["version"] >= offset:
+                return True
+            if not row and not os.path.exists(os.path.join(self.directory, name)):
+                return True     # fully applied and retired
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+
+    def run(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        last_cleanup = 0.0
+        while True:
+            try:
+                if time.monotonic() - last_cleanup >= WRITE_RECOVER_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    self.recover(conn)
+                    self.forget_stale_offsets(conn)
+                try:
+                    batch = [self._queue.get(timeout=WRITE_RECOVER_INTERVAL)]
+                except queue.Empty:
+                    continue
+                deadline = time.monotonic() + WRITE_LINGER
+                while len(batch) < WRITE_BATCH_MAX:
+                    try:
+                        batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                    except queue.Empty:
+                        break
+                # orphans hold older writes than anything in this batch
+                self.recover(conn)
+                self.apply(conn, batch)
+            except Exception:
+                app.logger.exception("write-behind writer failed; retrying")
+                time.sleep(WRITE_RETRY_DELAY)
+
+    def apply(self, conn, batch):
+        """Apply a batch in one transaction, retrying while the database is locked."""
+        while True:
+            try:
+                events = self._apply_once(conn, batch)
+                break
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                if not is_busy_error(e):
+                    raise
+                self.retries += 1
+                time.sleep(WRITE_RETRY_DELAY)
+        writes = sum(1 for _, _, op, _ in batch if op)
+        with self._applied:
+            for seg, offset, op, _ in batch:
+                if op and seg.name in self.offsets:
+                    self.offsets[seg.name] = offset
+            if writes:
+                self.applied += writes
+                self.batches += 1
+                self.last_batch = writes
+                self.max_batch = max(self.max_batch, writes)
+            self._applied.notify_all()
+        for event in events:
+            get_broker().publish(event)
+        for seg, _, op, _ in batch:
+            if op is None:
+                self.retire(conn, seg)
+
+    def _apply_once(self, conn, batch):
+        conn.execute("BEGIN IMMEDIATE")
+        offsets, students, events = {}, set(), []
+        for seg, offset, op, args in batch:
+            if op is None:
+                continue
+            offsets[seg.name] = offset
+            conn.execute("SAVEPOINT write_op")
+            try:
+                result = WRITE_OPS[op](conn, **args)
+            except sqlite3.OperationalError as e:
+                if is_busy_error(e):
+                    raise
+                conn.execute("ROLLBACK TO write_op")
+                self.failed += 1
+                app.logger.exception("write-behind: dropping %s record", op)
+                continue
+            except Exception:
+                # a record that can never apply must not wedge the log behind it
+                conn.execute("ROLLBACK TO write_op")
+                self.failed += 1
+                app.logger.exception("write-behind: dropping %s record", op)
+                continue
+            finally:
+                conn.execute("RELEASE write_op")
+            if op in PRACTICE_OPS and result:
+                students.add(args["user_id"])
+            elif op == "create_notification":
+                events.append(result)
+        if students:
+            refresh_suggestions_many(conn, sorted(students))
+        conn.executemany("""
+            INSERT INTO feed_state (name, version) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET version=excluded.version
+        """, [(f"write_log:{name}", offset) for name, offset in offsets.items()])
+        conn.commit()
+        return events
+
+    def retire(self, conn, seg):
+        """Drop a fully applied segment: file first, so a waiter never sees neither."""
+        os.remove(os.path.join(self.directory, seg.name))
+        os.close(seg.fd)
+        conn.execute("DELETE FROM feed_state WHERE name=?", (f"write_log:{seg.name}",))
+        conn.commit()
+        with self._applied:
+            if seg.name in self.offsets:
+                self.offsets[seg.name] = None
+            self._applied.notify_all()
+
+    def recover(self, conn):
+        """Replay segments left behind by processes that have exited."""
+        for name in sorted(n for n in os.listdir(self.directory) if n.endswith(".log")):
+            if self.owns(name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)    # its process is still writing it
+                continue
+            row = conn.execute("SELECT version FROM feed_state WHERE name=?", (f"write_log:{name}",)).fetchone()
+            offset = row["version"] if row else 0
+            seg = LogSegment(name, fd, offset)
+            batch = []
+            with open(path, "rb") as fh:
+                fh.seek(offset)
+                for line in fh:
+                    try:
+                        record = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        break       # torn final append: it was never acknowledged
+                    offset += len(line)
+                    batch.append((seg, offset, record["op"], record["args"]))
+                    if len(batch) >= WRITE_BATCH_MAX:
+                        self.apply(conn, batch)
+                        self.recovered += len(batch)
+                        batch = []
+            self.recovered += len(batch)
+            self.apply(conn, batch + [(seg, None, None, None)])
+
+    def forget_stale_offsets(self, conn):
+        """Delete applied offsets of segments that no longer exist."""
+        names = set(os.listdir(self.directory))
+        stale = [r["name"] for r in conn.execute("SELECT name FROM feed_state WHERE name LIKE 'write\\_log:%' ESCAPE '\\'")
+                 if r["name"][len("write_log:"):] not in names]
+        conn.executemany("DELETE FROM feed_state WHERE name=?", [(n,) for n in stale])
+        conn.commit()
+
+    def stats(self):
+        with self._applied:
+            return {
+                "enabled": WRITE_BEHIND,
+                "depth": self._queue.qsize(),
+                "max_depth": self.max_depth,
+                "appended": self.appended,
+                "applied": self.applied,
+                "failed": self.failed,
+                "recovered": self.recovered,
+                "retries": self.retries,
+                "batches": self.batches,
+                "last_batch": self.last_batch,
+                "max_batch": self.max_batch,
+                "mean_batch": round(self.applied / self.batches, 2) if self.batches else 0,
+                "segments": sum(1 for v in self.offsets.values() if v is not None),
+            }
+
+
+_write_log = None
+_write_log_lock = threading.Lock()
+
+
+def get_write_log():
+    global _write_log
+    if _write_log is None or _write_log.pid != os.getpid():
+        with _write_log_lock:
+            if _write_log is None or _write_log.pid != os.getpid():
+                _write_log = WriteBehindLog(DB_PATH, WRITE_LOG_DIR)
+    return _write_log
+
+
+@app.before_request
+def await_session_writes():
+    if WRITE_BEHIND:
+        get_write_log().start()
+    raw = request.cookies.get(WRITE_TOKEN_COOKIE)
+    if not raw or request.endpoint == "static":
+        return
+    try:
+        name, offset = write_token_signer().loads(raw)
+    except (BadSignature, TypeError, ValueError):
+        g.write_token = None        # unreadable: drop it
+        return
+    log = get_write_log()
+    if request.endpoint in WRITE_OPS and log.owns(name):
+        return      # queued behind the earlier write on the same segment
+    if log.wait_for(get_db(), (name, offset)):
+        g.write_token = None
+
+
+@app.after_request
+def set_write_token_cookie(response):
+    if "write_token" not in g:
+        return response
+    if g.write_token is None:
+        response.delete_cookie(WRITE_TOKEN_COOKIE, httponly=True, samesite="Lax")
+    else:
+        response.set_cookie(WRITE_TOKEN_COOKIE, write_token_signer().dumps(list(g.write_token)),
+                            httponly=True, samesite="Lax")
+    return response
+
+
+@app.route("/api/write_queue")
+@login_required
+def api_write_queue():
+    if session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(get_write_log().stats())
+
+
+# -------------------------
+# Suggestions (rule engine, persisted)
 # -------------------------
+# Suggestions come from declarative rules (see rules.py): the built-in
+# rules.DEFAULT_RULES plus whatever teachers store in suggestion_rules. The
+# enabled set is compiled once per process and recompiled when the
+# 'suggestion_rules' version in feed_state moves. Features are extracted
+# from practice_entries (technique counts from practice_technique_monthly,
+# kept alongside the rollups) in one pass per batch of students, so a single
+# student's refresh after a save and the nightly batch share the same code.
+# Results are stored in `suggestions` with the rules version they were
+# computed under; the page refreshes rows computed on an earlier day or
+# under older rules, and `flask refresh-suggestions` recomputes every student.
+SUGGESTION_BATCH = 2000         # students per task in the nightly batch
+RULE_NAME_MAX = 100
+RULE_PREVIEW_STUDENTS = 5000    # students evaluated per preview request
+
+_ruleset_lock = threading.Lock()
+_ruleset_cache = {"version": None, "ruleset": None}
+
+
+def get_rules_version(db):
+    row = db.execute("SELECT version FROM feed_state WHERE name='suggestion_rules'").fetchone()
+    return row["version"] if row else 0
+
+
+def active_ruleset(db):
+    """Built-in plus enabled teacher rules, compiled once per rules version."""
+    version = get_rules_version(db)
+    with _ruleset_lock:
+        if _ruleset_cache["version"] == version:
+            return _ruleset_cache["ruleset"]
+    compiled = [rules.compile_rule(rule, rule["name"]) for rule in rules.DEFAULT_RULES]
+    for r in db.execute("SELECT id, definition FROM suggestion_rules WHERE enabled=1 ORDER BY id"):
+        try:
+            compiled.append(rules.compile_rule(json.loads(r["definition"]), f"rule:{r['id']}"))
+        except ValueError as e:
+            app.logger.warning("suggestion rule %s skipped: %s", r["id"], e)
+    ruleset = rules.RuleSet(compiled)
+    with _ruleset_lock:
+        _ruleset_cache.update(version=version, ruleset=ruleset)
+    return ruleset
+
+
+def compute_suggestions_many(db, user_ids, today=None, ruleset=None):
+    """[(kind, title, text)] per student for a sorted list of ids, from one query."""
+    if not user_ids:
+        return []
+    today = today or date.today()
+    ruleset = ruleset or active_ruleset(db)
+    start = (today - timedelta(days=ruleset.window - 1)).isoformat()
+    cur = db.cursor()
+    cur.row_factory = None      # plain tuples; Row objects dominate large batches
+    rows = cur.execute(
+        "SELECT user_id, date, hours, technique FROM practice_entries "
+        "WHERE user_id BETWEEN ? AND ? AND date BETWEEN ? AND ?",
+        (user_ids[0], user_ids[-1], start, today.isoformat())
+    )
+    counts = ()
+    if ruleset.top_months:
+        first_month = today.year * 12 + today.month - ruleset.top_months[-1]
+        counts = db.execute(
+            "SELECT user_id, month, technique, entries FROM practice_technique_monthly "
+            "WHERE user_id BETWEEN ? AND ? AND month >= ?",
+            (user_ids[0], user_ids[-1], f"{first_month // 12:04d}-{first_month % 12 + 1:02d}")
+        ).fetchall()
+    features, text = ruleset.extract(user_ids, rows, today, counts)
+    return ruleset.evaluate(user_ids, features, text)
+
+
+def compute_suggestions(db, user_id, today=None):
+    """Return [(kind, title, text)] for one student."""
+    return compute_suggestions_many(db, [user_id], today)[0]
+
+
+def store_suggestions(db, user_ids, results, rules_version):
+    """Replace the stored suggestions of each student. The caller commits."""
+    now = datetime.now().isoformat()
+    db.executemany("DELETE FROM suggestions WHERE user_id=?", [(u,) for u in user_ids])
+    db.executemany("INSERT INTO suggestions (user_id, kind, title, suggestion, timestamp, rules_version) "
+                   "VALUES (?, ?, ?, ?, ?, ?)",
+                   [(u, kind, title, text, now, rules_version)
+                    for u, out in zip(user_ids, results) for kind, title, text in out])
+
+
+def refresh_suggestions_many(db, user_ids, today=None):
+    """Recompute and store suggestions for a sorted list of students. The caller commits."""
+    # read before computing: a rules change in between leaves the rows stale, not wrongly fresh
+    version = get_rules_version(db)
+    store_suggestions(db, user_ids, compute_suggestions_many(db, user_ids, today), version)
+
+
+def refresh_suggestions(db, user_id, today=None):
+    """Recompute and store one student's suggestions. The caller commits."""
+    refresh_suggestions_many(db, [user_id], today)
+
+
+def _refresh_suggestions_chunk(user_ids):
+    """Nightly batch task; runs in a worker process with its own connection."""
+    conn = sqlite3.connect(DB_PATH, timeout=60)
+    conn.row_factory = sqlite3.Row
+    try:
+        refresh_suggestions_many(conn, user_ids)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(user_ids)
+
+
+@app.cli.command("refresh-suggestions")
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True, help="Worker processes.")
+def refresh_suggestions_command(workers):
+    """Recompute every student's suggestions (run nightly)."""
+    ids = [r["id"] for r in get_db().execute("SELECT id FROM users WHERE role='student' ORDER BY id")]
+    chunks = [ids[i:i + SUGGESTION_BATCH] for i in range(0, len(ids), SUGGESTION_BATCH)]
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=max(workers, 1), mp_context=multiprocessing.get_context(method)) as pool:
+        done = sum(pool.map(_refresh_suggestions_chunk, chunks))
+    print(f"Suggestions refreshed for {done} student(s).")
+
+
 @app.route("/suggestions")
 @login_required
 def suggestions():
@@ -660,51 +4694,382 @@ def suggestions():
         return redirect(url_for("dashboard_teacher"))
     user_id = session["user_id"]
     db = get_db()
+    sql = "SELECT title, suggestion, timestamp, rules_version FROM suggestions WHERE user_id=? ORDER BY id"
+    rows = db.execute(sql, (user_id,)).fetchall()
+    if not rows or (rows[0]["timestamp"] or "")[:10] != date.today().isoformat() \
+            or rows[0]["rules_version"] != get_rules_version(db):
+        refresh_suggestions(db, user_id)
+        db.commit()
+        rows = db.execute(sql, (user_id,)).fetchall()
+    suggestions_list = [(r["title"], r["suggestion"]) for r in rows]
+    return render_template("suggestions.html", title="Smart Suggestions", active="suggestions", suggestions=suggestions_list)
 
-    # compute simple signals
-    rows = db.execute("SELECT date, hours, technique FROM practice_entries WHERE user_id=? ORDER BY date DESC LIMIT 30", (user_id,)).fetchall()
-    suggestions_list = []
 
-    # 1) Consistency: compare last 7 days vs previous 7 days
-    def sum_range(rows_list):
-        s = 0
-        for r in rows_list:
-            try:
-                s += float(r["hours"] or 0)
-            except Exception:
-                pass
-        return s
+# Teacher-defined rules (JSON API)
+#   GET    /api/suggestion_rules            built-in rules and the caller's own
+#   POST   /api/suggestion_rules            {name?, rule, enabled?}
+#   PUT    /api/suggestion_rules/<id>       same body; replaces the rule
+#   DELETE /api/suggestion_rules/<id>
+#   POST   /api/suggestion_rules/preview    {rule, after?, limit?} -> how many students
+#                                           (one page of ids, or the rule's cohort) it fires for
+# Any change bumps the rules version; stored suggestions from an older
+# version are recomputed on the student's next visit (or by the nightly
+# batch), so a change costs nothing up front.
+def suggestion_rule_json(r):
+    return {"id": r["id"], "name": r["name"], "enabled": bool(r["enabled"]),
+            "rule": json.loads(r["definition"]), "updated_at": r["updated_at"]}
+
+
+def parse_suggestion_rule(data):
+    """Validate a request body; returns (name, definition JSON, enabled)."""
+    rule = data.get("rule")
+    rules.compile_rule(rule)
+    name = str(data.get("name") or rule.get("name") or rule["title"]).strip()[:RULE_NAME_MAX]
+    return name, json.dumps(rule), 1 if data.get("enabled", True) else 0
+
+
+def rules_changed(db):
+    db.execute("UPDATE feed_state SET version=version+1 WHERE name='suggestion_rules'")
+
+
+@app.route("/api/suggestion_rules", methods=["GET", "POST"])
+@login_required
+def suggestion_rules_api():
+    if session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    db = get_db()
+    if request.method == "GET":
+        rows = db.execute("SELECT * FROM suggestion_rules WHERE teacher_id=? ORDER BY id", (session["user_id"],))
+        return jsonify({"builtin": rules.DEFAULT_RULES, "rules": [suggestion_rule_json(r) for r in rows]})
+    try:
+        name, definition, enabled = parse_suggestion_rule(request.get_json(silent=True) or {})
+    except rules.RuleError as e:
+        return jsonify({"error": str(e)}), 400
+    cur = db.execute(
+        "INSERT INTO suggestion_rules (teacher_id, name, definition, enabled, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (session["user_id"], name, definition, enabled, datetime.now().isoformat())
+    )
+    rules_changed(db)
+    db.commit()
+    row = db.execute("SELECT * FROM suggestion_rules WHERE id=?", (cur.lastrowid,)).fetchone()
+    return jsonify(suggestion_rule_json(row)), 201
+
+
+@app.route("/api/suggestion_rules/<int:rule_id>", methods=["PUT", "DELETE"])
+@login_required
+def suggestion_rule_api(rule_id):
+    if session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    db = get_db()
+    row = db.execute("SELECT * FROM suggestion_rules WHERE id=? AND teacher_id=?", (rule_id, session["user_id"])).fetchone()
+    if not row:
+        return jsonify({"error": "not found"}), 404
+    if request.method == "DELETE":
+        db.execute("DELETE FROM suggestion_rules WHERE id=?", (rule_id,))
+        rules_changed(db)
+        db.commit()
+        return "", 204
+    try:
+        name, definition, enabled = parse_suggestion_rule(request.get_json(silent=True) or {})
+    except rules.RuleError as e:
+        return jsonify({"error": str(e)}), 400
+    db.execute("UPDATE suggestion_rules SET name=?, definition=?, enabled=?, updated_at=? WHERE id=?",
+               (name, definition, enabled, datetime.now().isoformat(), rule_id))
+    rules_changed(db)
+    db.commit()
+    row = db.execute("SELECT * FROM suggestion_rules WHERE id=?", (rule_id,)).fetchone()
+    return jsonify(suggestion_rule_json(row))
+
 
-    last_7 = rows[:7]
-    prev_7 = rows[7:14]
-    s_last = sum_range(last_7)
-    s_prev = sum_range(prev_7)
-    if s_prev > 0:
-        pct = ((s_last - s_prev) / s_prev) * 100
-        if pct >= 10:
-            suggestions_list.append(("Consistency improved", f"Your practice time increased by {int(pct)}% vs previous week."))
-        elif pct <= -10:
-            suggestions_list.append(("Consistency drop", f"Your practice time dropped by {int(abs(pct))}% vs previous week. Try 3 short sessions."))
-    elif s_last > 0:
-        suggestions_list.append(("New streak", "Nice job starting a consistent practice! Keep going."))
-
-    # 2) Weak area detection (technique keyword frequency)
+@app.route("/api/suggestion_rules/preview", methods=["POST"])
+@login_required
+def suggestion_rule_preview():
+    if session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        rule = rules.compile_rule(data.get("rule"))
+        after = int(data.get("after") or 0)
+        limit = max(1, min(int(data.get("limit") or RULE_PREVIEW_STUDENTS), RULE_PREVIEW_STUDENTS))
+    except rules.RuleError as e:
+        return jsonify({"error": str(e)}), 400
+    except (TypeError, ValueError):
+        return jsonify({"error": "after and limit must be integers"}), 400
+    db = get_db()
+    if rule.students is not None:
+        cohort = [int(u) for u in rule.students if u > after][:limit]
+        ids = [r["id"] for r in db.execute(
+            f"SELECT id FROM users WHERE role='student' AND id IN ({','.join('?' * len(cohort))}) ORDER BY id",
+            cohort)] if cohort else []
+    else:
+        ids = [r["id"] for r in db.execute(
+            "SELECT id FROM users WHERE role='student' AND id > ? ORDER BY id LIMIT ?", (after, limit))]
+    results = compute_suggestions_many(db, ids, ruleset=rules.RuleSet([rule]))
+    matched = [(u, out[0]) for u, out in zip(ids, results) if out[0][0] != "on_track"]
+    return jsonify({"students": len(ids), "matched": len(matched),
+                    "next_after": ids[-1] if len(ids) == limit else None,
+                    "sample": [{"user_id": u, "title": title, "message": text} for u, (_, title, text) in matched[:10]]})
+
+
+# -------------------------
+# Analytics (single-pass aggregation over a student's history)
+# -------------------------
+ANALYTICS_HEATMAP_SIZE = 8
+
+
+def compute_analytics(db, user_id, today=None):
+    """Compute every analytics-page figure from one ordered cursor pass.
+
+    practice_entries, errors and special_notes are merged into a single
+    date-ordered stream and folded into running totals, so time is O(rows)
+    and memory is O(1) apart from the technique counter (bounded by the
+    number of distinct techniques, not by history length). Streaks come
+    from the practice-day bitset.
+    """
+    today = today or date.today()
+    cur_month = today.isoformat()[:7]
+
+    total_hours = 0.0
+    total_notes = 0
+    total_errors = 0
+    month_key = None
+    month_sum = 0.0
+    months_seen = 0
+    best_month = None
+    best_month_hours = 0.0
+    cur_month_hours = 0.0
+    cur_month_days = 0
     tech_freq = {}
-    for r in rows:
-        t = (r["technique"] or "").strip().lower()
-        if not t:
+
+    cursor = db.execute("""
+        SELECT 'p' AS kind, date, hours, technique, notes FROM practice_entries WHERE user_id=?
+        UNION ALL
+        SELECT 'e', date, NULL, NULL, NULL FROM errors WHERE user_id=?
+        UNION ALL
+        SELECT 'n', date, NULL, NULL, NULL FROM special_notes WHERE user_id=?
+        ORDER BY date
+    """, (user_id, user_id, user_id))
+
+    for kind, day, hours, technique, notes in cursor:
+        if kind == "e":
+            total_errors += 1
+            continue
+        if kind == "n":
+            total_notes += 1
             continue
-        tech_freq[t] = tech_freq.get(t, 0) + 1
-    if tech_freq:
-        top = max(tech_freq.items(), key=lambda x: x[1])
-        suggestions_list.append(("Focus area", f"You've practiced '{top[0]}' {top[1]} times recently — consider drilling it deliberately."))
 
-    # 3) Low practice alert
-    total_30 = sum_range(rows)
-    if total_30 < 2:
-        suggestions_list.append(("Low practice", "You practiced less than 2 hours in the last 30 recorded sessions. Try a 10-minute daily goal."))
+        if notes:
+            total_notes += 1
+        h = float(hours or 0)
+        total_hours += h
 
-    return render_template("suggestions.html", title="Smart Suggestions", active="suggestions", suggestions=suggestions_list)
+        # month buckets arrive in order, so only the open one is kept
+        m = day[:7]
+        if m != month_key:
+            if month_key is not None and month_sum > best_month_hours:
+                best_month, best_month_hours = month_key, month_sum
+            month_key, month_sum = m, 0.0
+            months_seen += 1
+        month_sum += h
+        if m == cur_month:
+            cur_month_hours += h
+            cur_month_days += 1
+
+        t = (technique or "").strip().lower()
+        if t:
+            tech_freq[t] = tech_freq.get(t, 0) + 1
+
+    if month_key is not None and month_sum > best_month_hours:
+        best_month, best_month_hours = month_key, month_sum
+
+    longest_streak, _ = practice_streaks(*load_practice_days(db, user_id), today)
+    heatmap = sorted(tech_freq.items(), key=lambda x: (-x[1], x[0]))[:ANALYTICS_HEATMAP_SIZE]
+    days_in_month = ((today.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)).day
+
+    return {
+        "total_hours_alltime": round(total_hours, 2),
+        "best_month": round(best_month_hours, 2),
+        "best_month_label": best_month or "—",
+        "avg_monthly_hours": round(total_hours / months_seen, 2) if months_seen else 0,
+        "total_notes_alltime": total_notes,
+        "total_errors_alltime": total_errors,
+        "month_name": today.strftime("%B"),
+        "year": today.year,
+        "month_hours": round(cur_month_hours, 2),
+        "avg_per_day": round(cur_month_hours / cur_month_days, 2) if cur_month_days else 0,
+        "days_practiced": cur_month_days,
+        "days_in_month": days_in_month,
+        "longest_streak": longest_streak,
+        "heatmap": heatmap,
+        "max_heat_score": heatmap[0][1] if heatmap else 0,
+        "chart_days": 30,
+    }
+
+
+def compute_weekly_categories(db, user_id, today=None, days=7):
+    """Per-technique totals for the last `days` days, in one cursor pass."""
+    today = today or date.today()
+    start = today - timedelta(days=days - 1)
+    daily = {(start + timedelta(days=i)).isoformat(): 0.0 for i in range(days)}
+    cats = {}
+    total = 0.0
+
+    cursor = db.execute(
+        "SELECT date, hours, technique FROM practice_entries WHERE user_id=? AND date BETWEEN ? AND ?",
+        (user_id, start.isoformat(), today.isoformat())
+    )
+    for day, hours, technique in cursor:
+        h = float(hours or 0)
+        total += h
+        daily[day] = daily.get(day, 0.0) + h
+        name = (technique or "").strip().lower() or "uncategorized"
+        c = cats.setdefault(name, [0.0, 0])
+        c[0] += h
+        c[1] += 1
+
+    categories = [
+        {
+            "name": name,
+            "hours": round(h, 2),
+            "sessions": n,
+            "avg": round(h / n, 2) if n else 0,
+            "pct": round(h / total * 100, 1) if total else 0,
+        }
+        for name, (h, n) in sorted(cats.items(), key=lambda x: -x[1][0])
+    ]
+    return {"categories": categories, "daily": daily, "total_week": round(total, 2)}
+
+
+@app.route("/analytics")
+@login_required
+def analytics():
+    if session.get("role") != "student":
+        return redirect(url_for("dashboard_teacher"))
+    user_id = session["user_id"]
+
+    def build():
+        stats = compute_analytics(get_db(), user_id)
+        return render_template("analytics.html", title="Analytics", active="analytics", **stats)
+    return cached_response([f"practice:{user_id}", f"errors:{user_id}", f"notes:{user_id}"] + layout_scopes(), build)
+
+
+# -------------------------
+# Teacher cohort analytics (vectorized over all students at once)
+# -------------------------
+ENTRY_DTYPE = np.dtype([("user_id", "i8"), ("day", "i4"), ("hours", "f8")])
+
+
+def load_practice_columns(db):
+    """Load practice_entries once as columnar arrays sorted by (user_id, day).
+
+    `day` is a proleptic Gregorian ordinal, the same as date.toordinal().
+    """
+    cursor = db.execute("""
+        SELECT user_id, CAST(julianday(date) - 1721424.5 AS INTEGER), COALESCE(hours, 0)
+        FROM practice_entries
+        ORDER BY user_id, date
+    """)
+    return np.fromiter((tuple(r) for r in cursor), dtype=ENTRY_DTYPE)
+
+
+def compute_cohort_metrics(entries, student_ids, today=None):
+    """Per-student totals, streaks, week-over-week deltas and percentiles.
+
+    `entries` comes from load_practice_columns(); `student_ids` is a sorted
+    int array of every student to report on (students with no entries get
+    zeros). Every metric is a grouped NumPy reduction - no per-student loop.
+    """
+    today_ord = (today or date.today()).toordinal()
+    n = len(student_ids)
+    uid, day, hours = entries["user_id"], entries["day"], entries["hours"]
+
+    # rows are sorted by user, so resolve slots once per user, not per row
+    user_start = np.flatnonzero(np.r_[True, uid[1:] != uid[:-1]]) if len(uid) else np.zeros(0, dtype=np.int64)
+    users = uid[user_start]
+    user_slot = np.minimum(np.searchsorted(student_ids, users), max(n - 1, 0))
+    is_student = (student_ids[user_slot] == users) if n else np.zeros(len(users), dtype=bool)
+    counts = np.diff(np.r_[user_start, len(uid)])
+    if not is_student.all():
+        keep = np.repeat(is_student, counts)
+        day, hours = day[keep], hours[keep]
+        counts, user_slot = counts[is_student], user_slot[is_student]
+        user_start = np.r_[0, np.cumsum(counts)[:-1]] if len(counts) else user_start[:0]
+    slot = np.repeat(user_slot, counts)
+
+    total = np.zeros(n)
+    days_practiced = np.zeros(n, dtype=np.int64)
+    if len(slot):
+        total[user_slot] = np.add.reduceat(hours, user_start)
+        days_practiced[user_slot] = counts
+    # only the last two weeks matter here, so reduce over that subset
+    recent = np.flatnonzero(day > today_ord - 14)
+    age = today_ord - day[recent]
+    this_week = np.bincount(slot[recent], weights=hours[recent] * ((age >= 0) & (age < 7)), minlength=n)
+    last_week = np.bincount(slot[recent], weights=hours[recent] * (age >= 7), minlength=n)
+    delta = this_week - last_week
+    delta_pct = np.divide(delta * 100, last_week, out=np.zeros(n), where=last_week > 0)
+
+    longest = np.zeros(n, dtype=np.int64)
+    current = np.zeros(n, dtype=np.int64)
+    if len(slot):
+        # a run starts wherever the user changes or the day gap isn't 1
+        new_user = np.zeros(len(slot), dtype=bool)
+        new_user[user_start] = True
+        run_start = new_user | np.r_[True, np.diff(day) != 1]
+        run_id = np.cumsum(run_start) - 1
+        run_len = np.bincount(run_id)
+        longest[user_slot] = np.maximum.reduceat(run_len, run_id[user_start])
+
+        last_row = np.r_[user_start[1:] - 1, len(slot) - 1]
+        live = day[last_row] >= today_ord - 1
+        current[user_slot[live]] = run_len[run_id[last_row[live]]]
+
+    # percentile rank of all-time total (mid-rank for ties)
+    ranked = np.sort(total)
+    below = np.searchsorted(ranked, total, side="left")
+    at_or_below = np.searchsorted(ranked, total, side="right")
+    percentile = (below + at_or_below) * 50.0 / max(n, 1)
+
+    return {
+        "user_id": student_ids,
+        "total_hours": total,
+        "days_practiced": days_practiced,
+        "this_week": this_week,
+        "last_week": last_week,
+        "week_delta": delta,
+        "week_delta_pct": delta_pct,
+        "longest_streak": longest,
+        "current_streak": current,
+        "percentile": percentile,
+    }
+
+
+@app.route("/api/cohort_analytics")
+@login_required
+def api_cohort_analytics():
+    if session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    db = get_db()
+    students = db.execute("SELECT id, name FROM users WHERE role='student' ORDER BY id").fetchall()
+    student_ids = np.fromiter((r["id"] for r in students), dtype=np.int64, count=len(students))
+    m = compute_cohort_metrics(load_practice_columns(db), student_ids)
+
+    result = []
+    for i, r in enumerate(students):
+        result.append({
+            "user_id": r["id"],
+            "name": r["name"],
+            "total_hours": round(float(m["total_hours"][i]), 2),
+            "days_practiced": int(m["days_practiced"][i]),
+            "this_week": round(float(m["this_week"][i]), 2),
+            "last_week": round(float(m["last_week"][i]), 2),
+            "week_delta": round(float(m["week_delta"][i]), 2),
+            "week_delta_pct": round(float(m["week_delta_pct"][i]), 1),
+            "longest_streak": int(m["longest_streak"][i]),
+            "current_streak": int(m["current_streak"][i]),
+            "percentile": round(float(m["percentile"][i]), 1),
+        })
+    return jsonify({"as_of": date.today().isoformat(), "students": result})
 
 
 # -------------------------
@@ -716,17 +5081,36 @@ def api_hours_data():
     if session.get("role") != "student":
         return jsonify({"error": "forbidden"}), 403
     user_id = session["user_id"]
-    db = get_db()
-    # return last 30 days of data (date => hours)
-    start = (date.today() - timedelta(days=29)).isoformat()
-    rows = db.execute("SELECT date, hours FROM practice_entries WHERE user_id=? AND date>=? ORDER BY date", (user_id, start)).fetchall()
-    data = {r["date"]: r["hours"] for r in rows}
-    # ensure all days are present
-    result = []
-    for i in range(30):
-        d = (date.today() - timedelta(days=29 - i)).isoformat()
-        result.append({"date": d, "hours": float(data.get(d, 0))})
-    return jsonify(result)
+
+    def build():
+        # return last 30 days of data (date => hours)
+        start = (date.today() - timedelta(days=29)).isoformat()
+        rows = get_db().execute("SELECT date, hours FROM practice_rollup_daily WHERE user_id=? AND date>=? ORDER BY date", (user_id, start)).fetchall()
+        data = {r["date"]: r["hours"] for r in rows}
+        # ensure all days are present
+        result = []
+        for i in range(30):
+            d = (date.today() - timedelta(days=29 - i)).isoformat()
+            result.append({"date": d, "hours": float(data.get(d, 0))})
+        return jsonify(result)
+    return cached_response([f"practice:{user_id}"], build)
+
+
+@app.route("/api/weekly_category_data")
+@login_required
+def api_weekly_category_data():
+    if session.get("role") != "student":
+        return jsonify({"error": "forbidden"}), 403
+    user_id = session["user_id"]
+    return cached_response([f"practice:{user_id}"], lambda: jsonify(compute_weekly_categories(get_db(), user_id)))
+
+
+@app.route("/api/db_pool")
+@login_required
+def api_db_pool():
+    if session.get("role") != "teacher":
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(get_pool().stats())
 
 
 # -------------------------
@@ -736,17 +5120,23 @@ def api_hours_data():
 @login_required
 def profile():
     db = get_db()
-    user = get_user_by_id(session["user_id"])
+    user = get_user_by_id(session["user_id"], fresh=request.method == "POST")
     if request.method == "POST":
         current = request.form.get("current_password")
         newp = request.form.get("new_password")
         confirm = request.form.get("confirm_password")
-        if current != user["password"]:
-            return render_template("profile.html", title="Profile", active="profile", error="Current password incorrect.", user=user)
         if not newp or newp != confirm:
             return render_template("profile.html", title="Profile", active="profile", error="New passwords do not match.", user=user)
-        db.execute("UPDATE users SET password=? WHERE id=?", (newp, session["user_id"]))
+        try:
+            if not verify_password(user, current or ""):
+                return render_template("profile.html", title="Profile", active="profile", error="Current password incorrect.", user=user)
+            new_hash = get_password_hasher().run(hash_password, newp)
+        except PasswordBusy:
+            return render_template("profile.html", title="Profile", active="profile", error="The server is busy. Please try again.", user=user), 503
+        db.execute("UPDATE users SET password=? WHERE id=?", (new_hash, session["user_id"]))
+        end_other_sessions(db, session["user_id"], keep=session.sid)
         db.commit()
+        invalidate_user(session["user_id"])
         return render_template("profile.html", title="Profile", active="profile", success="Password changed.", user=get_user_by_id(session["user_id"]))
     return render_template("profile.html", title="Profile", active="profile", user=user)
 
@@ -757,7 +5147,7 @@ def profile():
 @app.route("/uploads/public/<filename>")
 @login_required
 def serve_public_upload(filename):
-    return send_from_directory(UPLOAD_PUBLIC, filename)
+    return send_upload(UPLOAD_PUBLIC, filename, public_file_sha256(get_db(), filename))
 
 
 # -------------------------
@@ -765,12 +5155,159 @@ def serve_public_upload(filename):
 # -------------------------
 @app.context_processor
 def inject_user():
+    user = current_user()
+    unread = 0
+    if user and user["role"] == "student":
+        unread = unread_count(get_db(), user["id"])
     return dict(current_user={
-        "id": session.get("user_id"),
-        "username": session.get("username"),
-        "role": session.get("role"),
-        "name": session.get("name")
-    })
+        "id": user["id"] if user else None,
+        "username": user["username"] if user else None,
+        "role": user["role"] if user else None,
+        "name": user["name"] if user else None,
+    }, unread_notifications=unread)
+
+
+# -------------------------
+# Query plan check (run after schema changes: `flask --app app check-query-plans`)
+# -------------------------
+# Rather than a hand-kept list of queries, the check signs in as a student and
+# a teacher on a scratch copy of the schema, walks every GET route that takes
+# no arguments (first page, and a deep keyset page via ?cursor=) plus the
+# requests in PLAN_WALK_EXTRA, records every statement the routes run through
+# TimedConnection, and EXPLAINs each one. Any full scan (including a full
+# index scan) or temporary B-tree fails unless the statement is in
+# PLAN_ALLOW with the reason it is acceptable.
+PLAN_WALK_USERS = ("10001", "70001")
+PLAN_WALK_SKIP = {"static", "logout", "notifications_stream"}
+PLAN_WALK_CURSOR = encode_cursor("9999-12-31", 2 ** 40)
+PLAN_WALK_EXTRA = [
+    # (username, method, path, request kwargs)
+    ("10001", "POST", "/save_hours", {"data": {"date": "2024-01-01", "hours": "1", "technique": "scales", "notes": "n"}}),
+    ("10001", "POST", "/save_hours", {"data": {"date": "2024-01-01", "hours": "2"}}),
+    ("10001", "POST", "/api/practice_entries/batch", {"json": {
+        "ops": [{"op": "upsert", "date": "2024-01-02", "hours": 1}, {"op": "delete", "date": "2024-01-01", "base_version": 2}],
+        "from": "2024-01-01", "to": "2024-01-31"}}),
+    ("10001", "POST", "/save_hours", {"data": {"date": "2024-01-01", "hours": "1"}}),
+    ("10001", "POST", "/delete_hours", {"data": {"date": "2024-01-02"}}),
+    ("10001", "POST", "/add_error", {"data": {"piece": "p", "error_text": "e"}}),
+    ("10001", "POST", "/add_note", {"data": {"note_text": "n"}}),
+    ("10001", "GET", "/search?q=scales", {}),
+    ("10001", "GET", "/api/practice_entries?month=2024-01", {}),
+    ("10001", "GET", "/download/private/x.pdf", {}),
+    ("10001", "GET", "/download/public/x.pdf", {}),
+    ("10001", "GET", "/uploads/public/x.pdf", {}),
+    ("70001", "POST", "/create_notification", {"data": {"title": "t", "message": "m"}}),
+    ("70001", "GET", "/search?q=scales", {}),
+]
+# statement (whitespace collapsed) -> why its scan or sort is acceptable
+PLAN_ALLOW = {
+    "SELECT id, definition FROM suggestion_rules WHERE enabled=1 ORDER BY id":
+        "a few teacher rules, read once per rules version",
+    "SELECT rowid, day, highlight(search_index, 0, char(2), char(3)) AS title, "
+    "snippet(search_index, 1, char(2), char(3), '…', 16) AS snippet FROM search_index "
+    "WHERE search_index MATCH ? ORDER BY bm25(search_index, 3.0, 1.0, 0.0) LIMIT ? OFFSET ?":
+        "ranking sorts the full-text matches",
+    "SELECT id FROM notifications ORDER BY id":
+        "live_notification_ids: read once per feed version",
+    LIBRARY_SELECT["public"]: "library catalog: loaded into memory once per process",
+    LIBRARY_SELECT["private"]: "library catalog: loaded into memory once per process",
+    "SELECT pf.*, u.name as teacher_name FROM public_files pf LEFT JOIN users u ON u.id=pf.teacher_id "
+    "ORDER BY pf.timestamp DESC, pf.id DESC LIMIT ?":
+        "first keyset page: walks the index in order and stops after LIMIT rows",
+    "SELECT n.*, u.name as teacher_name FROM notifications n LEFT JOIN users u ON u.id=n.teacher_id "
+    "ORDER BY n.timestamp DESC, n.id DESC LIMIT ?":
+        "first keyset page: walks the index in order and stops after LIMIT rows",
+    "SELECT title, suggestion, timestamp, rules_version FROM suggestions WHERE user_id=? ORDER BY id":
+        "sorts one student's handful of suggestions",
+    "SELECT user_id, CAST(julianday(date) - 1721424.5 AS INTEGER), COALESCE(hours, 0) "
+    "FROM practice_entries ORDER BY user_id, date":
+        "cohort analytics loads every entry by design, in index order",
+}
+PLAN_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+def plan_problems(db, sql, params):
+    """Return EXPLAIN QUERY PLAN lines that indicate a full scan or a sort."""
+    problems = []
+    for row in db.execute("EXPLAIN QUERY PLAN " + sql, params):
+        detail = row["detail"]
+        if detail.startswith("SCAN ") and "VIRTUAL TABLE INDEX" not in detail and detail != "SCAN CONSTANT ROW":
+            problems.append(detail)
+        elif "TEMP B-TREE" in detail:
+            problems.append(detail)
+    return problems
+
+
+def walk_routes():
+    """Run the plan-check walk; returns ({sql: params}, [failed requests])."""
+    statements, failed = {}, []
+    TimedConnection.recorder = recorder = []
+    try:
+        for username in PLAN_WALK_USERS:
+            client = app.test_client()
+            client.post("/login", data={"username": username, "password": username})
+            requests = [(u, m, p, kw) for u, m, p, kw in PLAN_WALK_EXTRA if u == username]
+            for rule in app.url_map.iter_rules():
+                if "GET" in rule.methods and not rule.arguments and rule.endpoint not in PLAN_WALK_SKIP:
+                    requests += [(username, "GET", rule.rule, {}),
+                                 (username, "GET", f"{rule.rule}?cursor={PLAN_WALK_CURSOR}", {})]
+            for _, method, path, kwargs in requests:
+                status = client.open(path, method=method, **kwargs).status_code
+                if status >= 500:
+                    failed.append(f"{method} {path} as {username}: {status}")
+    finally:
+        TimedConnection.recorder = None
+    for sql, params in recorder:
+        if sql.lstrip().upper().startswith(PLAN_STATEMENTS):
+            statements.setdefault(sql, params)
+    return statements, failed
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Fail if any statement the routes run has regressed to a full scan or sort."""
+    global DB_PATH, _pool
+    close_db(None)
+    with tempfile.TemporaryDirectory() as tmp:
+        # a scratch database: the walk writes, and must not touch real data
+        DB_PATH = os.path.join(tmp, "plans.db")
+        _pool = ConnectionPool(DB_PATH, factory=TimedConnection)
+        init_tables()
+        ensure_default_users()
+        app.logger.disabled = True      # routes that fail are reported below
+        try:
+            # on a thread of its own, so each request gets its own app context
+            with ThreadPoolExecutor(1) as executor:
+                statements, failed_routes = executor.submit(walk_routes).result()
+        finally:
+            app.logger.disabled = False
+        db = get_db()
+        failed = 0
+        for sql, params in statements.items():
+            if " ".join(sql.split()) in PLAN_ALLOW:
+                continue
+            try:
+                problems = plan_problems(db, sql, params if params is not None else [None] * sql.count("?"))
+            except sqlite3.Error as e:
+                problems = [f"could not explain: {e}"]
+            if problems:
+                failed += 1
+                print(" ".join(sql.split()))
+                for p in problems:
+                    print(f"    {p}")
+        for route in failed_routes:
+            print(f"warning: {route} (its later statements were not checked)")
+        close_db(None)
+    if failed:
+        raise SystemExit(f"{failed} of {len(statements)} statement(s) scan or sort.")
+    print(f"All {len(statements)} statements use indexes.")
+
+
+# initialize on startup
+with app.app_context():
+    init_tables()
+    ensure_default_users()
+    ensure_rollups()
 
 
 # -------------------------
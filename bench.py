@@ -0,0 +1,371 @@
+"""Route benchmarks: throughput and p50/p95/p99 latency per route.
+
+    python gen_data.py --students 20000                 # once: instance/bench.db
+    python bench.py client                              # in-process, Flask test client
+    python bench.py http --url http://127.0.0.1:5000 --procs 8 --duration 30
+    python bench.py client --save                       # baseline named after the git commit
+    python bench.py client --compare 1a2b3c4            # exit 1 if a route's p95 regressed
+
+`client` imports the app against --db and times each route on its own.
+After a warmup it sends --requests requests per route, spread over
+--users logged-in students (and teachers for the teacher routes). This
+measures the Python and SQL cost of each route with no network or
+server in the way.
+
+`http` runs --procs processes against a server that is already running.
+Each process logs in its own users and keeps one keep-alive connection.
+It sends requests picked at random by route weight for --duration
+seconds; requests during the first --warmup seconds are not counted.
+Give the server the same database as --db, because users are chosen
+from it.
+
+Write routes (save_hours, add_error, add_note) change the database; pass
+--read-only to leave them out. The login route logs the same users in
+again and again. For `http`, start the server with a large LOGIN_BURST;
+client mode sets it itself. Results are written to instance/bench/ as
+<mode>-<name>.json.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+
+BENCH_DIR = os.path.join("instance", "bench")
+SEARCH_TERMS = ["scales", "arpeggios", "rhythm", "bar", "fingering", "recital", "tempo", "minuet"]
+
+
+def random_day(rng):
+    return (date.today() - timedelta(days=rng.randrange(365))).isoformat()
+
+
+def random_month(rng):
+    return (date.today() - timedelta(days=rng.randrange(365))).strftime("%Y-%m")
+
+
+# name: (role, weight, method, path(rng), form(rng, username) or None, writes)
+ROUTES = {
+    "dashboard_student": ("student", 10, "GET", lambda r: "/dashboard_student", None, False),
+    "hours": ("student", 3, "GET", lambda r: "/hours", None, False),
+    "practice_month": ("student", 8, "GET", lambda r: f"/api/practice_entries?month={random_month(r)}", None, False),
+    "practice_heatmap": ("student", 4, "GET", lambda r: "/api/practice_heatmap", None, False),
+    "errors": ("student", 4, "GET", lambda r: "/errors", None, False),
+    "api_errors": ("student", 3, "GET", lambda r: "/api/errors", None, False),
+    "notes": ("student", 3, "GET", lambda r: "/notes", None, False),
+    "api_notes": ("student", 3, "GET", lambda r: "/api/notes", None, False),
+    "notifications": ("student", 5, "GET", lambda r: "/notifications", None, False),
+    "unread": ("student", 8, "GET", lambda r: "/api/notifications/unread", None, False),
+    "search": ("student", 4, "GET", lambda r: f"/search?q={r.choice(SEARCH_TERMS)}", None, False),
+    "analytics": ("student", 4, "GET", lambda r: "/analytics", None, False),
+    "hours_data": ("student", 4, "GET", lambda r: "/api/hours_data", None, False),
+    "weekly_categories": ("student", 2, "GET", lambda r: "/api/weekly_category_data", None, False),
+    "suggestions": ("student", 2, "GET", lambda r: "/suggestions", None, False),
+    "library": ("student", 3, "GET", lambda r: "/get_library", None, False),
+    "save_hours": ("student", 6, "POST", lambda r: "/save_hours",
+                   lambda r, u: {"date": random_day(r), "hours": r.choice(["0.5", "1", "1.25", "2"]),
+                              "technique": r.choice(SEARCH_TERMS[:3]), "notes": ""}, True),
+    "add_error": ("student", 2, "POST", lambda r: "/add_error",
+                  lambda r, u: {"piece": "Minuet in G", "error_text": f"rushed bar {r.randrange(1, 64)}"}, True),
+    "add_note": ("student", 2, "POST", lambda r: "/add_note",
+                 lambda r, u: {"note_text": "benchmark note"}, True),
+    "login": ("student", 2, "POST", lambda r: "/login", lambda r, u: {"username": u, "password": u}, False),
+    "dashboard_teacher": ("teacher", 2, "GET", lambda r: "/dashboard_teacher", None, False),
+    "teacher_notifications": ("teacher", 1, "GET", lambda r: "/notifications", None, False),
+    "cohort_analytics": ("teacher", 1, "GET", lambda r: "/api/cohort_analytics", None, False),
+    "public_library": ("teacher", 1, "GET", lambda r: "/api/music_library", None, False),
+}
+
+
+def pick_routes(args):
+    names = args.routes.split(",") if args.routes else list(ROUTES)
+    unknown = [n for n in names if n not in ROUTES]
+    if unknown:
+        sys.exit(f"unknown route(s): {', '.join(unknown)}; choose from {', '.join(ROUTES)}")
+    return [n for n in names if not (args.read_only and ROUTES[n][5])]
+
+
+def pick_users(db_path, count, seed):
+    """Random loginable (five-digit) students and teachers; init_db.py defaults if there is no db."""
+    if not os.path.exists(db_path):
+        return {"student": [str(i) for i in range(10001, 10051)][:count],
+                "teacher": [str(i) for i in range(70001, 70011)][:count]}
+    conn = sqlite3.connect(db_path)
+    users = {}
+    for role in ("student", "teacher"):
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM users WHERE role=? AND id BETWEEN 10000 AND 99999", (role,))]
+        random.Random(seed).shuffle(ids)
+        users[role] = [str(i) for i in ids[:count]]
+    conn.close()
+    return users
+
+
+def summarize(samples, errors, seconds):
+    """samples: {route: [latency seconds]}, errors: {route: count}."""
+    routes = {}
+    for name, lat in samples.items():
+        a = np.asarray(lat) * 1000
+        n, failed = len(a), errors.get(name, 0)
+        routes[name] = {
+            "requests": n,
+            "errors": failed,
+            "rps": round(n / seconds[name], 1) if seconds[name] else 0.0,
+            "mean_ms": round(float(a.mean()), 2) if n else None,
+            "p50_ms": round(float(np.percentile(a, 50)), 2) if n else None,
+            "p95_ms": round(float(np.percentile(a, 95)), 2) if n else None,
+            "p99_ms": round(float(np.percentile(a, 99)), 2) if n else None,
+        }
+    return routes
+
+
+def print_table(result):
+    print(f"\n{'route':<22}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, r in result["routes"].items():
+        cells = [f"{r[k]:>9.2f}" if r[k] is not None else f"{'-':>9}" for k in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<22}{r['requests']:>9}{r['errors']:>8}{r['rps']:>9.1f}{''.join(cells)}")
+    t = result["total"]
+    print(f"{'total':<22}{t['requests']:>9}{t['errors']:>8}{t['rps']:>9.1f}")
+
+
+# -------------------------
+# In-process (test client)
+# -------------------------
+def run_client(args, routes):
+    os.environ["DATABASE_PATH"] = os.path.abspath(args.db)
+    os.environ.setdefault("MEDIA_WORKERS", "0")
+    os.environ.setdefault("LOGIN_BURST", "1000000")     # the login route repeats the same users
+    import app as webapp
+
+    users = pick_users(args.db, args.users, args.seed)
+    clients = {}
+    for role, ids in users.items():
+        clients[role] = []
+        for uid in ids:
+            c = webapp.app.test_client()
+            resp = c.post("/login", data={"username": uid, "password": uid})
+            if resp.status_code != 302:
+                sys.exit(f"login failed for {uid}: {resp.status_code}")
+            clients[role].append((uid, c))
+
+    rng = random.Random(args.seed)
+    samples, errors, seconds = {}, {}, {}
+    for name in routes:
+        role, _, method, path, form, _ = ROUTES[name]
+        if not clients[role]:
+            print(f"  {name}: skipped (no {role}s in {args.db})")
+            continue
+        lat, failed = [], 0
+        started = None
+        for i in range(args.warmup + args.requests):
+            if i == args.warmup:
+                started = time.perf_counter()
+            uid, c = clients[role][i % len(clients[role])]
+            url = path(rng)
+            data = form(rng, uid) if form else None
+            t = time.perf_counter()
+            resp = c.open(url, method=method, data=data)
+            resp.get_data()
+            elapsed = time.perf_counter() - t
+            if i >= args.warmup:
+                lat.append(elapsed)
+                failed += resp.status_code >= 400
+        seconds[name] = time.perf_counter() - started
+        samples[name], errors[name] = lat, failed
+        print(f"  {name}: {np.percentile(np.asarray(lat) * 1000, 50):.2f} ms p50", flush=True)
+    return samples, errors, seconds
+
+
+# -------------------------
+# Multi-process HTTP load
+# -------------------------
+class HttpUser:
+    """One logged-in session on a keep-alive connection."""
+
+    def __init__(self, host, port, username):
+        self.username = username
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookie = None
+        status, _ = self.request("POST", "/login", {"username": username, "password": username})
+        if status != 302 or not self.cookie:
+            raise RuntimeError(f"login failed for {username}: {status}")
+
+    def request(self, method, path, form=None):
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            # the server closed an idle keep-alive connection: reconnect once
+            self.conn.close()
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+        data = resp.read()
+        for header, value in resp.getheaders():
+            if header.lower() == "set-cookie" and value.startswith("session="):
+                self.cookie = value.split(";", 1)[0]
+        return resp.status, data
+
+
+def http_worker(url, users, routes, duration, warmup, seed):
+    parts = urlsplit(url)
+    sessions = {role: [HttpUser(parts.hostname, parts.port or 80, u) for u in ids] for role, ids in users.items()}
+    routes = [n for n in routes if sessions[ROUTES[n][0]]]
+    weights = [ROUTES[n][1] for n in routes]
+    rng = random.Random(seed)
+    samples = {n: [] for n in routes}
+    errors = {n: 0 for n in routes}
+    start = time.perf_counter()
+    counted_from, deadline = start + warmup, start + warmup + duration
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        name = rng.choices(routes, weights)[0]
+        role, _, method, path, form, _ = ROUTES[name]
+        user = rng.choice(sessions[role])
+        try:
+            status, _ = user.request(method, path(rng), form(rng, user.username) if form else None)
+        except OSError:
+            status = 599
+        elapsed = time.perf_counter() - now
+        if now >= counted_from:
+            samples[name].append(elapsed)
+            errors[name] += status >= 400
+    return samples, errors
+
+
+def run_http(args, routes):
+    users = pick_users(args.db, args.users * args.procs, args.seed)
+    jobs = []
+    for p in range(args.procs):
+        share = {role: ids[p::args.procs] for role, ids in users.items()}
+        jobs.append((args.url, share, routes, args.duration, args.warmup, args.seed + p))
+    print(f"  {args.procs} processes x {args.users} users, {args.duration}s after {args.warmup}s warmup", flush=True)
+    with multiprocessing.Pool(args.procs) as pool:
+        results = pool.starmap(http_worker, jobs)
+    samples, errors = {}, {}
+    for s, e in results:
+        for name, lat in s.items():
+            samples.setdefault(name, []).extend(lat)
+            errors[name] = errors.get(name, 0) + e[name]
+    # routes share the wall clock, so per-route rps is that route's share of the whole run
+    seconds = {name: args.duration for name in samples}
+    return samples, errors, seconds
+
+
+# -------------------------
+# Baselines
+# -------------------------
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def baseline_path(mode, name):
+    return os.path.join(BENCH_DIR, f"{mode}-{name}.json")
+
+
+def compare(result, baseline, threshold):
+    """Print p95 changes per route; return the routes that got slower than threshold percent."""
+    print(f"\nCompared with {baseline['name']} ({baseline['at']}), p95:")
+    regressed = []
+    for name, r in result["routes"].items():
+        old = baseline["routes"].get(name)
+        if not old or not old["p95_ms"] or r["p95_ms"] is None:
+            continue
+        change = (r["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+        flag = ""
+        if change > threshold:
+            regressed.append(name)
+            flag = "  REGRESSION"
+        print(f"  {name:<22}{old['p95_ms']:>9.2f} -> {r['p95_ms']:>9.2f} ms ({change:+.0f}%){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", choices=["client", "http"])
+    parser.add_argument("--db", default=os.path.join("instance", "bench.db"),
+                        help="database to benchmark (client) / to pick users from (http)")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="server to load (http)")
+    parser.add_argument("--routes", help="comma-separated route names (default: all)")
+    parser.add_argument("--read-only", action="store_true", help="skip routes that write")
+    parser.add_argument("--users", type=int, default=20, help="logged-in users per role (per process for http)")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route (client)")
+    parser.add_argument("--warmup", type=int, default=None,
+                        help="untimed requests per route (client, default 20) / seconds (http, default 2)")
+    parser.add_argument("--procs", type=int, default=os.cpu_count() or 4, help="load processes (http)")
+    parser.add_argument("--duration", type=int, default=30, help="timed seconds (http)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", nargs="?", const="", metavar="NAME",
+                        help="save results as a baseline (default name: current git commit)")
+    parser.add_argument("--compare", metavar="NAME", help="baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=20.0, help="p95 regression threshold, percent")
+    args = parser.parse_args()
+    if args.warmup is None:
+        args.warmup = 20 if args.mode == "client" else 2
+    if args.mode == "client" and not os.path.exists(args.db):
+        parser.error(f"{args.db} does not exist; create it with gen_data.py")
+
+    routes = pick_routes(args)
+    print(f"Benchmarking {len(routes)} routes ({args.mode}) on {args.db}")
+    started = time.perf_counter()
+    if args.mode == "client":
+        samples, errors, seconds = run_client(args, routes)
+    else:
+        samples, errors, seconds = run_http(args, routes)
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(s) for s in samples.values())
+    result = {
+        "mode": args.mode,
+        "name": args.save or git_revision(),
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "db": args.db,
+        "routes": summarize(samples, errors, seconds),
+        "total": {
+            "requests": total,
+            "errors": sum(errors.values()),
+            "rps": round(total / (args.duration if args.mode == "http" else elapsed), 1),
+        },
+    }
+    print_table(result)
+
+    if args.save is not None:
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        path = baseline_path(args.mode, result["name"])
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved {path}")
+    if args.compare:
+        path = baseline_path(args.mode, args.compare)
+        if not os.path.exists(path):
+            sys.exit(f"no baseline {path}")
+        with open(path) as f:
+            regressed = compare(result, json.load(f), args.threshold)
+        if regressed:
+            print(f"\np95 regressed more than {args.threshold:g}% on: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
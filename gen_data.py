@@ -0,0 +1,270 @@
+"""Build a synthetic, school-scale database for load testing.
+
+    python gen_data.py                       # 100k students, 2 years -> instance/bench.db
+    python gen_data.py --students 5000 --years 1 --out instance/small.db
+    DATABASE_PATH=instance/bench.db flask --app app run
+
+Every account's username and password are its id, like the defaults
+from init_db.py. Passwords are stored hashed with --password-method,
+which is cheaper than the app's own setting so 100k accounts hash in
+about a minute; the app rehashes each one at its first login. Students
+start at 10001 and skip the teacher range 70000-79999. Only five-digit
+ids can log in, so with more than 79,999 students the rest (ids from
+100000) exist only as data. Each student gets an activity level, a
+start date and sometimes a drop-out date. From those come daily
+practice entries (more at weekends), errors, notes and private files.
+Teachers post notifications and public library files. Files exist only
+as metadata and blob rows; nothing is written under static/uploads.
+
+Rows are bulk-inserted with the search triggers dropped. Rollups,
+practice-day bitsets and the search index are then rebuilt in one pass
+each, so the result looks the same as a database the app built up
+itself.
+"""
+import argparse
+import os
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from migrations import (
+    SEARCH_SOURCES, create_search_triggers, drop_search_triggers, hash_password, migrate,
+    rebuild_practice_days, rebuild_rollup_tables, rebuild_search_index,
+)
+
+CHUNK = 2000                # students generated per batch
+
+TECHNIQUES = ["scales", "arpeggios", "sight-reading", "rhythm", "chords", "repertoire",
+              "intervals", "ear training", "improvisation", "etudes"]
+PIECES = ["Ode to Joy", "Minuet in G", "Canon in D", "Fur Elise", "Clair de Lune", "Gymnopedie No. 1",
+          "River Flows in You", "Prelude in C", "The Entertainer", "Turkish March", "Moonlight Sonata",
+          "Autumn Leaves", "Greensleeves", "La Campanella", "Nocturne Op. 9 No. 2"]
+ERROR_TEXTS = ["rushed the run in bar {n}", "wrong fingering in bar {n}", "missed the key change at bar {n}",
+               "dynamics too flat from bar {n}", "lost the beat after the repeat", "left hand late in bar {n}",
+               "forgot the accidental in bar {n}", "tempo dragged in the middle section"]
+PRACTICE_NOTES = ["felt tired", "great session", "metronome at 80", "worked slowly", "hands separately",
+                  "recorded myself", "teacher's warm-up", "focused on tone"]
+NOTE_TEXTS = ["Lesson moved to Thursday", "Recital piece chosen: {piece}", "Need new strings",
+              "Exam in three weeks", "Practised with a friend", "Listened to a recording of {piece}",
+              "Worked on memorising {piece}", "Sore wrist, took it easy"]
+NOTIFICATION_TITLES = ["Recital schedule", "Theory homework", "Exam entries", "Studio closed",
+                       "New practice pieces", "Masterclass", "Ensemble rehearsal", "Holiday practice plan"]
+FILE_CATEGORIES = ["scales", "intervals", "exercises", "songs"]
+FILE_TYPES = np.array(["mp3", "pdf", "wav", "mp4"])
+FILE_TYPE_WEIGHTS = [0.45, 0.35, 0.12, 0.08]
+
+
+def student_ids(count):
+    ids = np.arange(10001, 10001 + count + 10000)
+    return ids[(ids < 70000) | (ids >= 80000)][:count]
+
+
+def day_strings(start, days):
+    return np.array([(start + timedelta(days=i)).isoformat() for i in range(days)], dtype=object)
+
+
+def sha256s(rng, count):
+    raw = rng.integers(0, 256, size=(count, 32), dtype=np.uint8)
+    return [row.tobytes().hex() for row in raw]
+
+
+def phase(label, started):
+    print(f"  {label}: {time.perf_counter() - started:.1f}s", flush=True)
+    return time.perf_counter()
+
+
+def generate(conn, args):
+    rng = np.random.default_rng(args.seed)
+    days = int(args.years * 365)
+    first = date.today() - timedelta(days=days - 1)
+    day_str = day_strings(first, days)
+    weekday = np.array([(first + timedelta(days=i)).weekday() for i in range(days)])
+    # weekends get more practice, Fridays a little less
+    day_factor = np.select([weekday >= 5, weekday == 4], [1.3, 0.8], 1.0)
+    stamp = datetime.now().isoformat()
+
+    students = student_ids(args.students)
+    teachers = np.arange(70001, 70001 + args.teachers)
+    with Pool() as pool:
+        hashed = partial(hash_password, method=args.password_method)
+        student_pw = pool.map(hashed, [str(u) for u in students], chunksize=1000)
+        teacher_pw = pool.map(hashed, [str(u) for u in teachers], chunksize=1000)
+    conn.executemany("INSERT INTO users (id, username, password, name, role) VALUES (?, ?, ?, ?, 'student')",
+                     [(int(u), str(u), pw, f"Student {u}") for u, pw in zip(students, student_pw)])
+    conn.executemany("INSERT INTO users (id, username, password, name, role) VALUES (?, ?, ?, ?, 'teacher')",
+                     [(int(u), str(u), pw, f"Teacher {u}") for u, pw in zip(teachers, teacher_pw)])
+
+    techniques = np.array(TECHNIQUES, dtype=object)
+    practice_notes = np.array([""] + PRACTICE_NOTES, dtype=object)
+    counts = {"practice_entries": 0, "errors": 0, "special_notes": 0, "private_files": 0}
+    started = time.perf_counter()
+    for lo in range(0, len(students), CHUNK):
+        uids = students[lo:lo + CHUNK]
+        n = len(uids)
+        activity = rng.beta(2.0, 3.0, n)
+        start = rng.integers(0, max(days // 2, 1), n)
+        end = np.where(rng.random(n) < 0.2, rng.integers(days // 2, days, n), days)
+        day_idx = np.arange(days)
+        mask = (rng.random((n, days)) < activity[:, None] * day_factor[None, :]) \
+            & (day_idx[None, :] >= start[:, None]) & (day_idx[None, :] < end[:, None])
+        u, d = np.nonzero(mask)     # row-major: grouped by student, days ascending
+        hours = np.clip(np.round(rng.gamma(2.0, 0.45, u.size) * 4) / 4, 0.25, 6.0)
+        technique = techniques[rng.integers(0, len(TECHNIQUES), u.size)]
+        notes = practice_notes[np.where(rng.random(u.size) < 0.08, rng.integers(1, len(practice_notes), u.size), 0)]
+        conn.executemany("INSERT INTO practice_entries (user_id, date, hours, technique, notes) VALUES (?, ?, ?, ?, ?)",
+                         zip(uids[u].tolist(), day_str[d].tolist(), hours.tolist(), technique.tolist(), notes.tolist()))
+        counts["practice_entries"] += u.size
+
+        def spread(rate):
+            """(student index, day index) pairs: Poisson(rate * activity) per student within their active span."""
+            per = rng.poisson(rate * (0.5 + activity))
+            who = np.repeat(np.arange(n), per)
+            span = np.maximum(end[who] - start[who], 1)
+            return who, start[who] + (rng.random(who.size) * span).astype(np.int64)
+
+        who, when = spread(args.errors)
+        bars = rng.integers(1, 64, who.size)
+        pieces = rng.integers(0, len(PIECES), who.size)
+        texts = rng.integers(0, len(ERROR_TEXTS), who.size)
+        conn.executemany("INSERT INTO errors (user_id, date, piece, error_text) VALUES (?, ?, ?, ?)",
+                         [(int(uids[w]), day_str[t], PIECES[p], ERROR_TEXTS[x].format(n=b))
+                          for w, t, p, x, b in zip(who.tolist(), when.tolist(), pieces.tolist(), texts.tolist(), bars.tolist())])
+        counts["errors"] += who.size
+
+        who, when = spread(args.notes)
+        pieces = rng.integers(0, len(PIECES), who.size)
+        texts = rng.integers(0, len(NOTE_TEXTS), who.size)
+        conn.executemany("INSERT INTO special_notes (user_id, date, note_text) VALUES (?, ?, ?)",
+                         [(int(uids[w]), day_str[t], NOTE_TEXTS[x].format(piece=PIECES[p]))
+                          for w, t, p, x in zip(who.tolist(), when.tolist(), pieces.tolist(), texts.tolist())])
+        counts["special_notes"] += who.size
+
+        per = rng.poisson(args.private_files, n)
+        counts["private_files"] += insert_files(conn, rng, "private_files", "user_id", np.repeat(uids, per),
+                                                first, days, stamp)
+
+        done = min(lo + CHUNK, len(students))
+        if done % (CHUNK * 10) == 0 or done == len(students):
+            rate = counts["practice_entries"] / (time.perf_counter() - started)
+            print(f"  students {done}/{len(students)}: {counts['practice_entries']} practice rows "
+                  f"({rate:,.0f}/s)", flush=True)
+    conn.commit()
+
+    # teachers: notifications and the public library
+    per = rng.poisson(args.notifications, len(teachers))
+    who = np.repeat(teachers, per)
+    when = rng.integers(0, days * 86400, who.size)
+    order = np.argsort(when, kind="stable")
+    titles = rng.integers(0, len(NOTIFICATION_TITLES), who.size)
+    conn.executemany("INSERT INTO notifications (teacher_id, title, message, timestamp) VALUES (?, ?, ?, ?)",
+                     [(int(who[i]), NOTIFICATION_TITLES[titles[i]],
+                       f"{NOTIFICATION_TITLES[titles[i]]}: details for {PIECES[titles[i] % len(PIECES)]}.",
+                       (datetime.combine(first, datetime.min.time()) + timedelta(seconds=int(when[i]))).isoformat())
+                      for i in order.tolist()])
+    counts["notifications"] = who.size
+    per = rng.poisson(args.public_files, len(teachers))
+    counts["public_files"] = insert_files(conn, rng, "public_files", "teacher_id", np.repeat(teachers, per),
+                                          first, days, stamp)
+
+    # a read cursor for most students, somewhere in the feed
+    if counts["notifications"]:
+        readers = students[rng.random(len(students)) < 0.7]
+        seen = rng.integers(0, counts["notifications"] + 1, readers.size)
+        conn.executemany("INSERT INTO notification_reads (user_id, last_seen_id) VALUES (?, ?)",
+                         zip(readers.tolist(), seen.tolist()))
+    conn.commit()
+    return counts
+
+
+def insert_files(conn, rng, table, owner_col, owners, first, days, stamp):
+    """File metadata plus a blob row per file (content itself is not written)."""
+    count = owners.size
+    if not count:
+        return 0
+    types = FILE_TYPES[rng.choice(len(FILE_TYPES), count, p=FILE_TYPE_WEIGHTS)]
+    sizes = np.clip(rng.lognormal(14.5, 1.0, count), 10_000, 200_000_000).astype(np.int64)
+    shas = sha256s(rng, count)
+    pieces = rng.integers(0, len(PIECES), count)
+    categories = rng.integers(0, len(FILE_CATEGORIES), count)
+    when = rng.integers(0, days * 86400, count)
+    base = datetime.combine(first, datetime.min.time())
+    rows = []
+    for i, (owner, ftype, piece, cat, t) in enumerate(zip(owners.tolist(), types.tolist(), pieces.tolist(),
+                                                           categories.tolist(), when.tolist())):
+        ts = base + timedelta(seconds=t)
+        original = f"{PIECES[piece].lower().replace(' ', '_').replace('.', '')}_{i}.{ftype}"
+        rows.append((owner, f"{owner}_{int(ts.timestamp())}_{original}", original, ftype,
+                     f"{PIECES[piece]} ({FILE_CATEGORIES[cat]})", ts.isoformat(), int(sizes[i]), shas[i],
+                     FILE_CATEGORIES[cat]))
+    conn.executemany(f"""
+        INSERT INTO {table} ({owner_col}, file_name, original_name, file_type, description, timestamp, size, sha256, category)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.executemany("INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 1, ?)",
+                     [(sha, int(size), stamp) for sha, size in zip(shas, sizes.tolist())])
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default=os.path.join("instance", "bench.db"), help="database file to create")
+    parser.add_argument("--students", type=int, default=100_000)
+    parser.add_argument("--teachers", type=int, default=500)
+    parser.add_argument("--years", type=float, default=2.0, help="history length")
+    parser.add_argument("--errors", type=float, default=12.0, help="mean errors per student")
+    parser.add_argument("--notes", type=float, default=8.0, help="mean notes per student")
+    parser.add_argument("--private-files", type=float, default=1.5, help="mean uploads per student")
+    parser.add_argument("--notifications", type=float, default=20.0, help="mean notifications per teacher")
+    parser.add_argument("--public-files", type=float, default=30.0, help="mean library files per teacher")
+    parser.add_argument("--password-method", default="pbkdf2:sha256:1000",
+                        help="werkzeug hash method for the seeded passwords")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="replace --out if it exists")
+    args = parser.parse_args()
+    if args.teachers > 9999:
+        parser.error("--teachers must be below 10000 (ids 70001-79999)")
+
+    if os.path.exists(args.out):
+        if not args.force:
+            parser.error(f"{args.out} exists; pass --force to replace it")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.out + suffix):
+                os.remove(args.out + suffix)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+
+    conn = sqlite3.connect(args.out)
+    migrate(conn)
+    # bulk load: no journal, and search entries are built in one pass at the end
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    for source in SEARCH_SOURCES:
+        drop_search_triggers(conn, source[0])
+
+    total = time.perf_counter()
+    print(f"Generating {args.students} students / {args.teachers} teachers, {args.years:g} years -> {args.out}")
+    counts = generate(conn, args)
+    t = phase("rows", total)
+    rebuild_rollup_tables(conn)
+    t = phase("rollups", t)
+    rebuild_practice_days(conn)
+    t = phase("practice-day bitsets", t)
+    for source in SEARCH_SOURCES:
+        create_search_triggers(conn, source[0])
+    rebuild_search_index(conn)
+    conn.commit()
+    t = phase("search index", t)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+
+    for table, n in counts.items():
+        print(f"  {table}: {n:,}")
+    print(f"Done in {time.perf_counter() - total:.0f}s. Run the app on it with DATABASE_PATH={args.out}")
+
+
+if __name__ == "__main__":
+    main()
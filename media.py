@@ -0,0 +1,137 @@
+# media.py
+"""Derived media for stored uploads: waveform peaks, PDF thumbnails and
+low-bitrate audio previews.
+
+These functions run inside the media worker's process pool, so this module
+must not import app.py. ffmpeg and pdftoppm are optional: when a job needs
+a tool that is not installed it raises ToolMissing and the queue records
+the job as skipped instead of retrying it.
+"""
+import os
+import shutil
+import subprocess
+import wave
+
+import numpy as np
+
+PEAK_COUNT = 1024           # waveform buckets; one unsigned byte each
+PEAK_SAMPLE_RATE = 4000     # ffmpeg decode rate for non-WAV peak extraction
+PREVIEW_BITRATE = "48k"
+PREVIEW_SAMPLE_RATE = 22050
+THUMB_WIDTH = 320
+TOOL_TIMEOUT = 600          # seconds before an external tool is killed
+
+# which derivatives each upload type gets
+KINDS_BY_TYPE = {
+    "mp3": ("waveform", "preview"),
+    "wav": ("waveform", "preview"),
+    "mp4": ("waveform", "preview"),
+    "pdf": ("thumbnail",),
+}
+EXTENSIONS = {"waveform": "peaks", "preview": "mp3", "thumbnail": "png"}
+
+_WAV_DTYPES = {1: np.uint8, 2: np.dtype("<i2"), 4: np.dtype("<i4")}
+
+
+class ToolMissing(RuntimeError):
+    pass
+
+
+def _tool(name):
+    path = shutil.which(name)
+    if not path:
+        raise ToolMissing(f"{name} is not installed")
+    return path
+
+
+def _run(args):
+    subprocess.run(args, check=True, timeout=TOOL_TIMEOUT,
+                   stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def _scale_peaks(peaks):
+    """Normalized peaks (0..1) -> exactly PEAK_COUNT bytes."""
+    out = np.zeros(PEAK_COUNT, dtype=np.uint8)
+    peaks = np.clip(np.asarray(peaks, dtype=np.float64)[:PEAK_COUNT], 0.0, 1.0)
+    out[:peaks.size] = np.rint(peaks * 255)
+    return out.tobytes()
+
+
+def _wav_peaks(src):
+    """Stream a PCM WAV bucket by bucket; None if the sample width is unusual."""
+    try:
+        w = wave.open(src, "rb")
+    except (wave.Error, EOFError):
+        return None
+    with w:
+        width = w.getsampwidth()
+        if width not in _WAV_DTYPES:
+            return None
+        bounds = np.linspace(0, w.getnframes(), PEAK_COUNT + 1).astype(np.int64)
+        full_scale = 128.0 if width == 1 else float(2 ** (8 * width - 1))
+        peaks = []
+        for frames in np.diff(bounds):
+            buf = w.readframes(int(frames)) if frames else b""
+            samples = np.frombuffer(buf, dtype=_WAV_DTYPES[width]).astype(np.int64)
+            if width == 1:
+                samples -= 128
+            peaks.append(np.abs(samples).max() / full_scale if samples.size else 0.0)
+    return _scale_peaks(peaks)
+
+
+def _decoded_peaks(src):
+    """Decode any audio/video track to low-rate mono PCM with ffmpeg."""
+    proc = subprocess.run(
+        [_tool("ffmpeg"), "-v", "error", "-i", src, "-vn", "-ac", "1",
+         "-ar", str(PEAK_SAMPLE_RATE), "-f", "s16le", "-"],
+        check=True, timeout=TOOL_TIMEOUT, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    samples = np.abs(np.frombuffer(proc.stdout, dtype="<i2").astype(np.int32))
+    if not samples.size:
+        return _scale_peaks([])
+    starts = np.linspace(0, samples.size, PEAK_COUNT, endpoint=False).astype(np.int64)
+    return _scale_peaks(np.maximum.reduceat(samples, starts) / 32768.0)
+
+
+def waveform(src, dest, file_type):
+    peaks = _wav_peaks(src) if file_type == "wav" else None
+    if peaks is None:
+        peaks = _decoded_peaks(src)
+    with open(dest, "wb") as fh:
+        fh.write(peaks)
+
+
+def preview(src, dest, file_type):
+    _run([_tool("ffmpeg"), "-v", "error", "-y", "-i", src, "-vn", "-ac", "1",
+          "-ar", str(PREVIEW_SAMPLE_RATE), "-b:a", PREVIEW_BITRATE, "-f", "mp3", dest])
+
+
+def thumbnail(src, dest, file_type):
+    # pdftoppm appends the extension itself
+    prefix = dest[:-len(".png")] if dest.endswith(".png") else dest
+    _run([_tool("pdftoppm"), "-png", "-f", "1", "-l", "1", "-singlefile",
+          "-scale-to", str(THUMB_WIDTH), src, prefix])
+    if prefix + ".png" != dest:
+        os.replace(prefix + ".png", dest)
+
+
+BUILDERS = {"waveform": waveform, "preview": preview, "thumbnail": thumbnail}
+
+
+def run_job(kind, src, dest, file_type):
+    """Build one derivative at `dest`. Safe to repeat: output is written to a
+    temporary name and renamed into place, and an existing result is kept.
+    Returns the output size in bytes."""
+    if os.path.exists(dest):
+        return os.path.getsize(dest)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    root, ext = os.path.splitext(dest)
+    tmp = f"{root}.{os.getpid()}.tmp{ext}"
+    try:
+        BUILDERS[kind](src, tmp, file_type)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return os.path.getsize(dest)
@@ -0,0 +1,661 @@
+# migrations.py
+"""Versioned schema migrations shared by app.py and init_db.py.
+
+Each migration is (version, name, function). migrate() applies every
+migration newer than the version recorded in schema_version, each inside
+its own transaction, so a database created by either entry point ends up
+with the same schema.
+"""
+import itertools
+import os
+import re
+import secrets
+import sqlite3
+from datetime import datetime
+
+from werkzeug.security import generate_password_hash
+
+# werkzeug method string "scrypt:N:r:p": memory is 128 * N * r bytes per hash
+# (16 MB by default). Hashes made with other settings are redone at next login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:16384:8:1")
+
+
+def _columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    ).fetchone() is not None
+
+
+def _can_drop_column():
+    return sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def hash_password(password, method=None):
+    """The value stored in users.password (every entry point seeds through this)."""
+    return generate_password_hash(password, method=method or PASSWORD_HASH_METHOD, salt_length=16)
+
+
+# -------------------------
+# Migrations
+# -------------------------
+def m0001_baseline(conn):
+    """Tables as created by app.py's init_tables()."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT UNIQUE,
+            password TEXT,
+            name TEXT,
+            role TEXT
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS practice_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            date TEXT,
+            hours REAL,
+            technique TEXT,
+            notes TEXT,
+            UNIQUE(user_id, date),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS errors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            date TEXT,
+            piece TEXT,
+            error_text TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS special_notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            date TEXT,
+            note_text TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            teacher_id INTEGER,
+            title TEXT,
+            message TEXT,
+            timestamp TEXT,
+            attachment TEXT,
+            FOREIGN KEY(teacher_id) REFERENCES users(id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS public_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            teacher_id INTEGER,
+            file_name TEXT,
+            original_name TEXT,
+            file_type TEXT,
+            description TEXT,
+            timestamp TEXT,
+            FOREIGN KEY(teacher_id) REFERENCES users(id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS private_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            file_name TEXT,
+            original_name TEXT,
+            file_type TEXT,
+            description TEXT,
+            timestamp TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS suggestions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            suggestion TEXT,
+            timestamp TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+    # rollups: kept current by save_hours / delete_hours / add_note so the
+    # dashboard reads a handful of rows instead of scanning practice_entries
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS practice_rollup_daily (
+            user_id INTEGER,
+            date TEXT,
+            hours REAL DEFAULT 0,
+            entries INTEGER DEFAULT 0,
+            notes_count INTEGER DEFAULT 0,
+            PRIMARY KEY(user_id, date)
+        ) WITHOUT ROWID
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS practice_rollup_monthly (
+            user_id INTEGER,
+            month TEXT,
+            hours REAL DEFAULT 0,
+            days_practiced INTEGER DEFAULT 0,
+            notes_count INTEGER DEFAULT 0,
+            PRIMARY KEY(user_id, month)
+        ) WITHOUT ROWID
+    """)
+
+
+def m0002_reconcile_legacy_schema(conn):
+    """Fold the old init_db.py schema (practice_logs, file_path columns) in."""
+    if _table_exists(conn, "practice_logs"):
+        conn.execute("""
+            INSERT OR IGNORE INTO practice_entries (user_id, date, hours, technique, notes)
+            SELECT user_id, date, hours, '', notes FROM practice_logs ORDER BY id
+        """)
+        conn.execute("DROP TABLE practice_logs")
+
+    cols = _columns(conn, "notifications")
+    if "attachment" not in cols:
+        conn.execute("ALTER TABLE notifications ADD COLUMN attachment TEXT")
+    if "file_path" in cols:
+        conn.execute("UPDATE notifications SET attachment=file_path WHERE attachment IS NULL")
+        if _can_drop_column():
+            conn.execute("ALTER TABLE notifications DROP COLUMN file_path")
+
+    for table in ("public_files", "private_files"):
+        cols = _columns(conn, table)
+        if "original_name" not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN original_name TEXT")
+            conn.execute(f"UPDATE {table} SET original_name=file_name")
+        if "file_type" not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN file_type TEXT")
+            conn.execute(f"""
+                UPDATE {table} SET file_type=lower(replace(file_name, rtrim(file_name, replace(file_name, '.', '')), ''))
+                WHERE instr(file_name, '.') > 0
+            """)
+        if "file_path" in cols and _can_drop_column():
+            conn.execute(f"ALTER TABLE {table} DROP COLUMN file_path")
+
+
+def m0003_listing_indexes(conn):
+    """Indexes matching every per-user listing / lookup the routes run."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_errors_user_date ON errors(user_id, date DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_special_notes_user_date ON special_notes(user_id, date DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_teacher_ts ON notifications(teacher_id, timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_ts ON notifications(timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_public_files_teacher_ts ON public_files(teacher_id, timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_public_files_ts ON public_files(timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_private_files_user_ts ON private_files(user_id, timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_private_files_name ON private_files(file_name, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_suggestions_user_ts ON suggestions(user_id, timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, id)")
+
+
+def m0004_keyset_indexes(conn):
+    """Add id as a tie-breaker so keyset pages seek on (timestamp, id)."""
+    conn.execute("DROP INDEX IF EXISTS idx_notifications_teacher_ts")
+    conn.execute("DROP INDEX IF EXISTS idx_notifications_ts")
+    conn.execute("DROP INDEX IF EXISTS idx_public_files_ts")
+    conn.execute("DROP INDEX IF EXISTS idx_private_files_user_ts")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_teacher_ts ON notifications(teacher_id, timestamp DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_ts ON notifications(timestamp DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_public_files_ts ON public_files(timestamp DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_private_files_user_ts ON private_files(user_id, timestamp DESC, id DESC)")
+
+
+def m0005_notification_feed_state(conn):
+    """Shared feed version counter and per-student notification read cursors."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS feed_state (
+            name TEXT PRIMARY KEY,
+            version INTEGER DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT OR IGNORE INTO feed_state (name, version) VALUES ('notifications', 0)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notification_reads (
+            user_id INTEGER PRIMARY KEY,
+            last_seen_id INTEGER DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+
+
+def m0006_notification_events(conn):
+    """Outbox the sqlite push backend polls to fan events out across workers."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notification_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT,
+            created_at TEXT
+        )
+    """)
+
+
+def m0007_upload_sessions(conn):
+    """Resumable chunked uploads, plus stored sizes for per-user quotas."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            target TEXT,
+            file_name TEXT,
+            original_name TEXT,
+            description TEXT,
+            size INTEGER,
+            received INTEGER DEFAULT 0,
+            expected_sha256 TEXT,
+            sha256 TEXT,
+            created_at TEXT,
+            completed_at TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions(user_id, completed_at)")
+    for table in ("public_files", "private_files"):
+        if "size" not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN size INTEGER")
+
+
+def m0008_blob_store(conn):
+    """Reference-counted content-addressed blobs behind every stored upload."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER,
+            refcount INTEGER DEFAULT 0,
+            created_at TEXT
+        ) WITHOUT ROWID
+    """)
+    for table, col in (("public_files", "sha256"), ("private_files", "sha256"),
+                       ("notifications", "attachment_sha256")):
+        if col not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} TEXT")
+
+
+def m0009_file_name_indexes(conn):
+    """Stored-name lookups behind downloads and ETag revalidation."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_public_files_name ON public_files(file_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_attachment ON notifications(attachment)")
+
+
+def m0010_media_jobs(conn):
+    """Background queue for waveform, thumbnail and preview derivatives."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sha256 TEXT,
+            kind TEXT,
+            file_type TEXT,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            run_after REAL DEFAULT 0,
+            locked_until REAL,
+            error TEXT,
+            size INTEGER,
+            created_at TEXT,
+            finished_at TEXT,
+            UNIQUE(sha256, kind)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_jobs_status ON media_jobs(status, run_after)")
+    # media access checks look uploads up by content hash
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_public_files_sha ON public_files(sha256)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_private_files_sha ON private_files(sha256, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_attachment_sha ON notifications(attachment_sha256)")
+
+
+def m0011_library_catalog(conn):
+    """Library categories, and the change log the in-process catalog replays."""
+    for table in ("public_files", "private_files"):
+        if "category" not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN category TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS library_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            file_id INTEGER
+        )
+    """)
+
+
+def m0013_practice_entry_versions(conn):
+    """Per-entry version stamps for the batch / offline sync API."""
+    if "version" not in _columns(conn, "practice_entries"):
+        conn.execute("ALTER TABLE practice_entries ADD COLUMN version INTEGER DEFAULT 1")
+
+
+def m0014_persisted_suggestions(conn):
+    """Monthly technique counts, and kind/title columns for stored suggestions."""
+    for col in ("kind", "title"):
+        if col not in _columns(conn, "suggestions"):
+            conn.execute(f"ALTER TABLE suggestions ADD COLUMN {col} TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS practice_technique_monthly (
+            user_id INTEGER,
+            month TEXT,
+            technique TEXT,
+            entries INTEGER DEFAULT 0,
+            PRIMARY KEY(user_id, month, technique)
+        ) WITHOUT ROWID
+    """)
+    rebuild_technique_counts(conn)
+
+
+def m0015_suggestion_rules(conn):
+    """Teacher-defined suggestion rules."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS suggestion_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            teacher_id INTEGER,
+            name TEXT,
+            definition TEXT,
+            enabled INTEGER DEFAULT 1,
+            updated_at TEXT,
+            FOREIGN KEY(teacher_id) REFERENCES users(id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_suggestion_rules_teacher ON suggestion_rules(teacher_id, id)")
+    conn.execute("INSERT OR IGNORE INTO feed_state (name, version) VALUES ('suggestion_rules', 0)")
+
+
+def technique_key(technique):
+    """Techniques are free text; counts are kept per stripped, lower-cased name."""
+    return (technique or "").strip().lower()
+
+
+def rebuild_technique_counts(conn, user_id=None):
+    """Refill practice_technique_monthly from practice_entries. The caller commits."""
+    where = "" if user_id is None else "WHERE user_id = ?"
+    params = () if user_id is None else (user_id,)
+    conn.execute(f"DELETE FROM practice_technique_monthly {where}", params)
+    counts = {}
+    for uid, day, technique in conn.execute(f"SELECT user_id, date, technique FROM practice_entries {where}", params):
+        key = technique_key(technique)
+        if key and day:
+            counts[(uid, day[:7], key)] = counts.get((uid, day[:7], key), 0) + 1
+    conn.executemany("INSERT INTO practice_technique_monthly (user_id, month, technique, entries) "
+                     "VALUES (?, ?, ?, ?)", [k + (n,) for k, n in counts.items()])
+
+
+def rebuild_rollup_tables(conn, user_id=None):
+    """Refill the daily / monthly practice rollups and the monthly technique
+    counts from the raw tables (all users, or one). The caller commits."""
+    where = "" if user_id is None else "WHERE user_id = ?"
+    params = () if user_id is None else (user_id,)
+    conn.execute(f"DELETE FROM practice_rollup_daily {where}", params)
+    conn.execute(f"DELETE FROM practice_rollup_monthly {where}", params)
+    conn.execute(f"""
+        INSERT INTO practice_rollup_daily (user_id, date, hours, entries, notes_count)
+        SELECT user_id, date, SUM(hours), SUM(entries), SUM(notes_count) FROM (
+            SELECT user_id, date, COALESCE(hours, 0) AS hours, 1 AS entries,
+                   CASE WHEN notes IS NOT NULL AND notes != '' THEN 1 ELSE 0 END AS notes_count
+            FROM practice_entries {where}
+            UNION ALL
+            SELECT user_id, date, 0, 0, 1 FROM special_notes {where}
+        )
+        GROUP BY user_id, date
+    """, params + params)
+    conn.execute(f"""
+        INSERT INTO practice_rollup_monthly (user_id, month, hours, days_practiced, notes_count)
+        SELECT user_id, substr(date, 1, 7), SUM(hours), SUM(entries), SUM(notes_count)
+        FROM practice_rollup_daily {where}
+        GROUP BY user_id, substr(date, 1, 7)
+    """, params)
+    rebuild_technique_counts(conn, user_id)
+
+
+def rebuild_practice_days(conn, user_id=None):
+    """Refill the practice_days bitsets from practice_entries. The caller commits.
+
+    Bit i (little-endian within each byte) is set when the student has an
+    entry on day first_day + i, where first_day is a date ordinal.
+    """
+    where = "" if user_id is None else "WHERE user_id = ?"
+    params = () if user_id is None else (user_id,)
+    conn.execute(f"DELETE FROM practice_days {where}", params)
+    rows = conn.execute(f"""
+        SELECT user_id, CAST(julianday(date) - 1721424.5 AS INTEGER) AS day FROM practice_entries {where}
+        ORDER BY user_id, day
+    """, params)
+    out = []
+    for uid, group in itertools.groupby(rows, key=lambda r: r[0]):
+        days = [r[1] for r in group if r[1] is not None]
+        if not days:
+            continue
+        bits = bytearray((days[-1] - days[0]) // 8 + 1)
+        for d in days:
+            bits[(d - days[0]) >> 3] |= 1 << ((d - days[0]) & 7)
+        out.append((uid, days[0], bytes(bits)))
+    conn.executemany("INSERT INTO practice_days (user_id, first_day, bits) VALUES (?, ?, ?)", out)
+
+
+def m0016_practice_days(conn):
+    """Per-student practice-day bitsets for streaks and calendar heatmaps."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS practice_days (
+            user_id INTEGER PRIMARY KEY,
+            first_day INTEGER,
+            bits BLOB
+        ) WITHOUT ROWID
+    """)
+    rebuild_practice_days(conn)
+
+
+def m0017_response_cache_epoch(conn):
+    """A random per-database number in every response-cache key, so a shared
+    cache never serves entries written for a different (or recreated) database."""
+    conn.execute("INSERT OR IGNORE INTO feed_state (name, version) VALUES ('cache_epoch', ?)",
+                 (secrets.randbits(48),))
+
+
+def m0018_sessions(conn):
+    """Server-side sessions: the cookie carries only the random id."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            data TEXT,
+            expires_at REAL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)")
+
+
+def m0019_practice_tombstones(conn):
+    """Remember the version of deleted practice entries so a re-created day
+    carries on from it instead of restarting at 1 (a client still holding the
+    old version must conflict, not overwrite the new entry)."""
+    # the insert trigger below rewrites version, which must not reindex the row
+    for source in SEARCH_SOURCES:
+        drop_search_triggers(conn, source[0])
+        create_search_triggers(conn, source[0])
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS practice_tombstones (
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (user_id, date)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS practice_entries_tombstone_ad AFTER DELETE ON practice_entries BEGIN
+            INSERT OR REPLACE INTO practice_tombstones (user_id, date, version)
+            VALUES (old.user_id, old.date, old.version);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS practice_entries_tombstone_ai AFTER INSERT ON practice_entries
+        WHEN EXISTS (SELECT 1 FROM practice_tombstones WHERE user_id = new.user_id AND date = new.date) BEGIN
+            UPDATE practice_entries SET version = MAX(new.version, (
+                SELECT version + 1 FROM practice_tombstones WHERE user_id = new.user_id AND date = new.date
+            )) WHERE id = new.id;
+            DELETE FROM practice_tombstones WHERE user_id = new.user_id AND date = new.date;
+        END
+    """)
+
+
+def m0020_upload_session_expiry(conn):
+    """Lets the purge find expired unfinished uploads without a scan."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_pending ON upload_sessions(completed_at, created_at)")
+
+
+def m0021_suggestion_rules_version(conn):
+    """Stored suggestions remember the rules version they were computed with."""
+    if "rules_version" not in _columns(conn, "suggestions"):
+        conn.execute("ALTER TABLE suggestions ADD COLUMN rules_version INTEGER")
+
+
+# (table, kind code, title, body, scope, date) for each searchable source.
+# search_index rowids are id * 4 + kind code, so triggers can find a row's
+# entry without a lookup. scope holds "u<user id>" tokens (plus "all" for
+# notifications every student sees) and is matched as part of the query.
+SEARCH_SOURCES = (
+    ("practice_entries", 0, "{r}.technique", "{r}.notes", "'u' || {r}.user_id", "{r}.date"),
+    ("errors", 1, "{r}.piece", "{r}.error_text", "'u' || {r}.user_id", "{r}.date"),
+    ("special_notes", 2, "NULL", "{r}.note_text", "'u' || {r}.user_id", "{r}.date"),
+    ("notifications", 3, "{r}.title", "{r}.message", "'all u' || {r}.teacher_id", "substr({r}.timestamp, 1, 10)"),
+)
+
+
+def _search_row_sql(source, r):
+    """Column expressions for one source row aliased `r` (rowid, title, body, scope, day)."""
+    table, code, *exprs = source
+    return ", ".join([f"{r}.id * 4 + {code}"] + [e.format(r=r) for e in exprs])
+
+
+def _search_source(table):
+    return next(source for source in SEARCH_SOURCES if source[0] == table)
+
+
+def create_search_triggers(conn, table):
+    """Triggers that keep search_index in step with one source table."""
+    source = _search_source(table)
+    insert = f"INSERT INTO search_index (rowid, title, body, scope, day) VALUES ({_search_row_sql(source, 'new')});"
+    delete = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {source[1]};"
+    # only updates to indexed columns reindex (not e.g. practice_entries.version)
+    columns = ", ".join(dict.fromkeys(re.findall(r"\{r\}\.(\w+)", " ".join(source[2:]))))
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_ai AFTER INSERT ON {table} BEGIN {insert} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_ad AFTER DELETE ON {table} BEGIN {delete} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_au AFTER UPDATE OF {columns} ON {table} "
+                 f"BEGIN {delete} {insert} END")
+
+
+def drop_search_triggers(conn, table):
+    """For bulk writes inside one transaction: the caller reindexes the rows it
+    touched with reindex_search_rows() and recreates the triggers before committing."""
+    for suffix in ("ai", "ad", "au"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_search_{suffix}")
+
+
+def reindex_search_rows(conn, table, id_sql, params=()):
+    """Replace the search_index entries of the `table` rows whose ids `id_sql` selects."""
+    source = _search_source(table)
+    conn.execute(f"DELETE FROM search_index WHERE rowid IN (SELECT id * 4 + {source[1]} FROM ({id_sql}))", params)
+    conn.execute(f"INSERT INTO search_index (rowid, title, body, scope, day) "
+                 f"SELECT {_search_row_sql(source, 'r')} FROM {table} r WHERE r.id IN ({id_sql})", params)
+
+
+def rebuild_search_index(conn):
+    """Refill search_index from the source tables. The caller commits."""
+    conn.execute("DELETE FROM search_index")
+    for source in SEARCH_SOURCES:
+        conn.execute(f"INSERT INTO search_index (rowid, title, body, scope, day) "
+                     f"SELECT {_search_row_sql(source, source[0])} FROM {source[0]}")
+    conn.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+
+def m0012_search_index(conn):
+    """FTS5 index over notes, errors and notifications, kept current by triggers."""
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            title, body, scope, day UNINDEXED,
+            tokenize='porter unicode61 remove_diacritics 2'
+        )
+    """)
+    for source in SEARCH_SOURCES:
+        create_search_triggers(conn, source[0])
+    rebuild_search_index(conn)
+
+
+MIGRATIONS = [
+    (1, "baseline", m0001_baseline),
+    (2, "reconcile legacy init_db schema", m0002_reconcile_legacy_schema),
+    (3, "listing indexes", m0003_listing_indexes),
+    (4, "keyset pagination indexes", m0004_keyset_indexes),
+    (5, "notification feed state", m0005_notification_feed_state),
+    (6, "notification events", m0006_notification_events),
+    (7, "upload sessions", m0007_upload_sessions),
+    (8, "blob store", m0008_blob_store),
+    (9, "file name indexes", m0009_file_name_indexes),
+    (10, "media jobs", m0010_media_jobs),
+    (11, "library catalog", m0011_library_catalog),
+    (12, "full-text search", m0012_search_index),
+    (13, "practice entry versions", m0013_practice_entry_versions),
+    (14, "persisted suggestions", m0014_persisted_suggestions),
+    (15, "suggestion rules", m0015_suggestion_rules),
+    (16, "practice day bitsets", m0016_practice_days),
+    (17, "response cache epoch", m0017_response_cache_epoch),
+    (18, "server-side sessions", m0018_sessions),
+    (19, "practice entry tombstones", m0019_practice_tombstones),
+    (20, "upload session expiry", m0020_upload_session_expiry),
+    (21, "suggestion rules version", m0021_suggestion_rules_version),
+]
+
+
+# -------------------------
+# Runner
+# -------------------------
+def current_version(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TEXT
+        )
+    """)
+    conn.commit()
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """Apply pending migrations in order; returns the list of versions applied."""
+    applied = []
+    version = current_version(conn)
+    for number, name, fn in MIGRATIONS:
+        if number <= version:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # another worker may have migrated while we waited for the lock
+            done = conn.execute("SELECT 1 FROM schema_version WHERE version=?", (number,)).fetchone()
+            if not done:
+                fn(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                    (number, name, datetime.now().isoformat())
+                )
+                applied.append(number)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return applied
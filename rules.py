@@ -0,0 +1,330 @@
+# rules.py
+"""Declarative suggestion rules, compiled into vectorized evaluators.
+
+A rule is a JSON object:
+
+    {"name": "few-scales",
+     "title": "Scales need attention",
+     "message": "Only {scale_sessions} scale sessions in the last 14 days.",
+     "when": {"feature": "sessions", "days": 14, "technique": "scale",
+              "op": "<", "value": 3, "as": "scale_sessions"},
+     "students": [10001, 10002]}
+
+`when` is one condition or {"all": [...]} / {"any": [...]} of them, nested
+freely. A condition compares one feature of a student's recent practice
+with a number; its value is available to the title and message as {as}
+(default: the feature name), {as}_abs and with a format spec, e.g. {hours:.1f}.
+`students` optionally limits the rule to a cohort.
+
+compile_rules() collects the distinct features a rule set needs.
+RuleSet.extract() builds them for a whole batch of students from one pass
+over their practice rows (plus their monthly technique counts, for
+top_technique_count), and RuleSet.evaluate() applies every rule to every
+student at once with numpy, so cost grows with students and rows, not
+students x rules x rows.
+
+This module must not import app.py.
+"""
+import math
+import re
+from datetime import date
+
+import numpy as np
+
+MAX_WINDOW = 365            # days of history any feature may look at
+MAX_MONTHS = 12             # calendar months top_technique_count may look at
+DEFAULT_WINDOW = 90         # history used by streak / days_since_last
+
+# feature name -> whether it takes a "days" argument (top_technique_count
+# takes "months" instead)
+FEATURES = {
+    "hours": True,              # total hours in the last N days
+    "hours_prev": True,         # total hours in the N days before that
+    "hours_change_pct": True,   # last N days vs the N before, in percent (NaN if none before)
+    "sessions": True,           # days practiced in the last N days (optionally one technique)
+    "top_technique_count": True,  # entries of the most practiced technique this month and the
+                                  # months-1 before; text var {top_technique}
+    "streak": False,            # consecutive days practiced, ending today or yesterday
+    "days_since_last": False,   # days since the last session (inf if none in the window)
+}
+
+OPS = {
+    "<": np.less, "<=": np.less_equal, ">": np.greater,
+    ">=": np.greater_equal, "==": np.equal, "!=": np.not_equal,
+}
+
+# The original hard-coded suggestions, expressed as rules.
+DEFAULT_RULES = [
+    {"name": "consistency-up", "title": "Consistency improved",
+     "message": "Your practice time increased by {hours_change_pct:.0f}% vs previous week.",
+     "when": {"feature": "hours_change_pct", "days": 7, "op": ">=", "value": 10}},
+    {"name": "consistency-down", "title": "Consistency drop",
+     "message": "Your practice time dropped by {hours_change_pct_abs:.0f}% vs previous week. Try 3 short sessions.",
+     "when": {"feature": "hours_change_pct", "days": 7, "op": "<=", "value": -10}},
+    {"name": "new-streak", "title": "New streak",
+     "message": "Nice job starting a consistent practice! Keep going.",
+     "when": {"all": [{"feature": "hours_prev", "days": 7, "op": "==", "value": 0},
+                      {"feature": "hours", "days": 7, "op": ">", "value": 0}]}},
+    {"name": "focus-area", "title": "Focus area",
+     "message": "You've practiced '{top_technique}' {top_technique_count} times recently — consider drilling it deliberately.",
+     "when": {"feature": "top_technique_count", "months": 3, "op": ">=", "value": 1}},
+    {"name": "low-practice", "title": "Low practice",
+     "message": "You practiced less than 2 hours in the last 30 days. Try a 10-minute daily goal.",
+     "when": {"feature": "hours", "days": 30, "op": "<", "value": 2}},
+    {"name": "streak", "title": "{streak}-day streak",
+     "message": "You've practiced {streak} days in a row — keep it going!",
+     "when": {"feature": "streak", "op": ">=", "value": 3}},
+    {"name": "nudge", "title": "Pick it back up",
+     "message": "It's been {days_since_last} days since your last session. Even 10 minutes today keeps the momentum.",
+     "when": {"all": [{"feature": "streak", "op": "<", "value": 3},
+                      {"feature": "days_since_last", "op": ">=", "value": 3},
+                      {"feature": "days_since_last", "op": "<", "value": DEFAULT_WINDOW}]}},
+]
+
+ON_TRACK = ("on_track", "On track", "Your practice is steady. Keep logging sessions for more tailored tips.")
+
+_placeholder = re.compile(r"\{(\w+)(?::([^{}]*))?\}")
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _day_offsets(days, today):
+    """Days before `today` for each ISO date string; -1 for unparseable ones."""
+    try:
+        parsed = np.asarray([day[:10] for day in days], dtype="datetime64[D]")
+    except (TypeError, ValueError):
+        parsed = np.asarray([_parse_day(day) for day in days], dtype="datetime64[D]")
+    offsets = (np.datetime64(today, "D") - parsed).astype(np.int64)
+    return np.where(np.isnat(parsed), -1, offsets)
+
+
+def _month_index(months):
+    """year * 12 + month - 1 for each 'YYYY-MM' string; -1 for unparseable ones."""
+    out = np.full(len(months), -1, dtype=np.int64)
+    for k, month in enumerate(months):
+        try:
+            out[k] = int(month[:4]) * 12 + int(month[5:7]) - 1
+        except (TypeError, ValueError):
+            pass
+    return out
+
+
+def _parse_day(day):
+    try:
+        return date.fromisoformat(day[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def _feature_key(cond):
+    name = cond.get("feature")
+    if name not in FEATURES:
+        raise RuleError(f"unknown feature {name!r}")
+    days = None
+    if name == "top_technique_count":
+        # read from monthly counts, so the window is whole calendar months;
+        # a "days" window is rounded up to months
+        months = cond.get("months")
+        if months is None and isinstance(cond.get("days"), int) and cond["days"] >= 1:
+            months = math.ceil(cond["days"] / 30)
+        if not isinstance(months, int) or not 1 <= months <= MAX_MONTHS:
+            raise RuleError(f"{name} needs 'months' between 1 and {MAX_MONTHS}")
+        return name, months, None
+    if FEATURES[name]:
+        limit = MAX_WINDOW // 2 if name in ("hours_prev", "hours_change_pct") else MAX_WINDOW
+        days = cond.get("days")
+        if not isinstance(days, int) or not 1 <= days <= limit:
+            raise RuleError(f"{name} needs 'days' between 1 and {limit}")
+    technique = None
+    if name == "sessions" and cond.get("technique"):
+        technique = str(cond["technique"]).strip().lower() or None
+    return name, days, technique
+
+
+def _compile_when(node, aliases, keys):
+    if not isinstance(node, dict):
+        raise RuleError("conditions must be objects")
+    for combinator, reduce in (("all", np.logical_and.reduce), ("any", np.logical_or.reduce)):
+        if combinator in node:
+            parts = node[combinator]
+            if not isinstance(parts, list) or not parts:
+                raise RuleError(f"'{combinator}' needs a non-empty list")
+            compiled = [_compile_when(p, aliases, keys) for p in parts]
+            return lambda F, compiled=compiled, reduce=reduce: reduce([p(F) for p in compiled])
+    key = _feature_key(node)
+    op = OPS.get(node.get("op"))
+    if op is None:
+        raise RuleError(f"op must be one of {', '.join(OPS)}")
+    try:
+        value = float(node.get("value"))
+    except (TypeError, ValueError):
+        raise RuleError("value must be a number")
+    keys.add(key)
+    aliases[str(node.get("as") or key[0])] = key
+    return lambda F: op(F[key], value)
+
+
+class CompiledRule:
+    def __init__(self, rule, kind):
+        if not isinstance(rule, dict):
+            raise RuleError("a rule must be an object")
+        self.kind = kind
+        self.title = str(rule.get("title") or "").strip()[:200]
+        self.message = str(rule.get("message") or "").strip()[:500]
+        if not self.title or not self.message:
+            raise RuleError("a rule needs a title and a message")
+        self.aliases, self.keys = {}, set()
+        self.predicate = _compile_when(rule.get("when"), self.aliases, self.keys)
+        students = rule.get("students")
+        if students and not isinstance(students, list):
+            raise RuleError("students must be a list of user ids")
+        try:
+            self.students = np.array(sorted({int(s) for s in students})) if students else None
+        except (TypeError, ValueError):
+            raise RuleError("students must be a list of user ids")
+
+    def render(self, F, text, i):
+        """(title, message) for student i, with placeholders filled in."""
+        values = {}
+        for alias, key in self.aliases.items():
+            v = float(F[key][i])
+            v = int(v) if math.isfinite(v) and v == int(v) else v
+            values[alias], values[alias + "_abs"] = v, abs(v)
+        # text columns are per window: {top_technique} names the technique
+        # counted by this rule's own top_technique_count (the shortest, if several)
+        top = [k[1] for k in self.keys if k[0] == "top_technique_count"]
+        if top:
+            values["top_technique"] = text[("top_technique", min(top))][i]
+
+        def sub(m):
+            if m.group(1) not in values:
+                return m.group(0)
+            try:
+                return format(values[m.group(1)], m.group(2) or "")
+            except (TypeError, ValueError):
+                return str(values[m.group(1)])
+        return _placeholder.sub(sub, self.title), _placeholder.sub(sub, self.message)
+
+
+def compile_rule(rule, kind="custom"):
+    """Validate one rule definition; raises RuleError with a readable reason."""
+    return CompiledRule(rule, kind)
+
+
+class RuleSet:
+    """A compiled list of rules sharing one feature-extraction pass."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.keys = set().union(*(r.keys for r in rules)) if rules else set()
+        spans = [k[1] * (2 if k[0] in ("hours_prev", "hours_change_pct") else 1)
+                 for k in self.keys if k[1] and k[0] != "top_technique_count"]
+        if any(k[0] in ("streak", "days_since_last") for k in self.keys):
+            spans.append(DEFAULT_WINDOW)
+        self.window = min(max(spans, default=1), MAX_WINDOW)
+        self.techniques = sorted({k[2] for k in self.keys if k[2]})
+        self.top_months = sorted({k[1] for k in self.keys if k[0] == "top_technique_count"})
+
+    def extract(self, user_ids, rows, today=None, technique_counts=()):
+        """Feature columns for `user_ids` from (user_id, date, hours, technique) rows
+        and (user_id, month, technique, entries) monthly technique counts.
+
+        Rows outside the window or for other users are ignored. Returns
+        (features, text) where each value is an array aligned with user_ids;
+        text is keyed by (variable, window).
+        """
+        today = today or date.today()
+        n, w = len(user_ids), self.window
+        hours = np.zeros((n, w))
+        practiced = np.zeros((n, w), dtype=bool)
+        masks = {t: np.zeros((n, w), dtype=bool) for t in self.techniques}
+
+        columns = list(zip(*rows)) or [(), (), (), ()]
+        ids = np.asarray(user_ids, dtype=np.int64)
+        uid = np.asarray(columns[0], dtype=np.int64)
+        i = np.minimum(np.searchsorted(ids, uid), max(n - 1, 0))
+        d = _day_offsets(columns[1], today)
+        keep = (ids[i] == uid) & (d >= 0) & (d < w) if n else np.zeros(len(uid), dtype=bool)
+        i, d = i[keep], d[keep]
+        np.add.at(hours, (i, d), np.nan_to_num(np.asarray(columns[2], dtype=float)[keep]))
+        practiced[i, d] = True
+
+        # techniques are free text with few distinct values: normalize and
+        # match each distinct value once, then broadcast through the codes
+        distinct, codes = np.unique(np.asarray([t or "" for t in columns[3]], dtype=str)[keep], return_inverse=True)
+        names, key_codes = np.unique([t.strip().lower() for t in distinct], return_inverse=True)
+        codes = key_codes[codes] if codes.size else codes
+        for t, mask in masks.items():
+            hit = np.array([t in name for name in names], dtype=bool)[codes]
+            mask[i[hit], d[hit]] = True
+
+        hours_sum = hours.cumsum(axis=1)
+        session_sums = {None: practiced.cumsum(axis=1)}
+        session_sums.update((t, m.cumsum(axis=1)) for t, m in masks.items())
+
+        def run_length(m):
+            return np.where(m.all(axis=1), m.shape[1], np.argmin(m, axis=1))
+
+        F, text = {}, {}
+        for key in self.keys:
+            name, days, technique = key
+            if name == "hours":
+                F[key] = hours_sum[:, days - 1]
+            elif name in ("hours_prev", "hours_change_pct"):
+                last = hours_sum[:, days - 1]
+                prev = hours_sum[:, 2 * days - 1] - last
+                if name == "hours_prev":
+                    F[key] = prev
+                else:
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        F[key] = np.where(prev > 0, (last - prev) / prev * 100, np.nan)
+            elif name == "sessions":
+                F[key] = session_sums[technique][:, days - 1]
+            elif name == "streak":
+                from_today = run_length(practiced)
+                from_yesterday = run_length(practiced[:, 1:]) if w > 1 else np.zeros(n, dtype=int)
+                F[key] = np.where(practiced[:, 0], from_today, from_yesterday)
+            elif name == "days_since_last":
+                F[key] = np.where(practiced.any(axis=1), np.argmax(practiced, axis=1), np.inf)
+        if self.top_months:
+            # monthly counts are keyed by the normalized technique already
+            columns = list(zip(*technique_counts)) or [(), (), (), ()]
+            uid = np.asarray(columns[0], dtype=np.int64)
+            ti = np.minimum(np.searchsorted(ids, uid), max(n - 1, 0))
+            tm = today.year * 12 + today.month - 1 - _month_index(columns[1])
+            keep = (ids[ti] == uid) & (tm >= 0) & (tm < self.top_months[-1]) if n else np.zeros(len(uid), dtype=bool)
+            names, codes = np.unique(np.asarray(columns[2], dtype=str)[keep], return_inverse=True)
+            ti, tm, entries = ti[keep], tm[keep], np.asarray(columns[3], dtype=np.int64)[keep]
+        for months in self.top_months:
+            # most entries per student, ties broken alphabetically
+            sel = (tm < months) & (entries > 0)
+            pairs, inverse = np.unique(ti[sel] * len(names) + codes[sel], return_inverse=True)
+            counts = np.bincount(inverse, weights=entries[sel], minlength=len(pairs)).astype(np.int64)
+            student, code = pairs // max(len(names), 1), pairs % max(len(names), 1)
+            order = np.lexsort((code, -counts, student))
+            first = order[np.r_[True, student[order][1:] != student[order][:-1]]] if order.size else order
+            top_count, top_name = np.zeros(n), np.empty(n, dtype=object)
+            top_count[student[first]] = counts[first]
+            top_name[student[first]] = names[code[first]]
+            F[("top_technique_count", months, None)] = top_count
+            text[("top_technique", months)] = top_name
+        return F, text
+
+    def evaluate(self, user_ids, F, text):
+        """[(kind, title, message), ...] per student, aligned with user_ids."""
+        results = [[] for _ in user_ids]
+        ids = np.asarray(user_ids)
+        for rule in self.rules:
+            hit = np.asarray(rule.predicate(F), dtype=bool)
+            if rule.students is not None:
+                hit &= np.isin(ids, rule.students)
+            for i in np.flatnonzero(hit):
+                results[i].append((rule.kind,) + rule.render(F, text, i))
+        return [r or [ON_TRACK] for r in results]
+
+
+def compile_rules(definitions):
+    """[(kind, rule dict)] -> RuleSet; invalid rules raise RuleError."""
+    return RuleSet([compile_rule(rule, kind) for kind, rule in definitions])
@@ -1,29 +1,82 @@
-async function loadLibrary(mode) {
-    const response = await fetch(`/get_library?mode=${mode}`);
-    const files = await response.json();
+function escapeText(value) {
+    const div = document.createElement("div");
+    div.textContent = value == null ? "" : String(value);
+    return div.innerHTML;
+}
+
+// current query per container, so "Load more" continues the same listing
+const libraryState = {};
+
+function libraryQuery(mode) {
+    const params = new URLSearchParams({ mode });
+    const search = document.getElementById("search");
+    const category = document.getElementById("categoryFilter");
+    const sortOrder = document.getElementById("sortOrder");
+    if (search && search.value.trim()) params.set("q", search.value.trim());
+    if (category && category.value !== "all") params.set("category", category.value);
+    if (sortOrder) params.set("sort", sortOrder.value);
+    return params;
+}
 
+async function loadLibrary(mode, append = false) {
     const container = document.getElementById(
         mode === "public" ? "musicContainer" : "manageContainer"
     );
-    container.innerHTML = "";
+    const params = append ? libraryState[mode].params : libraryQuery(mode);
+    if (append) params.set("cursor", libraryState[mode].next);
+
+    const response = await fetch(`/get_library?${params}`);
+    const data = await response.json();
+    libraryState[mode] = { params, next: data.next_cursor };
+
+    if (!append) container.innerHTML = "";
+    const oldMore = container.querySelector(".load-more");
+    if (oldMore) oldMore.remove();
 
-    files.forEach(file => {
+    data.items.forEach(file => {
         const card = document.createElement("div");
         card.className = "card";
 
+        const preview = file.media && file.media.preview ? file.media.preview : file.url;
         card.innerHTML = `
-            <h3>${file.name}</h3>
-            <p class="category">${file.category}</p>
-            <audio controls src="/static/${file.path}"></audio>
+            <h3>${escapeText(file.name)}</h3>
+            <p class="category">${escapeText(file.category || "")}</p>
+            ${file.media && file.media.thumbnail ? `<img src="${file.media.thumbnail}" alt="">` : ""}
+            ${file.file_type === "pdf"
+                ? `<a href="${file.url}">Open</a>`
+                : `<audio controls preload="none" src="${preview}"></audio>`}
             ${mode === "private" ? `
-                <button onclick="deleteFile('${file.path}')">Delete</button>
+                <button onclick="deleteFile('${escapeText(file.path)}')">Delete</button>
             ` : ""}
         `;
 
         container.appendChild(card);
     });
+
+    if (data.next_cursor) {
+        const more = document.createElement("button");
+        more.className = "load-more";
+        more.textContent = "Load more";
+        more.onclick = () => loadLibrary(mode, true);
+        container.appendChild(more);
+    }
 }
 
+// re-query when the public library's filters change
+document.addEventListener("DOMContentLoaded", () => {
+    const search = document.getElementById("search");
+    if (!search) return;
+    let timer = null;
+    search.addEventListener("input", () => {
+        clearTimeout(timer);
+        timer = setTimeout(() => loadLibrary("public"), 200);
+    });
+    ["categoryFilter", "sortOrder"].forEach(id => {
+        const el = document.getElementById(id);
+        if (el) el.addEventListener("change", () => loadLibrary("public"));
+    });
+});
+
 // ========== UPLOAD FILE (PRIVATE ONLY) ==========
 async function uploadFile() {
     const file = document.getElementById("fileInput").files[0];
@@ -0,0 +1,79 @@
+// static/script.js
+
+/* ---------- infinite scroll for keyset-paginated listings ----------
+   <div class="load-more" data-endpoint="/api/errors" data-cursor="..."></div>
+   initInfiniteScroll(sentinel, container, item => "<div>...</div>")
+*/
+function initInfiniteScroll(sentinel, container, renderItem) {
+    if (!sentinel || !sentinel.dataset.cursor) return;
+    let loading = false;
+
+    async function loadNext() {
+        const cursor = sentinel.dataset.cursor;
+        if (loading || !cursor) return;
+        loading = true;
+        try {
+            const sep = sentinel.dataset.endpoint.includes("?") ? "&" : "?";
+            const res = await fetch(`${sentinel.dataset.endpoint}${sep}cursor=${encodeURIComponent(cursor)}`);
+            if (!res.ok) throw new Error("Network error");
+            const page = await res.json();
+            page.items.forEach(item => container.insertAdjacentHTML("beforeend", renderItem(item)));
+            sentinel.dataset.cursor = page.next_cursor || "";
+            if (!page.next_cursor) observer.disconnect();
+        } catch (e) {
+            console.error("Load more failed:", e);
+        } finally {
+            loading = false;
+        }
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(e => e.isIntersecting)) loadNext();
+    }, { rootMargin: "200px" });
+    observer.observe(sentinel);
+}
+
+function escapeHtml(s) {
+    return String(s == null ? "" : s)
+        .replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;")
+        .replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+}
+
+/* ---------- chunked, resumable uploads (/api/uploads) ----------
+   chunkedUpload(file, {target: "private", description: ""}, pct => ...)
+   Re-calling with the same upload_id resumes from the server's offset.
+*/
+async function chunkedUpload(file, opts = {}, onProgress = () => {}) {
+    let status;
+    if (opts.uploadId) {
+        status = await (await fetch(`/api/uploads/${opts.uploadId}`)).json();
+    } else {
+        const res = await fetch("/api/uploads", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({
+                filename: file.name,
+                size: file.size,
+                target: opts.target || "private",
+                description: opts.description || ""
+            })
+        });
+        status = await res.json();
+        if (!res.ok) throw new Error(status.error || "Upload failed");
+    }
+
+    while (!status.complete) {
+        const start = status.offset;
+        const end = Math.min(start + status.chunk_size, file.size);
+        const res = await fetch(`/api/uploads/${status.upload_id}`, {
+            method: "PUT",
+            headers: { "Content-Range": `bytes ${start}-${end - 1}/${file.size}` },
+            body: file.slice(start, end)
+        });
+        const next = await res.json();
+        if (!res.ok && res.status !== 409) throw new Error(next.error || "Upload failed");
+        status = next;
+        onProgress(Math.round(status.offset * 100 / file.size));
+    }
+    return status;
+}
@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app reads its configuration at import time
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(prefix="practice-tests-"), "test.db"))
+os.environ.setdefault("MEDIA_WORKERS", "0")
+os.environ.setdefault("LOGIN_BURST", "1000000")
+os.environ.setdefault("PASSWORD_HASH_METHOD", "pbkdf2:sha256:1")
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    import app as app_module
+    with app_module.app.app_context():
+        app_module.init_tables()
+        app_module.ensure_default_users()
+    return app_module
+
+
+@pytest.fixture
+def db(app_module):
+    with app_module.app.app_context():
+        yield app_module.get_db()
+
+
+@pytest.fixture
+def login(app_module):
+    """login(username) -> a test client with a session for that seeded user."""
+    def login(username):
+        client = app_module.app.test_client()
+        resp = client.post("/login", data={"username": username, "password": username})
+        assert resp.status_code == 302
+        return client
+    return login
@@ -0,0 +1,45 @@
+def test_metrics_needs_token_or_debug_admin(app_module, login, monkeypatch):
+    client = app_module.app.test_client()
+    # the test client connects from 127.0.0.1, as a reverse proxy would
+    assert client.get("/metrics").status_code == 403
+
+    monkeypatch.setattr(app_module, "METRICS_LOOPBACK", True)
+    assert client.get("/metrics").status_code == 200
+    monkeypatch.setattr(app_module, "METRICS_LOOPBACK", False)
+
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+    assert login("10001").get("/metrics").status_code == 403
+    assert login("70001").get("/metrics").status_code == 200
+
+
+def test_pool_timeout_is_a_503_with_retry_after(app_module, login, monkeypatch):
+    client = login("10006")
+    sessions = app_module.app.session_interface
+    pool = app_module.ConnectionPool(app_module.DB_PATH, size=1, timeout=0.01)
+    held = pool.checkout()
+    monkeypatch.setattr(app_module, "_pool", pool)
+    try:
+        resp = client.get("/api/practice_entries?month=2024-01")
+        assert resp.status_code == 503 and resp.headers["Retry-After"] == "2"
+        assert resp.json == {"error": "busy"}
+
+        # a cached session due for a recheck is served as-is; the view then times out
+        sid = client.get_cookie(app_module.app.config["SESSION_COOKIE_NAME"]).value
+        data, expires_at, _ = sessions.cache.get(sid)
+        sessions.cache.set(sid, (data, expires_at, 0.0))
+        user, _ = app_module.user_cache.get(10006)
+        app_module.user_cache.set(10006, (user, 0.0))
+        resp = client.get("/api/practice_entries?month=2024-01")
+        assert resp.status_code == 503 and resp.headers["Retry-After"] == "2"
+
+        # with nothing cached the session can't be read at all
+        sessions.cache.clear()
+        resp = client.get("/api/practice_entries?month=2024-01")
+        assert resp.status_code == 503 and resp.headers["Retry-After"] == "2"
+        assert "Set-Cookie" not in resp.headers
+        assert pool.stats()["timeouts"] >= 3
+    finally:
+        held.close()
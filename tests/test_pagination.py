@@ -0,0 +1,16 @@
+import base64
+import json
+
+import pytest
+
+
+def cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+@pytest.mark.parametrize("value", [[["x"], 5], [{"a": 1}, 5], [True, 5], [None, 5], [2 ** 70, 5], ["x", 1e400]])
+def test_tampered_cursor_gets_the_first_page(login, value):
+    client = login("10015")
+    first = client.get("/api/errors")
+    resp = client.get("/api/errors", query_string={"cursor": cursor(value)})
+    assert resp.status_code == 200 and resp.json == first.json
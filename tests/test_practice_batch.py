@@ -0,0 +1,106 @@
+import migrations
+
+
+def batch(client, *ops, **extra):
+    resp = client.post("/api/practice_entries/batch", json=dict(extra, ops=list(ops)))
+    assert resp.status_code == 200, resp.data
+    return resp.json
+
+
+def upsert(date, base_version, hours=1.0, technique="", notes=""):
+    return {"op": "upsert", "date": date, "hours": hours, "technique": technique,
+            "notes": notes, "base_version": base_version}
+
+
+def delete(date, base_version):
+    return {"op": "delete", "date": date, "base_version": base_version}
+
+
+def rollups(db, user_id):
+    daily = db.execute("SELECT date, hours, entries, notes_count FROM practice_rollup_daily "
+                       "WHERE user_id=? AND entries != 0 ORDER BY date", (user_id,)).fetchall()
+    monthly = db.execute("SELECT month, hours, days_practiced, notes_count FROM practice_rollup_monthly "
+                         "WHERE user_id=? AND days_practiced != 0 ORDER BY month", (user_id,)).fetchall()
+    return [tuple(r) for r in daily], [tuple(r) for r in monthly]
+
+
+def test_stale_base_version_conflicts(login):
+    client = login("10001")
+    out = batch(client, upsert("2024-03-01", 0, hours=1))
+    assert out["applied"] == [{"date": "2024-03-01", "version": 1}]
+
+    out = batch(client, upsert("2024-03-01", 1, hours=2))
+    assert out["applied"] == [{"date": "2024-03-01", "version": 2}]
+
+    # a second device still holding version 1
+    out = batch(client, upsert("2024-03-01", 1, hours=5), delete("2024-03-01", 1))
+    assert out["applied"] == []
+    assert out["conflicts"] == [{"date": "2024-03-01",
+                                 "server": {"hours": 2.0, "technique": "", "notes": "", "version": 2}}]
+    assert out["entries"]["2024-03-01"]["hours"] == 2.0
+
+
+def test_ops_in_one_batch_chain_versions(login):
+    client = login("10002")
+    out = batch(client, upsert("2024-03-02", 0, hours=1), upsert("2024-03-02", 1, hours=3))
+    assert out["applied"] == [{"date": "2024-03-02", "version": 2}]
+    assert out["conflicts"] == []
+    assert out["entries"]["2024-03-02"]["hours"] == 3.0
+
+
+def test_recreate_after_delete_does_not_reuse_versions(login):
+    client = login("10003")
+    batch(client, upsert("2024-03-03", 0, hours=1))
+    batch(client, upsert("2024-03-03", 1, hours=2))
+    out = batch(client, delete("2024-03-03", 2))
+    assert out["applied"] == [{"date": "2024-03-03", "version": None}]
+    assert out["entries"] == {}
+
+    out = batch(client, upsert("2024-03-03", 0, hours=4))
+    assert out["applied"] == [{"date": "2024-03-03", "version": 3}]
+
+    # a client that last saw the deleted entry at version 1 or 2 must conflict
+    for stale in (1, 2):
+        out = batch(client, upsert("2024-03-03", stale, hours=9))
+        assert out["applied"] == []
+        assert out["conflicts"][0]["server"]["version"] == 3
+    assert out["entries"]["2024-03-03"]["hours"] == 4.0
+
+
+def test_delete_and_recreate_in_one_batch(login):
+    client = login("10004")
+    batch(client, upsert("2024-03-04", 0, hours=1))
+    out = batch(client, delete("2024-03-04", 1), upsert("2024-03-04", 0, hours=2))
+    assert out["applied"] == [{"date": "2024-03-04", "version": 2}]
+    assert out["entries"]["2024-03-04"]["version"] == 2
+
+
+def test_recreate_through_save_hours_continues_versions(login):
+    client = login("10005")
+    batch(client, upsert("2024-03-05", 0), upsert("2024-03-05", 1))
+    assert client.post("/delete_hours", data={"date": "2024-03-05"}).status_code == 200
+    assert client.post("/save_hours", data={"date": "2024-03-05", "hours": "1.5"}).status_code == 200
+
+    out = batch(client, upsert("2024-03-05", 2, hours=9))
+    assert out["applied"] == []
+    assert out["conflicts"][0]["server"]["version"] == 3
+
+
+def test_rollup_deltas_match_rebuild(login, db):
+    client = login("10006")
+    batch(client,
+          upsert("2024-04-01", 0, hours=1, notes="scales"),
+          upsert("2024-04-02", 0, hours=2),
+          upsert("2024-05-01", 0, hours=3, notes="etude"))
+    batch(client,
+          upsert("2024-04-01", 1, hours=1.5),              # notes removed
+          delete("2024-04-02", 1),
+          upsert("2024-05-01", 1, hours=0.5, notes="etude"),
+          upsert("2024-05-02", 0, hours=1, notes="piece"),
+          upsert("2024-04-01", 1, hours=7))                # conflict: must not count
+    daily, monthly = rollups(db, 10006)
+    assert daily == [("2024-04-01", 1.5, 1, 0), ("2024-05-01", 0.5, 1, 1), ("2024-05-02", 1.0, 1, 1)]
+    assert monthly == [("2024-04", 1.5, 1, 0), ("2024-05", 1.5, 2, 2)]
+
+    migrations.rebuild_rollup_tables(db, 10006)
+    assert rollups(db, 10006) == (daily, monthly)
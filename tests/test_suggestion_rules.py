@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+
+RULE = {"title": "Any practice", "message": "{hours:.1f} hours", "when": {"feature": "hours", "days": 7, "op": ">=", "value": 0}}
+
+
+def stored(db, user_id):
+    return db.execute("SELECT title, rules_version FROM suggestions WHERE user_id=? ORDER BY id", (user_id,)).fetchall()
+
+
+def test_rule_change_recomputes_lazily(app_module, login, db):
+    student, teacher = login("10031"), login("70002")
+    assert student.get("/suggestions").status_code == 200
+    before = stored(db, 10031)
+    assert before and "Any practice" not in [r["title"] for r in before]
+
+    resp = teacher.post("/api/suggestion_rules", json={"rule": RULE})
+    assert resp.status_code == 201
+    db.commit()     # end the read snapshot
+    # nothing is deleted up front; the rows are just out of date
+    assert [tuple(r) for r in stored(db, 10031)] == [tuple(r) for r in before]
+
+    assert student.get("/suggestions").status_code == 200
+    db.commit()
+    after = stored(db, 10031)
+    assert "Any practice" in [r["title"] for r in after]
+    assert {r["rules_version"] for r in after} == {app_module.get_rules_version(db)}
+
+    teacher.delete(f"/api/suggestion_rules/{resp.json['id']}")
+
+
+def test_preview_pages_through_students(login):
+    teacher = login("70002")
+    first = teacher.post("/api/suggestion_rules/preview", json={"rule": RULE, "limit": 20}).json
+    assert first["students"] == 20 and first["next_after"] == 10020
+    rest = teacher.post("/api/suggestion_rules/preview", json={"rule": RULE, "limit": 20, "after": 10040}).json
+    assert rest["students"] == 10 and rest["next_after"] is None
+
+    cohort = teacher.post("/api/suggestion_rules/preview", json={"rule": dict(RULE, students=[10002, 10005])}).json
+    assert cohort["students"] == 2 and cohort["matched"] == 2
+
+
+def technique_counts(db, user_id):
+    return {(r["month"], r["technique"]): r["entries"] for r in db.execute(
+        "SELECT month, technique, entries FROM practice_technique_monthly WHERE user_id=?", (user_id,))}
+
+
+def test_focus_area_reads_maintained_technique_counts(app_module, login, db):
+    student = login("10032")
+    days = [(date.today() - timedelta(days=i)).isoformat() for i in range(3)]
+    ops = [{"op": "upsert", "date": d, "hours": 1, "technique": t, "base_version": 0}
+           for d, t in zip(days, ["Scales ", " scales", "Arpeggios"])]
+    assert student.post("/api/practice_entries/batch", json={"ops": ops}).json["conflicts"] == []
+    # re-tag one scales day and delete the arpeggios day
+    ops = [{"op": "upsert", "date": days[1], "hours": 1, "technique": "Etudes", "base_version": 1},
+           {"op": "delete", "date": days[2], "base_version": 1}]
+    assert student.post("/api/practice_entries/batch", json={"ops": ops}).json["conflicts"] == []
+    db.commit()
+
+    counts = technique_counts(db, 10032)
+    assert sum(n for (_, t), n in counts.items() if t == "scales") == 1
+    assert sum(n for (_, t), n in counts.items() if t == "etudes") == 1
+    assert all(t != "arpeggios" for _, t in counts)
+    app_module.rebuild_rollups(db, 10032)
+    assert technique_counts(db, 10032) == counts
+
+    focus = [r["suggestion"] for r in db.execute(
+        "SELECT suggestion FROM suggestions WHERE user_id=? AND kind='focus-area'", (10032,))]
+    assert focus == ["You've practiced 'etudes' 1 times recently — consider drilling it deliberately."]
+
+
+def test_top_technique_name_follows_each_rules_window():
+    import rules
+    ruleset = rules.RuleSet([
+        rules.compile_rule({"title": "1m", "message": "{top_technique} {top_technique_count}",
+                            "when": {"feature": "top_technique_count", "months": 1, "op": ">=", "value": 1}}, "one"),
+        rules.compile_rule({"title": "3m", "message": "{top_technique} {top_technique_count}",
+                            "when": {"feature": "top_technique_count", "months": 3, "op": ">=", "value": 1}}, "three"),
+    ])
+    counts = [(1, "2024-05", "arpeggio", 2), (1, "2024-03", "scales", 10)]
+    features, text = ruleset.extract([1], [], date(2024, 5, 15), counts)
+    assert [m for _, _, m in ruleset.evaluate([1], features, text)[0]] == ["arpeggio 2", "scales 10"]
@@ -0,0 +1,85 @@
+import fcntl
+import io
+import os
+from datetime import datetime, timedelta
+
+
+def start_upload(client, size, filename="take.mp3"):
+    resp = client.post("/api/uploads", json={"filename": filename, "size": size, "target": "private"})
+    assert resp.status_code == 201, resp.data
+    return resp.json
+
+
+def put_chunk(client, upload_id, start, data, size):
+    return client.put(f"/api/uploads/{upload_id}", data=data,
+                      headers={"Content-Range": f"bytes {start}-{start + len(data) - 1}/{size}"})
+
+
+def part_path(app_module, db, upload_id):
+    return app_module.upload_part_path(db.execute("SELECT * FROM upload_sessions WHERE id=?", (upload_id,)).fetchone())
+
+
+def test_chunks_resume_and_finish(login):
+    client = login("10011")
+    up = start_upload(client, 10)
+    assert put_chunk(client, up["upload_id"], 0, b"01234", 10).status_code == 202
+    # a retry of the same chunk is out of sync
+    resp = put_chunk(client, up["upload_id"], 0, b"01234", 10)
+    assert resp.status_code == 409 and resp.json["offset"] == 5
+    resp = put_chunk(client, up["upload_id"], 5, b"56789", 10)
+    assert resp.status_code == 201 and resp.json["complete"]
+
+
+def test_concurrent_chunk_is_refused(app_module, login, db):
+    client = login("10012")
+    up = start_upload(client, 10)
+    with open(part_path(app_module, db, up["upload_id"]), "r+b") as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        resp = put_chunk(client, up["upload_id"], 0, b"01234", 10)
+    assert resp.status_code == 409 and resp.json["offset"] == 0
+    assert put_chunk(client, up["upload_id"], 0, b"01234", 10).status_code == 202
+
+
+def test_expired_uploads_release_quota_and_are_purged(app_module, login, db):
+    client = login("10013")
+    up = start_upload(client, 1000)
+    path = part_path(app_module, db, up["upload_id"])
+    assert app_module.quota_used(db, 10013) == 1000
+
+    old = (datetime.now() - timedelta(seconds=app_module.UPLOAD_SESSION_TTL + 60)).isoformat()
+    db.execute("UPDATE upload_sessions SET created_at=? WHERE id=?", (old, up["upload_id"]))
+    db.commit()
+    assert app_module.quota_used(db, 10013) == 0
+    assert client.get(f"/api/uploads/{up['upload_id']}").status_code == 404
+    assert put_chunk(client, up["upload_id"], 0, b"x", 1000).status_code == 404
+
+    assert app_module.purge_expired_uploads(db) >= 1
+    assert not os.path.exists(path)
+    assert db.execute("SELECT 1 FROM upload_sessions WHERE id=?", (up["upload_id"],)).fetchone() is None
+
+
+def test_file_meta_does_not_cache_misses(app_module, db):
+    assert app_module.public_file_sha256(db, "late.pdf") is None
+    db.execute("INSERT INTO public_files (teacher_id, file_name, sha256) VALUES (70001, 'late.pdf', ?)", ("ab" * 32,))
+    assert app_module.public_file_sha256(db, "late.pdf") == "ab" * 32
+    db.rollback()
+
+
+def test_form_upload_quota_is_checked_before_the_body(app_module, login, monkeypatch):
+    client = login("10014")
+    body = b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.mp3\"\r\n\r\nxyz\r\n--b--\r\n"
+    # no Content-Length (a chunked body): refused without reading it
+    resp = client.post("/upload_private", input_stream=io.BytesIO(body), headers={"Transfer-Encoding": "chunked"},
+                       content_type="multipart/form-data; boundary=b")
+    assert resp.status_code == 411
+
+    monkeypatch.setattr(app_module, "USER_QUOTA_BYTES", 10)
+    resp = client.post("/upload_audio", data={"file": (io.BytesIO(b"x" * 100), "a.mp3")})
+    assert resp.status_code == 413
+
+    # a body that passes the declared-length check is checked again once saved
+    monkeypatch.setattr(app_module, "upload_refusal", lambda db, user_id: None)
+    resp = client.post("/upload_audio", data={"file": (io.BytesIO(b"x" * 100), "a.mp3")})
+    assert resp.status_code == 413
+    folder = os.path.join(app_module.UPLOAD_PRIVATE, "10014")
+    assert not os.path.isdir(folder) or not os.listdir(folder)
@@ -0,0 +1,95 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+
+def record(user_id, date_key, hours):
+    args = {"user_id": user_id, "date_key": date_key, "hours": hours, "technique": "", "notes": ""}
+    return (json.dumps({"op": "save_hours", "args": args}) + "\n").encode()
+
+
+def hours_on(db, user_id, date_key):
+    row = db.execute("SELECT hours FROM practice_entries WHERE user_id=? AND date=?", (user_id, date_key)).fetchone()
+    return row["hours"] if row else None
+
+
+@pytest.fixture
+def write_log(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "WRITE_BEHIND", True)
+    monkeypatch.setattr(app_module, "WRITE_LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(app_module, "_write_log", None)
+    return app_module.get_write_log()
+
+
+@pytest.fixture
+def conn(app_module):
+    conn = sqlite3.connect(app_module.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+
+def test_replays_orphaned_segment_from_applied_offset(write_log, conn):
+    lines = [record(10021, "2024-06-01", 1), record(10021, "2024-06-02", 2), record(10021, "2024-06-03", 3)]
+    path = os.path.join(write_log.directory, "99999-1.log")
+    with open(path, "wb") as fh:
+        fh.writelines(lines)
+    # the first record was applied before the process died
+    conn.execute("INSERT INTO feed_state (name, version) VALUES (?, ?)", ("write_log:99999-1.log", len(lines[0])))
+    conn.commit()
+
+    write_log.recover(conn)
+    assert [hours_on(conn, 10021, d) for d in ("2024-06-01", "2024-06-02", "2024-06-03")] == [None, 2, 3]
+    assert not os.path.exists(path)
+    assert conn.execute("SELECT 1 FROM feed_state WHERE name='write_log:99999-1.log'").fetchone() is None
+    assert write_log.recovered == 2
+
+
+def test_torn_final_line_is_not_applied(write_log, conn):
+    path = os.path.join(write_log.directory, "99999-2.log")
+    with open(path, "wb") as fh:
+        fh.write(record(10022, "2024-06-01", 1) + record(10022, "2024-06-02", 2)[:-10])
+
+    write_log.recover(conn)
+    assert hours_on(conn, 10022, "2024-06-01") == 1
+    assert hours_on(conn, 10022, "2024-06-02") is None
+    assert not os.path.exists(path)
+
+
+def test_failing_record_is_dropped_not_retried(write_log, conn):
+    path = os.path.join(write_log.directory, "99999-3.log")
+    bad = (json.dumps({"op": "save_hours", "args": {"user_id": 10023, "date_key": "2024-06-01"}}) + "\n").encode()
+    with open(path, "wb") as fh:
+        fh.write(bad + record(10023, "2024-06-02", 2))
+
+    write_log.recover(conn)
+    assert write_log.failed == 1 and write_log.retries == 0
+    assert hours_on(conn, 10023, "2024-06-02") == 2
+
+
+def test_read_your_writes(write_log, login):
+    client = login("10024")
+    assert client.post("/save_hours", data={"date": "2024-07-01", "hours": "1.5"}).status_code == 200
+    assert client.get_cookie("write_token") is not None
+
+    entries = client.get("/api/practice_entries?month=2024-07").json["entries"]
+    assert entries["2024-07-01"]["hours"] == 1.5
+    assert client.get_cookie("write_token") is None
+
+
+def test_orphan_replays_before_newer_write(write_log, login, conn):
+    client = login("10025")
+    client.post("/save_hours", data={"date": "2024-07-01", "hours": "1"})
+    client.get("/api/practice_entries?month=2024-07")       # writer is running and idle
+
+    # a process died holding an older edit of the same day
+    with open(os.path.join(write_log.directory, "99999-4.log"), "wb") as fh:
+        fh.write(record(10025, "2024-07-02", 5))
+    client.post("/save_hours", data={"date": "2024-07-02", "hours": "2"})
+
+    entries = client.get("/api/practice_entries?month=2024-07").json["entries"]
+    assert entries["2024-07-02"]["hours"] == 2.0
+    write_log.recover(conn)     # a later sweep finds nothing left to replay
+    assert hours_on(conn, 10025, "2024-07-02") == 2.0